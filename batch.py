@@ -0,0 +1,232 @@
+# Resolves many games at once with NumPy, for simulations and analytics.
+#
+# Moves are integer codes (strategy.MOVES: 0 rock, 1 paper, 2 scissors, plus
+# NO_MOVE for a player who didn't choose) and results are indexes into
+# event_log.RESULTS (0 win, 1 lose, 2 draw). The rules are the bot's own, those
+# of game.play_game for solo rounds and settlement.settle for multiplayer rounds,
+# and every game resolves the same way here as there.
+#
+# The bot itself doesn't need NumPy; only the tools importing this module do
+# (pip install "rockpaperscissors-bot[analytics]", or just numpy).
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from event_log import RESULTS
+from settlement import WIN_REWARD, WIN_REWARD_NO_BET
+from strategy import MAX_COUNT, MOVE_CODES, STRATEGIES, STRATEGY_EXPLORATION, Evaluation
+
+NO_MOVE = 3
+
+WIN, LOSE, DRAW = (RESULTS.index(name) for name in ('win', 'lose', 'draw'))
+
+# Streams longer than this have their halved model rows replayed on their own, a
+# window of moves at a time (see _row_counts)
+_LONG_STREAM = 8192
+_REPLAY_WINDOW = 256
+
+# Result of the first player's move against the second's, NO_MOVE included (a draw)
+_OUTCOMES = np.full((4, 4), DRAW, dtype=np.uint8)
+for _move in range(3):
+    _OUTCOMES[_move, (_move + 2) % 3] = WIN
+    _OUTCOMES[_move, (_move + 1) % 3] = LOSE
+
+# Winning move by which moves were played (bit m set if anyone played m); -1 if
+# nobody wins because one move or all three are on the table
+_WINNING_MOVE = np.full(8, -1, dtype=np.int8)
+_WINNING_MOVE[0b011] = MOVE_CODES['paper']     # rock and paper
+_WINNING_MOVE[0b110] = MOVE_CODES['scissors']  # paper and scissors
+_WINNING_MOVE[0b101] = MOVE_CODES['rock']      # rock and scissors
+
+
+def move_array(moves) -> np.ndarray:
+    """Move names (or None) as a uint8 array of move codes."""
+    return np.array([MOVE_CODES.get(move, NO_MOVE) for move in moves], dtype=np.uint8)
+
+
+def resolve_solo(user_moves: np.ndarray, bot_moves: np.ndarray) -> np.ndarray:
+    """
+    Resolve solo rounds
+
+    Args:
+        user_moves: The players' move codes, one per round
+        bot_moves: The bot's move codes, same shape
+
+    Returns:
+        np.ndarray: Each round's result for the player (uint8 RESULTS codes)
+    """
+    return _OUTCOMES[np.asarray(user_moves, dtype=np.intp), np.asarray(bot_moves, dtype=np.intp)]
+
+
+def resolve_rounds(moves: np.ndarray, bets: np.ndarray, win_reward: int = WIN_REWARD,
+                   win_reward_no_bet: int = WIN_REWARD_NO_BET) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Resolve multiplayer rounds with settlement.settle's rules
+
+    Args:
+        moves: (rounds, seats) move codes; pad rounds with fewer players with NO_MOVE
+        bets: (rounds, seats) coins each player bet (0 for padding)
+        win_reward, win_reward_no_bet: Rewards to try instead of the bot's own
+
+    Returns:
+        tuple: (results, currency changes), both (rounds, seats): RESULTS codes as uint8
+            and coins won or lost as int64
+    """
+    moves = np.asarray(moves, dtype=np.uint8)
+    bets = np.asarray(bets, dtype=np.int64)
+
+    played = np.zeros(moves.shape[0], dtype=np.intp)
+    for move in range(3):
+        played |= (moves == move).any(axis=1).astype(np.intp) << move
+    winning = _WINNING_MOVE[played].astype(np.int16)[:, None]
+    # The move the winning move beats; -1 stays out of range of every move code
+    losing = np.where(winning >= 0, (winning + 2) % 3, -1)
+
+    wins = moves == winning
+    losses = moves == losing
+    results = np.full(moves.shape, DRAW, dtype=np.uint8)
+    results[wins] = WIN
+    results[losses] = LOSE
+
+    winner_bets = np.where(wins, bets, 0).sum(axis=1, keepdims=True)
+    loser_bets = np.where(losses, bets, 0).sum(axis=1, keepdims=True)
+    # Winners who bet split the losers' bets pro rata; winner_bets is only 0 when none of them bet
+    shares = loser_bets * bets // np.maximum(winner_bets, 1)
+    payouts = np.where(bets > 0, shares + win_reward, win_reward_no_bet)
+    changes = np.where(wins, payouts, np.where(losses, -bets, 0))
+    return results, changes
+
+
+def count_results(results: np.ndarray) -> Dict[str, int]:
+    """How many of the results are wins, losses and draws."""
+    counts = np.bincount(np.asarray(results).ravel(), minlength=len(RESULTS))
+    return {name: int(counts[code]) for code, name in enumerate(RESULTS)}
+
+
+
+def _row_counts(moves: np.ndarray, streams: np.ndarray) -> np.ndarray:
+    """
+    What a row of three model counters (see strategy._bump) held before each move was counted
+
+    Args:
+        moves: The moves counted in the row, one stream after the other
+        streams: The stream each move belongs to, non-decreasing; each stream starts from zero
+
+    Returns:
+        np.ndarray: (moves, 3) counters
+    """
+    counted = np.eye(3, dtype=np.int32)[moves]
+    before = np.cumsum(counted, axis=0, dtype=np.int32) - counted
+    new_stream = np.r_[True, streams[1:] != streams[:-1]]
+    starts = np.flatnonzero(new_stream)
+    ends = np.r_[starts[1:], len(moves)]
+    stream_index = np.cumsum(new_stream) - 1
+    before -= before[starts[stream_index]]
+
+    # A row is halved when one of its counters would pass MAX_COUNT. Every later count
+    # in the stream then drops by the same amount, so each round halves the rows at
+    # the first full counter of every stream and shifts the rest of those streams.
+    # Long streams are replayed on their own, or the rounds would rescan them too often.
+    long = (ends - starts) > _LONG_STREAM
+    full = before[np.arange(len(moves)), moves] >= MAX_COUNT
+    for stream in np.unique(stream_index[full & long[stream_index]]):
+        before[starts[stream]:ends[stream]] = _halving_row_counts(moves[starts[stream]:ends[stream]])
+    full = np.flatnonzero(full & ~long[stream_index])
+    while len(full):
+        first = full[np.r_[True, stream_index[full[1:]] != stream_index[full[:-1]]]]
+        halved = before[first] >> 1
+        halved[np.arange(len(first)), moves[first]] += 1
+        shift = halved - before[first] - counted[first]
+        # The positions after each first full counter, up to the end of its stream
+        lengths = ends[stream_index[first]] - first - 1
+        offsets = np.repeat(first + 1 - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+        later = np.arange(len(offsets)) + offsets
+        before[later] += np.repeat(shift, lengths, axis=0)
+        full = later[before[later, moves[later]] >= MAX_COUNT]
+    return before
+
+
+def _halving_row_counts(moves: np.ndarray) -> np.ndarray:
+    """_row_counts for a single stream, halving the row as strategy._bump does."""
+    before = np.empty((len(moves), 3), dtype=np.int32)
+    counts = np.zeros(3, dtype=np.int32)
+    done = 0
+    while done < len(moves):
+        window = moves[done:done + _REPLAY_WINDOW]
+        counted = np.eye(3, dtype=np.int32)[window]
+        window_before = counts + np.cumsum(counted, axis=0, dtype=np.int32) - counted
+        full = np.flatnonzero(window_before[np.arange(len(window)), window] >= MAX_COUNT)
+        if not len(full):
+            before[done:done + len(window)] = window_before
+            counts = window_before[-1] + counted[-1]
+            done += len(window)
+            continue
+        # Everything up to the first full counter was counted as usual; then the row is halved
+        halved = full[0]
+        before[done:done + halved + 1] = window_before[:halved + 1]
+        counts = window_before[halved] >> 1
+        counts[window[halved]] += 1
+        done += halved + 1
+    return before
+
+
+def _most_frequent(counts: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """strategy._most_frequent for rows of counts: the top move, ties broken at random, -1 without counts."""
+    top = counts.max(axis=1)
+    picked = np.argmax((counts == top[:, None]) * rng.random(counts.shape), axis=1)
+    return np.where(top > 0, picked, -1)
+
+
+def score_streams(strategy: str, streams: Sequence[bytes], exploration: float = STRATEGY_EXPLORATION,
+                  rng: Optional[np.random.Generator] = None) -> Tuple[int, int, int]:
+    """
+    Strategy.score_stream for many streams at once
+
+    Each stream is replayed from an empty model, with the same predictions, exploration
+    and ties broken at random as the strategy's per-move loop, but for every move at once.
+
+    Args:
+        strategy: 'random', 'frequency' or 'markov'
+        streams: One byte string of move codes per player (see strategy.encode_moves)
+        exploration: Share of rounds the adaptive strategies play a random move anyway
+        rng: Random numbers for the bot's random moves
+
+    Returns:
+        tuple: (bot wins, bot losses, draws) over all the streams
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy '{strategy}'")
+    rng = rng if rng is not None else np.random.default_rng()
+    moves = np.frombuffer(b''.join(streams), dtype=np.uint8).astype(np.intp)
+    lengths = np.fromiter(map(len, streams), dtype=np.intp, count=len(streams))
+    stream_of = np.repeat(np.arange(len(streams)), lengths)
+    bot_moves = rng.integers(0, 3, size=len(moves))
+
+    if strategy != 'random' and len(moves):
+        predicted = _most_frequent(_row_counts(moves, stream_of), rng)
+        if strategy == 'markov':
+            # Each move after a stream's first counts in the row of the move before it
+            follows = np.r_[False, stream_of[1:] == stream_of[:-1]]
+            previous = np.r_[0, moves[:-1]]
+            for row in range(3):
+                at = np.flatnonzero(follows & (previous == row))
+                if len(at):
+                    from_row = _most_frequent(_row_counts(moves[at], stream_of[at]), rng)
+                    predicted[at] = np.where(from_row >= 0, from_row, predicted[at])
+        counter = (predicted + 1) % 3
+        adaptive = (predicted >= 0) & (rng.random(len(moves)) >= exploration)
+        bot_moves = np.where(adaptive, counter, bot_moves)
+
+    counts = np.bincount(_OUTCOMES[bot_moves, moves], minlength=len(RESULTS))
+    return int(counts[WIN]), int(counts[LOSE]), int(counts[DRAW])
+
+
+def evaluate(strategies: Iterable[str], streams: Sequence[bytes]) -> List[Evaluation]:
+    """strategy.evaluate with score_streams in place of each strategy's per-move loop."""
+    results = []
+    for name in strategies:
+        started = time.perf_counter()
+        wins, losses, draws = score_streams(name, streams)
+        results.append(Evaluation(name, wins, losses, draws, time.perf_counter() - started))
+    return results
@@ -0,0 +1,105 @@
+# Benchmark and cross-check of the NumPy batch resolver (batch.py).
+#
+# Resolves random solo and multiplayer rounds with batch.resolve_solo and
+# batch.resolve_rounds, checks a sample of them against game.play_game's rules
+# and settlement.settle, and compares throughput with the one-game-at-a-time
+# code. Needs NumPy. Run from the repository root:
+#
+#     python -m benchmarks.bench_batch --solo 10000000 --rounds 1000000 --seats 8
+import argparse
+import random
+import time
+
+import numpy as np
+
+import batch
+from event_log import RESULTS
+from game import play_game
+from settlement import settle
+from strategy import MOVES
+
+BETS = (0, 10, 25, 50)
+
+
+def random_rounds(rounds: int, seats: int, rng: np.random.Generator):
+    """Random multiplayer rounds of 2 to `seats` players, some of whom don't choose."""
+    moves = rng.integers(0, 3, size=(rounds, seats), dtype=np.uint8)
+    moves[rng.random((rounds, seats)) < 0.05] = batch.NO_MOVE
+    bets = np.asarray(BETS, dtype=np.int64)[rng.integers(0, len(BETS), size=(rounds, seats))]
+    players = rng.integers(2, seats + 1, size=rounds)
+    empty = np.arange(seats)[None, :] >= players[:, None]
+    moves[empty] = batch.NO_MOVE
+    bets[empty] = 0
+    return moves, bets, players
+
+
+def check_solo(user_moves, bot_moves, results, sample: int) -> None:
+    for i in random.sample(range(len(results)), min(sample, len(results))):
+        user_move, bot_move = MOVES[user_moves[i]], MOVES[bot_moves[i]]
+        # play_game picks its own move, so check its rules through the outcome it reports
+        expected = 'draw' if user_move == bot_move else (
+            'win' if (MOVES.index(user_move) - MOVES.index(bot_move)) % 3 == 1 else 'lose')
+        assert RESULTS[results[i]] == expected, (user_move, bot_move, RESULTS[results[i]])
+
+
+def check_rounds(moves, bets, players, results, changes, sample: int) -> None:
+    for i in random.sample(range(len(moves)), min(sample, len(moves))):
+        seats = {seat: {'name': str(seat), 'bet': int(bets[i, seat]),
+                        'choice': MOVES[moves[i, seat]] if moves[i, seat] != batch.NO_MOVE else None}
+                 for seat in range(players[i])}
+        for outcome in settle(seats).outcomes:
+            assert RESULTS[results[i, outcome.user_id]] == outcome.result, (i, outcome.user_id)
+            assert changes[i, outcome.user_id] == outcome.currency_change, (i, outcome.user_id)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy batch resolver against the per-game code")
+    parser.add_argument("--solo", type=int, default=10_000_000, help="Solo rounds to resolve")
+    parser.add_argument("--rounds", type=int, default=1_000_000, help="Multiplayer rounds to resolve")
+    parser.add_argument("--seats", type=int, default=8, help="Most players in a multiplayer round")
+    parser.add_argument("--check", type=int, default=20_000, help="Rounds of each kind checked against the per-game code")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    user_moves = rng.integers(0, 3, size=args.solo, dtype=np.uint8)
+    bot_moves = rng.integers(0, 3, size=args.solo, dtype=np.uint8)
+    started = time.perf_counter()
+    results = batch.resolve_solo(user_moves, bot_moves)
+    batch_seconds = time.perf_counter() - started
+    check_solo(user_moves, bot_moves, results, args.check)
+
+    sample = min(args.check, args.solo)
+    started = time.perf_counter()
+    for i in range(sample):
+        play_game(MOVES[user_moves[i]])
+    loop_seconds = (time.perf_counter() - started) / sample * args.solo
+    print(f"Solo: {args.solo:,} rounds in {batch_seconds * 1000:.0f} ms "
+          f"({args.solo / batch_seconds:,.0f}/s, play_game loop ~{args.solo / loop_seconds:,.0f}/s) "
+          f"{batch.count_results(results)}")
+
+    moves, bets, players = random_rounds(args.rounds, args.seats, rng)
+    started = time.perf_counter()
+    results, changes = batch.resolve_rounds(moves, bets)
+    batch_seconds = time.perf_counter() - started
+    check_rounds(moves, bets, players, results, changes, args.check)
+
+    sample = min(args.check, args.rounds)
+    games = [{seat: {'name': str(seat), 'bet': int(bets[i, seat]),
+                     'choice': MOVES[moves[i, seat]] if moves[i, seat] != batch.NO_MOVE else None}
+              for seat in range(players[i])} for i in range(sample)]
+    started = time.perf_counter()
+    for game in games:
+        settle(game)
+    loop_seconds = (time.perf_counter() - started) / sample * args.rounds
+    print(f"Multiplayer: {args.rounds:,} rounds of up to {args.seats} in {batch_seconds * 1000:.0f} ms "
+          f"({args.rounds / batch_seconds:,.0f}/s, settle loop ~{args.rounds / loop_seconds:,.0f}/s), "
+          f"coins paid out {int(changes.sum()):+,}")
+    print(f"Checked {min(args.check, args.solo):,} solo and {sample:,} multiplayer rounds against the per-game code")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,271 @@
+# In-process benchmark for the handlers in bot.py.
+#
+# Drives full solo and multiplayer flows through the real handlers with synthetic
+# updates and a recording fake Bot, then reports latency percentiles, allocations
+# and throughput per handler. Run from the repository root:
+#
+#     python -m benchmarks.bench_handlers --games 200 --players 8 --save v1.0
+#     python -m benchmarks.bench_handlers --games 200 --players 8 --compare v1.0
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from telegram.ext import ApplicationHandlerStop
+
+from benchmarks.fake_telegram import FakeBot, FakeChat, UpdateFactory
+
+import bot
+from game_manager import get_game_manager
+from outbound import get_outbound_scheduler
+from status_updater import get_status_updater
+from callback_dedup import get_callback_deduplicator
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+# Handlers reported on by default; every other handler driven by the flows is reported too
+KEY_HANDLERS = ('button_callback', 'join_command', 'betting_callback',
+                'multiplayer_choice_callback', 'stats_command')
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class HandlerBench:
+    """Times handler invocations and optionally measures their allocations."""
+
+    def __init__(self, trace_allocations: bool = False):
+        self.trace_allocations = trace_allocations
+        self.latencies: Dict[str, List[float]] = {}
+        self.allocations: Dict[str, List[int]] = {}
+        self.errors: Dict[str, int] = {}
+
+    async def call(self, handler, update, context) -> bool:
+        """Run a handler. Returns False if it stopped the update from reaching later handlers."""
+        name = handler.__name__
+        handled = True
+        if self.trace_allocations:
+            before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        except ApplicationHandlerStop:
+            handled = False
+        except Exception:
+            # Injected Bot API failures that the handler doesn't catch itself
+            self.errors[name] = self.errors.get(name, 0) + 1
+        elapsed = time.perf_counter() - started
+        self.latencies.setdefault(name, []).append(elapsed)
+        if self.trace_allocations:
+            self.allocations.setdefault(name, []).append(tracemalloc.get_traced_memory()[0] - before)
+        return handled
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        results = {}
+        for name, samples in self.latencies.items():
+            ordered = sorted(samples)
+            total = sum(ordered)
+            entry = {
+                'calls': len(ordered),
+                'errors': self.errors.get(name, 0),
+                'p50_ms': percentile(ordered, 0.50) * 1000,
+                'p95_ms': percentile(ordered, 0.95) * 1000,
+                'p99_ms': percentile(ordered, 0.99) * 1000,
+                'mean_ms': total / len(ordered) * 1000,
+                # Calls per second of handler time, i.e. one handler running back to back
+                'throughput_per_s': len(ordered) / total if total > 0 else 0.0,
+            }
+            if name in self.allocations:
+                entry['alloc_bytes_per_call'] = sum(self.allocations[name]) / len(self.allocations[name])
+            results[name] = entry
+        return results
+
+
+async def solo_flow(bench: HandlerBench, factory: UpdateFactory, user_id: int, rounds: int) -> None:
+    """A private chat: /play, then rounds of picking a move and playing again, then /stats."""
+    user = factory.user(user_id)
+    chat = FakeChat(user_id, "private")
+    await bench.call(bot.play_command, factory.command(user, chat, "/play"), factory.context())
+    for round_number in range(rounds):
+        move = ('rock', 'paper', 'scissors')[round_number % 3]
+        await bench.call(bot.button_callback, factory.callback(user, chat, move), factory.context())
+        await bench.call(bot.play_again_callback, factory.callback(user, chat, "play_again"), factory.context())
+    await bench.call(bot.stats_command, factory.command(user, chat, "/stats"), factory.context())
+
+
+async def press(bench: HandlerBench, factory: UpdateFactory, handler, update, repeats: int) -> None:
+    """A button press plus `repeats` quick repeats, each dispatched like the application does."""
+    for tap in [update] + [factory.tap_again(update) for _ in range(repeats)]:
+        # The repeat-tap check runs in an earlier handler group
+        if await bench.call(bot.dedupe_callback, tap, factory.context()):
+            await bench.call(handler, tap, factory.context())
+
+
+async def multiplayer_flow(bench: HandlerBench, factory: UpdateFactory, chat_id: int,
+                           first_user_id: int, players: int, repeat_taps: int = 0) -> None:
+    """
+    A group game: /multiplayer, players joining, every player betting and choosing, then /stats.
+    Every bet and move button is pressed 1 + repeat_taps times.
+
+    Games start automatically on the second /join, so all players but the last are
+    seated directly through the game manager and only the final /join goes through
+    the handler (which then starts the game and prompts everyone).
+    """
+    chat = FakeChat(chat_id, "supergroup")
+    users = [factory.user(first_user_id + i) for i in range(players)]
+
+    await bench.call(bot.multiplayer_command, factory.command(users[0], chat, "/multiplayer"), factory.context())
+    manager = get_game_manager()
+    for user in users[1:-1]:
+        await manager.join_game(chat_id, user.id, user.username)
+    await bench.call(bot.join_command, factory.command(users[-1], chat, "/join"), factory.context())
+
+    for index, user in enumerate(users):
+        private = FakeChat(user.id, "private")
+        bet = (0, 10, 25, 50)[index % 4]
+        await press(bench, factory, bot.betting_callback,
+                    factory.callback(user, private, f"bet_{bet}_{chat_id}"), repeat_taps)
+    for index, user in enumerate(users):
+        private = FakeChat(user.id, "private")
+        move = ('rock', 'paper', 'scissors')[(index * 7 + chat_id) % 3]
+        await press(bench, factory, bot.multiplayer_choice_callback,
+                    factory.callback(user, private, f"mp_{move}_{chat_id}"), repeat_taps)
+
+    # Look someone up by name, as other group members would after a game
+    await bench.call(bot.stats_command, factory.command(users[0], chat, "/stats"),
+                     factory.context([users[-1].username]))
+
+
+async def run(args) -> Dict:
+    fake_bot = FakeBot(latency=args.latency / 1000, jitter=args.jitter / 1000,
+                       error_rate=args.error_rate, seed=args.seed, record=False)
+    factory = UpdateFactory(fake_bot)
+    bench = HandlerBench(trace_allocations=args.allocations)
+    # Handlers queue their messages; the fake Bot has no rate limits unless asked to model them
+    outbound = get_outbound_scheduler(fake_bot, rate_limits=args.rate_limits)
+
+    if args.allocations:
+        tracemalloc.start()
+    started = time.perf_counter()
+
+    for i in range(args.solo_users):
+        await solo_flow(bench, factory, user_id=1_000_000 + i, rounds=args.solo_rounds)
+    for game in range(args.games):
+        await multiplayer_flow(bench, factory, chat_id=-(1_000_000 + game),
+                               first_user_id=2_000_000 + game * args.players, players=args.players,
+                               repeat_taps=args.repeat_taps)
+    # Handlers return once their messages are queued; wait for them to go out
+    status_updates = get_status_updater(outbound)
+    status_updates.flush_all()
+    await outbound.drain()
+    await outbound.stop()
+
+    wall = time.perf_counter() - started
+    if args.allocations:
+        tracemalloc.stop()
+
+    return {
+        'config': {
+            'solo_users': args.solo_users, 'solo_rounds': args.solo_rounds,
+            'games': args.games, 'players': args.players, 'repeat_taps': args.repeat_taps,
+            'latency_ms': args.latency, 'jitter_ms': args.jitter, 'error_rate': args.error_rate,
+        },
+        'wall_seconds': wall,
+        'api_calls': dict(fake_bot.call_counts),
+        'api_errors': dict(fake_bot.error_counts),
+        'outbound': outbound.stats(),
+        'status_updates': status_updates.stats(),
+        'repeat_taps': get_callback_deduplicator().stats(),
+        'handlers': bench.summary(),
+    }
+
+
+def print_report(report: Dict, baseline: Optional[Dict] = None) -> None:
+    print(f"Wall time: {report['wall_seconds']:.2f}s, API calls: {sum(report['api_calls'].values())} "
+          f"({', '.join(f'{k}={v}' for k, v in sorted(report['api_calls'].items()))})")
+    if 'outbound' in report:
+        print(f"Outbound queue: {', '.join(f'{k}={v}' for k, v in report['outbound'].items())}")
+    if 'status_updates' in report:
+        print(f"Status updates: {', '.join(f'{k}={v}' for k, v in report['status_updates'].items())}")
+    if 'repeat_taps' in report:
+        print(f"Button presses: {', '.join(f'{k}={v}' for k, v in report['repeat_taps'].items())}")
+    header = f"{'handler':<30}{'calls':>8}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>12}{'alloc B':>10}"
+    print(header)
+    print('-' * len(header))
+    handlers = report['handlers']
+    names = [name for name in KEY_HANDLERS if name in handlers] + \
+            sorted(name for name in handlers if name not in KEY_HANDLERS)
+    for name in names:
+        entry = handlers[name]
+        alloc = entry.get('alloc_bytes_per_call')
+        line = (f"{name:<30}{entry['calls']:>8}{entry['errors']:>6}{entry['p50_ms']:>10.3f}"
+                f"{entry['p95_ms']:>10.3f}{entry['p99_ms']:>10.3f}{entry['throughput_per_s']:>12.0f}"
+                f"{(f'{alloc:.0f}' if alloc is not None else '-'):>10}")
+        print(line)
+        if baseline and name in baseline['handlers']:
+            base = baseline['handlers'][name]
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                if base[key] > 0:
+                    changes.append(f"{key} {(entry[key] - base[key]) / base[key] * 100:+.1f}%")
+            print(f"{'':<30}vs baseline: {', '.join(changes)}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark bot.py handlers with a fake Bot")
+    parser.add_argument("--solo-users", type=int, default=200, help="Users playing solo games")
+    parser.add_argument("--solo-rounds", type=int, default=5, help="Rounds per solo user")
+    parser.add_argument("--games", type=int, default=200, help="Multiplayer games to play")
+    parser.add_argument("--players", type=int, default=4, help="Players per multiplayer game")
+    parser.add_argument("--repeat-taps", type=int, default=0,
+                        help="Extra presses of every bet and move button, as impatient users do")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake Bot API latency in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Bot API calls that fail")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for latency and errors")
+    parser.add_argument("--rate-limits", action="store_true", help="Pace messages to Telegram's rate limits")
+    parser.add_argument("--allocations", action="store_true", help="Measure allocations (slower)")
+    parser.add_argument("--save", metavar="NAME", help="Save the results as baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="Compare against saved baseline NAME")
+    parser.add_argument("--json", action="store_true", help="Print the raw results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.players < 2:
+        parser.error("--players must be at least 2")
+
+    # The handlers log at DEBUG (and at ERROR for every injected failure); that would dominate the measurements
+    logging.disable(logging.ERROR)
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report, baseline)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.save}.json"), 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline {args.save}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# Stats persistence at realistic scale: how long a bot with many players takes to
+# write its shutdown snapshot and to load it again on a cold start.
+#
+# Plays --games games for each of --users players through update_user_stats and
+# update_user_currency (the same calls the handlers make), closes the storage, which
+# writes a snapshot, then times init_persistence in fresh interpreters. The generated
+# data is kept in --data-dir and reused by later runs unless --regenerate is given.
+# Run from the repository root:
+#
+#     python -m benchmarks.bench_persistence --users 500000 --games 3
+#     python -m benchmarks.bench_persistence --users 2000000 --runs 1
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Optional
+
+from event_log import SEGMENT_PREFIX, SNAPSHOT_FILE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter: load the stats and report the time it took and what was loaded
+_COLD_START = """
+import time
+started = time.perf_counter()
+import stats
+imported = time.perf_counter()
+stats.init_persistence()
+loaded = time.perf_counter()
+matches = stats.find_users_by_username('player_12')
+history = stats.get_user_history(12, 5)
+print(imported - started, loaded - imported, len(stats.user_stats), len(matches), len(history))
+stats.close_persistence() if {close} else None
+print(time.perf_counter() - loaded)
+"""
+
+
+def generate(users: int, games: int, seed: int) -> Dict[str, float]:
+    """Play the games and shut the storage down. Returns seconds spent playing and closing."""
+    import stats
+
+    stats.init_persistence()
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    for game in range(games):
+        for user_id in range(users):
+            result = rng.choice(('win', 'lose', 'draw'))
+            change = {'win': 10, 'lose': -10}.get(result, 0)
+            stats.update_user_stats(user_id, f"player_{user_id}", result, mode='solo',
+                                    choice=rng.choice(('rock', 'paper', 'scissors')),
+                                    opponent_choice=rng.choice(('rock', 'paper', 'scissors')),
+                                    bet=10, currency_change=change)
+            stats.update_user_currency(user_id, change, key=f"bench:{game}:{user_id}")
+            if user_id % 10000 == 9999:
+                # One batch per tick, as sync_stats does
+                pending = stats.sync_persistence()
+                if pending is not None:
+                    pending.result()
+    played = time.perf_counter() - started
+
+    started = time.perf_counter()
+    stats.close_persistence()
+    return {'play': played, 'close': time.perf_counter() - started}
+
+
+def cold_start(env: Dict[str, str], close: bool) -> Optional[Dict[str, float]]:
+    result = subprocess.run([sys.executable, '-c', _COLD_START.format(close=close)],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr[-2000:], file=sys.stderr)
+        return None
+    first, second = result.stdout.split('\n')[:2]
+    imported, loaded, users, matches, history = first.split()
+    return {'import': float(imported), 'load': float(loaded), 'users': int(users),
+            'matches': int(matches), 'history': int(history), 'close': float(second)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Time the shutdown snapshot and cold start with many players")
+    parser.add_argument("--users", type=int, default=500000)
+    parser.add_argument("--games", type=int, default=3, help="Games per player")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts to time")
+    parser.add_argument("--data-dir", help="Where to keep the generated stats (default: a temporary directory)")
+    parser.add_argument("--regenerate", action="store_true", help="Play the games again even if --data-dir has stats")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="rps-persistence-")
+    env = dict(os.environ, STATS_BACKEND='eventlog', STATS_DATA_DIR=data_dir,
+               # Only the shutdown snapshot, so the timings cover exactly one
+               STATS_SNAPSHOT_EVERY=str(10 ** 12))
+    os.environ.update(env)
+
+    os.makedirs(data_dir, exist_ok=True)
+    saved = [name for name in os.listdir(data_dir)
+             if name.startswith(SNAPSHOT_FILE.split('.')[0]) or name.startswith(SEGMENT_PREFIX)]
+    if args.regenerate:
+        for name in saved:
+            os.remove(os.path.join(data_dir, name))
+    if args.regenerate or not saved:
+        print(f"Playing {args.games} games for each of {args.users:,} players...")
+        timings = generate(args.users, args.games, args.seed)
+        print(f"played in {timings['play']:.1f} s, shutdown snapshot written in {timings['close']:.2f} s")
+
+    size = sum(os.path.getsize(os.path.join(data_dir, name)) for name in os.listdir(data_dir))
+    print(f"stats storage: {size / 2 ** 20:.1f} MiB in {data_dir}")
+
+    runs = [cold_start(env, close=run == args.runs - 1) for run in range(args.runs)]
+    runs = [run for run in runs if run is not None]
+    if not runs:
+        print("Every cold start failed")
+        return 1
+    best = min(runs, key=lambda run: run['load'])
+    print(f"cold start: init_persistence {best['load']:.2f} s best of {len(runs)} "
+          f"(median {sorted(run['load'] for run in runs)[len(runs) // 2]:.2f} s), "
+          f"importing stats {best['import']:.2f} s, {best['users']:,} players loaded")
+    print(f"snapshot on shutdown after a cold start: {runs[-1]['close']:.2f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,158 @@
+# Cold start benchmark: what importing the bot costs, module by module, and how
+# long a restarted bot takes to answer its first command.
+#
+# Import times come from `python -X importtime` in fresh interpreters. The first
+# reply is timed against the fake Bot API in benchmarks/fake_bot_api.py: a /start
+# is queued, the bot is started, and the clock stops when its reply arrives.
+# Run from the repository root:
+#
+#     python -m benchmarks.bench_startup --runs 5
+#     python -m benchmarks.bench_startup --module game_manager --no-reply
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.fake_bot_api import FakeTelegram, make_handler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# "import time: <self us> | <cumulative us> | <indented module name>"
+_IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+# The bot's own modules, reported one by one; everything else is grouped by top-level package
+_PROJECT_MODULES = {
+    os.path.splitext(name)[0] for name in os.listdir(ROOT) if name.endswith('.py')
+}
+
+
+def measure_imports(module: str, env: Dict[str, str]) -> Tuple[float, Dict[str, float], List[Tuple[str, float, float]]]:
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        tuple: (wall seconds, self time per package in ms, (module, self ms, cumulative ms) per module)
+    """
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    packages: Dict[str, float] = {}
+    modules = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, _, name = match.groups()
+        top = name.split('.')[0]
+        group = name if top in _PROJECT_MODULES else top
+        packages[group] = packages.get(group, 0.0) + int(self_us) / 1000
+        modules.append((name, int(self_us) / 1000, int(cumulative_us) / 1000))
+    return wall, packages, modules
+
+
+def measure_first_reply(env: Dict[str, str], timeout: float) -> Optional[float]:
+    """Seconds from starting the bot (as main.py does) to its reply to a /start that was already waiting."""
+    telegram = FakeTelegram(enforce_limits=False)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(telegram))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    user = {'id': 42, 'is_bot': False, 'first_name': 'Restart', 'username': 'restart'}
+    telegram.push_update({'message': {
+        'message_id': 1, 'date': int(time.time()), 'text': '/start',
+        'chat': {'id': user['id'], 'type': 'private'}, 'from': user,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    }})
+
+    env = dict(env, TELEGRAM_TOKEN='123:fake',
+               TELEGRAM_API_URL=f"http://127.0.0.1:{server.server_address[1]}")
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-c', 'from bot import start_bot; start_bot()'], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.monotonic() - started < timeout:
+            with telegram.lock:
+                if telegram.method_counts.get('sendMessage'):
+                    return time.monotonic() - started
+            if process.poll() is not None:
+                return None
+            time.sleep(0.002)
+        return None
+    finally:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        server.shutdown()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure import time and restart-to-first-reply time")
+    parser.add_argument("--module", default="bot", help="Module whose import is measured")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=15, help="Slowest packages and modules to list")
+    parser.add_argument("--no-reply", action="store_true", help="Only measure imports")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for the first reply")
+    args = parser.parse_args(argv)
+
+    # Keep the benchmark's stats away from the real ones
+    data_dir = tempfile.mkdtemp(prefix="rps-startup-")
+    env = dict(os.environ, STATS_DATA_DIR=data_dir)
+    env.pop('BOT_SHARDS', None)
+
+    walls = []
+    packages: Dict[str, List[float]] = {}
+    modules: Dict[str, List[float]] = {}
+    for _ in range(args.runs):
+        wall, run_packages, run_modules = measure_imports(args.module, env)
+        walls.append(wall)
+        for name, ms in run_packages.items():
+            packages.setdefault(name, []).append(ms)
+        for name, _, cumulative in run_modules:
+            modules.setdefault(name, []).append(cumulative)
+
+    def best(values: List[float]) -> float:
+        return min(values)
+
+    total = sum(best(values) for values in packages.values())
+    print(f"import {args.module}: {total:.1f} ms of imports, interpreter wall time "
+          f"{min(walls) * 1000:.0f} ms (best of {args.runs})")
+    header = f"{'package':<28}{'self ms':>10}{'share':>8}"
+    print(header)
+    print('-' * len(header))
+    for name, values in sorted(packages.items(), key=lambda item: -best(item[1]))[:args.top]:
+        print(f"{name:<28}{best(values):>10.1f}{best(values) / total:>8.0%}")
+
+    print()
+    header = f"{'module':<40}{'cumulative ms':>14}"
+    print(header)
+    print('-' * len(header))
+    for name, values in sorted(modules.items(), key=lambda item: -best(item[1]))[:args.top]:
+        print(f"{name:<40}{best(values):>14.1f}")
+
+    if not args.no_reply:
+        print()
+        replies = [measure_first_reply(env, args.timeout) for _ in range(args.runs)]
+        answered = sorted(seconds for seconds in replies if seconds is not None)
+        if not answered:
+            print("The bot never replied (check that it starts with TELEGRAM_API_URL set)")
+            return 1
+        print(f"Restart to first reply: best {answered[0] * 1000:.0f} ms, "
+              f"median {answered[len(answered) // 2] * 1000:.0f} ms, "
+              f"{len(replies) - len(answered)} of {len(replies)} runs without a reply")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,121 @@
+# Batch evaluation of the solo opponent's strategies (strategy.py).
+#
+# Replays move streams against each strategy and reports its edge (wins minus
+# losses per round, from the bot's side) and how many moves per second the
+# evaluator gets through. Streams come from synthetic players with typical
+# habits, or from the solo games recorded in the stats storage. With NumPy
+# installed, every stream is scored at once by batch.score_streams; --per-move
+# (or no NumPy) replays them through each strategy's own loop instead. Run from
+# the repository root:
+#
+#     python -m benchmarks.bench_strategies --players 1000 --moves 1000
+#     python -m benchmarks.bench_strategies --from-stats
+#     python -m benchmarks.bench_strategies --per-move
+import argparse
+import random
+from typing import Callable, Dict, List
+
+from strategy import STRATEGIES, encode_moves, evaluate
+
+
+def _random(rng: random.Random, previous: int) -> int:
+    return rng.randrange(3)
+
+
+def _favourite(rng: random.Random, previous: int) -> int:
+    # Plays rock half the time
+    return 0 if rng.random() < 0.5 else rng.randrange(1, 3)
+
+
+def _cycle(rng: random.Random, previous: int) -> int:
+    # Rock, paper, scissors, rock... with the odd slip
+    return (previous + 1) % 3 if rng.random() < 0.8 else rng.randrange(3)
+
+
+def _repeat(rng: random.Random, previous: int) -> int:
+    # Sticks with a move about two thirds of the time
+    return previous if rng.random() < 0.65 else rng.randrange(3)
+
+
+# Synthetic player habits: next move from the previous one
+PROFILES: Dict[str, Callable[[random.Random, int], int]] = {
+    'random': _random,
+    'favourite': _favourite,
+    'cycle': _cycle,
+    'repeat': _repeat,
+}
+
+
+def synthetic_streams(profile: str, players: int, moves: int, seed: int) -> List[bytes]:
+    rng = random.Random(seed)
+    play = PROFILES[profile]
+    streams = []
+    for _ in range(players):
+        previous = rng.randrange(3)
+        stream = bytearray(moves)
+        for i in range(moves):
+            previous = stream[i] = play(rng, previous)
+        streams.append(bytes(stream))
+    return streams
+
+
+def recorded_streams() -> List[bytes]:
+    """Every player's recorded solo moves, oldest first."""
+    from stats import init_persistence, close_persistence, get_all_players, get_user_history
+    from history import HISTORY_DEPTH
+
+    init_persistence()
+    try:
+        streams = []
+        for user_id, _ in get_all_players():
+            records = get_user_history(user_id, limit=HISTORY_DEPTH)
+            moves = encode_moves(record['choice'] for record in reversed(records) if record['mode'] == 'solo')
+            if moves:
+                streams.append(moves)
+        return streams
+    finally:
+        close_persistence()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Score the solo strategies against recorded or synthetic players")
+    parser.add_argument("--players", type=int, default=1000, help="Synthetic players per profile")
+    parser.add_argument("--moves", type=int, default=1000, help="Moves per synthetic player")
+    parser.add_argument("--from-stats", action="store_true", help="Replay the solo games in the stats storage")
+    parser.add_argument("--strategy", action="append", choices=sorted(STRATEGIES),
+                        help="Strategy to evaluate (repeatable; default: all)")
+    parser.add_argument("--per-move", action="store_true",
+                        help="Replay each move through the strategy's own loop instead of the NumPy evaluator")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    score = evaluate
+    if not args.per_move:
+        try:
+            import batch
+            score = batch.evaluate
+        except ImportError:
+            print("NumPy isn't installed, replaying move by move")
+
+    names = args.strategy or list(STRATEGIES)
+    if args.from_stats:
+        datasets = {'recorded': recorded_streams()}
+    else:
+        datasets = {profile: synthetic_streams(profile, args.players, args.moves, args.seed)
+                    for profile in PROFILES}
+
+    header = f"{'players':<12}{'strategy':<12}{'moves':>12}{'win %':>8}{'loss %':>8}{'edge':>8}{'moves/s':>14}"
+    print(header)
+    print('-' * len(header))
+    for dataset, streams in datasets.items():
+        if not streams:
+            print(f"{dataset:<12}(no moves)")
+            continue
+        for result in score(names, streams):
+            print(f"{dataset:<12}{result.name:<12}{result.moves:>12}{result.win_rate:>8.1%}"
+                  f"{result.losses / result.moves:>8.1%}{result.edge:>8.3f}{result.moves_per_second:>14,.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,441 @@
+# Local stand-in for the Telegram Bot API, for end-to-end load tests of the real bot.
+#
+# Serves the subset of Bot API methods the bot uses, generates synthetic traffic
+# from simulated groups and users who react to the bot's messages like people
+# would (joining, betting and choosing by pressing the inline buttons), enforces
+# Telegram-like rate limits and measures how long the bot takes to reply.
+#
+#     python -m benchmarks.fake_bot_api --port 8081 --groups 50 --users 6 --duration 60
+#     TELEGRAM_TOKEN=123:fake TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+import argparse
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+# Telegram's documented limits for bots
+GLOBAL_MESSAGES_PER_SECOND = 30
+GROUP_MESSAGES_PER_MINUTE = 20
+PRIVATE_MESSAGES_PER_SECOND = 1
+
+# Form fields whose values are sent as plain strings rather than JSON
+_STRING_FIELDS = {'text', 'parse_mode', 'callback_query_id', 'url', 'secret_token', 'data'}
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'RockPaperScissors Bot', 'username': 'RPLSLBot'}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to capacity."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Take a token. Returns 0 on success, or the seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeTelegram:
+    """State of the fake Bot API: queued updates, sent messages, rate limits and latency samples."""
+
+    def __init__(self, enforce_limits: bool = True):
+        self.enforce_limits = enforce_limits
+        self.lock = threading.Condition()
+        self.updates: List[Dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._global_bucket = TokenBucket(GLOBAL_MESSAGES_PER_SECOND, GLOBAL_MESSAGES_PER_SECOND)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self.simulation: Optional['TrafficSimulation'] = None
+
+        # Pending replies: callback_query_id -> sent time, chat_id -> [sent times of commands]
+        self._pending_callbacks: Dict[str, float] = {}
+        self._pending_commands: Dict[int, List[float]] = {}
+        self.callback_latencies: List[float] = []
+        self.command_latencies: List[float] = []
+        self.method_counts: Dict[str, int] = {}
+        self.rate_limited: Dict[str, int] = {}
+        self.updates_delivered = 0
+
+    # ------------------------------------------------------------------
+    # Incoming traffic (from the simulation)
+    # ------------------------------------------------------------------
+    def push_update(self, update: Dict) -> None:
+        with self.lock:
+            update['update_id'] = next(self._update_ids)
+            now = time.monotonic()
+            if 'callback_query' in update:
+                self._pending_callbacks[update['callback_query']['id']] = now
+            else:
+                self._pending_commands.setdefault(update['message']['chat']['id'], []).append(now)
+            self.updates.append(update)
+            self.lock.notify_all()
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    # ------------------------------------------------------------------
+    # Bot API methods
+    # ------------------------------------------------------------------
+    def call(self, method: str, params: Dict) -> Tuple[int, Dict]:
+        with self.lock:
+            self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return 200, {'ok': True, 'result': True}
+        return handler(params)
+
+    def api_getMe(self, params):
+        return 200, {'ok': True, 'result': dict(BOT_USER, can_join_groups=True,
+                                                can_read_all_group_messages=False,
+                                                supports_inline_queries=False)}
+
+    def api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            # Updates below the offset are confirmed and can be forgotten
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            batch = self.updates[:limit]
+            self.updates_delivered += len(batch)
+        return 200, {'ok': True, 'result': batch}
+
+    def _rate_limit(self, method: str, chat_id: int) -> Optional[Tuple[int, Dict]]:
+        if not self.enforce_limits:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if chat_id < 0:
+                    bucket = TokenBucket(GROUP_MESSAGES_PER_MINUTE / 60, GROUP_MESSAGES_PER_MINUTE)
+                else:
+                    bucket = TokenBucket(PRIVATE_MESSAGES_PER_SECOND, 3)
+                self._chat_buckets[chat_id] = bucket
+            wait = max(bucket.take(now), self._global_bucket.take(now))
+            if wait <= 0:
+                return None
+            self.rate_limited[method] = self.rate_limited.get(method, 0) + 1
+        retry_after = max(1, int(wait + 0.999))
+        return 429, {'ok': False, 'error_code': 429,
+                     'description': f"Too Many Requests: retry after {retry_after}",
+                     'parameters': {'retry_after': retry_after}}
+
+    def _record_reply(self, chat_id: int) -> None:
+        with self.lock:
+            pending = self._pending_commands.get(chat_id)
+            if pending:
+                self.command_latencies.append(time.monotonic() - pending.pop(0))
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None,
+                 reply_markup: Optional[Dict] = None) -> Dict:
+        message = {
+            'message_id': message_id or self.next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+            'from': BOT_USER,
+            'text': text,
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        return message
+
+    def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        limited = self._rate_limit('sendMessage', chat_id)
+        if limited:
+            return limited
+        self._record_reply(chat_id)
+        message = self._message(chat_id, params.get('text', ''), reply_markup=params.get('reply_markup'))
+        if self.simulation is not None:
+            self.simulation.on_bot_message(message)
+        return 200, {'ok': True, 'result': message}
+
+    def api_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        limited = self._rate_limit('editMessageText', chat_id)
+        if limited:
+            return limited
+        self._record_reply(chat_id)
+        message = self._message(chat_id, params.get('text', ''), message_id=int(params['message_id']),
+                                reply_markup=params.get('reply_markup'))
+        if self.simulation is not None:
+            self.simulation.on_bot_message(message)
+        return 200, {'ok': True, 'result': message}
+
+    def api_answerCallbackQuery(self, params):
+        with self.lock:
+            sent = self._pending_callbacks.pop(params.get('callback_query_id'), None)
+            if sent is not None:
+                self.callback_latencies.append(time.monotonic() - sent)
+        return 200, {'ok': True, 'result': True}
+
+    def api_getChatMemberCount(self, params):
+        chat_id = int(params['chat_id'])
+        members = self.simulation.group_sizes.get(chat_id, 2) if self.simulation else 2
+        return 200, {'ok': True, 'result': members + 1}
+
+    # ------------------------------------------------------------------
+    # Reporting
+    # ------------------------------------------------------------------
+    def take_stats(self) -> Dict:
+        """Latency and traffic numbers since the last call."""
+        with self.lock:
+            callbacks = sorted(self.callback_latencies)
+            commands = sorted(self.command_latencies)
+            stats = {
+                'updates_delivered': self.updates_delivered,
+                'callback_acks': len(callbacks),
+                'callback_p50_ms': percentile(callbacks, 0.5) * 1000,
+                'callback_p95_ms': percentile(callbacks, 0.95) * 1000,
+                'callback_p99_ms': percentile(callbacks, 0.99) * 1000,
+                'command_replies': len(commands),
+                'command_p50_ms': percentile(commands, 0.5) * 1000,
+                'command_p95_ms': percentile(commands, 0.95) * 1000,
+                'command_p99_ms': percentile(commands, 0.99) * 1000,
+                'backlog': len(self.updates),
+                'rate_limited': dict(self.rate_limited),
+                'method_counts': dict(self.method_counts),
+            }
+            self.callback_latencies = []
+            self.command_latencies = []
+            self.updates_delivered = 0
+            self.rate_limited = {}
+        return stats
+
+
+class TrafficSimulation:
+    """
+    Simulated groups of users playing through the bot.
+
+    In each group one member opens a game with /multiplayer and the others /join
+    after exponentially distributed delays. Whenever the bot sends a user an inline
+    keyboard (bet amounts, moves), that user presses one of its buttons after a
+    think time. When a game ends or times out, the group starts another one.
+    """
+
+    def __init__(self, telegram: FakeTelegram, groups: int, users_per_group: int,
+                 join_rate: float, bet_rate: float, choice_rate: float,
+                 restart_delay: float, seed: Optional[int] = None):
+        self.telegram = telegram
+        self.join_rate = join_rate
+        self.bet_rate = bet_rate
+        self.choice_rate = choice_rate
+        self.restart_delay = restart_delay
+        self.random = random.Random(seed)
+        self._queue: List[Tuple[float, int, Dict]] = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._query_ids = itertools.count(1)
+        self.group_members: Dict[int, List[int]] = {}
+        self.group_sizes: Dict[int, int] = {}
+        self.users: Dict[int, Dict] = {}
+
+        user_ids = itertools.count(10_000_000)
+        for group in range(groups):
+            chat_id = -(1_000_000_000 + group)
+            members = [next(user_ids) for _ in range(users_per_group)]
+            self.group_members[chat_id] = members
+            self.group_sizes[chat_id] = len(members)
+            for user_id in members:
+                self.users[user_id] = {'id': user_id, 'is_bot': False,
+                                       'first_name': f"Player {user_id}", 'username': f"player{user_id}"}
+            # Stagger the first games so the groups don't all start at once
+            self._start_game(chat_id, self.random.uniform(0, restart_delay))
+
+    def _schedule(self, delay: float, update: Dict) -> None:
+        with self._lock:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._sequence), update))
+
+    def _command(self, chat_id: int, user_id: int, command: str) -> Dict:
+        return {'message': {
+            'message_id': self.telegram.next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Arena {chat_id}"},
+            'from': self.users[user_id],
+            'text': command,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }}
+
+    def _start_game(self, chat_id: int, delay: float) -> None:
+        members = self.group_members[chat_id]
+        creator = self.random.choice(members)
+        self._schedule(delay, self._command(chat_id, creator, "/multiplayer"))
+        for user_id in members:
+            if user_id != creator:
+                self._schedule(delay + self.random.expovariate(self.join_rate),
+                               self._command(chat_id, user_id, "/join"))
+
+    def on_bot_message(self, message: Dict) -> None:
+        """React to a message the bot sent, like the users receiving it would."""
+        chat_id = message['chat']['id']
+        text = message.get('text', '')
+        if chat_id < 0:
+            if chat_id in self.group_members and ("BATTLE CONCLUDED" in text or "GAME TIMEOUT" in text):
+                self._start_game(chat_id, self.restart_delay)
+            return
+
+        keyboard = (message.get('reply_markup') or {}).get('inline_keyboard')
+        if not keyboard or chat_id not in self.users:
+            return
+        buttons = [button['callback_data'] for row in keyboard for button in row if 'callback_data' in button]
+        if not buttons:
+            return
+        data = self.random.choice(buttons)
+        rate = self.bet_rate if data.startswith('bet_') else self.choice_rate
+        self._schedule(self.random.expovariate(rate), {'callback_query': {
+            'id': str(next(self._query_ids)),
+            'from': self.users[chat_id],
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': message,
+        }})
+
+    def run(self, stop: threading.Event) -> None:
+        """Release scheduled updates to the fake API as they come due."""
+        while not stop.is_set():
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                while self._queue and self._queue[0][0] <= now:
+                    due.append(heapq.heappop(self._queue)[2])
+                next_time = self._queue[0][0] if self._queue else now + 0.05
+            for update in due:
+                self.telegram.push_update(update)
+            stop.wait(min(0.05, max(0.0, next_time - time.monotonic())))
+
+
+def make_handler(telegram: FakeTelegram):
+    class BotApiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self._handle()
+
+        def do_GET(self):
+            self._handle()
+
+        def _handle(self):
+            # Paths look like /bot<token>/<method>
+            parts = self.path.split('?', 1)[0].strip('/').split('/')
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                return
+            method = parts[1]
+
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            params = {}
+            if body:
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body)
+                else:
+                    for key, value in parse_qsl(body.decode('utf-8'), keep_blank_values=True):
+                        if key in _STRING_FIELDS:
+                            params[key] = value
+                        else:
+                            try:
+                                params[key] = json.loads(value)
+                            except ValueError:
+                                params[key] = value
+
+            status, payload = telegram.call(method, params)
+            self._reply(status, payload)
+
+        def _reply(self, status: int, payload: Dict) -> None:
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return BotApiHandler
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server with synthetic traffic")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--groups", type=int, default=20, help="Simulated group chats")
+    parser.add_argument("--users", type=int, default=4, help="Members per group")
+    parser.add_argument("--join-rate", type=float, default=0.5, help="Joins per second per member (mean 1/rate delay)")
+    parser.add_argument("--bet-rate", type=float, default=1.0, help="Bet button presses per second per user")
+    parser.add_argument("--choice-rate", type=float, default=1.0, help="Move button presses per second per user")
+    parser.add_argument("--restart-delay", type=float, default=5.0, help="Seconds before a group starts its next game")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to run before printing the report")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between progress reports")
+    parser.add_argument("--no-limits", action="store_true", help="Don't enforce Telegram rate limits")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    telegram = FakeTelegram(enforce_limits=not args.no_limits)
+    telegram.simulation = TrafficSimulation(
+        telegram, args.groups, args.users, args.join_rate, args.bet_rate,
+        args.choice_rate, args.restart_delay, seed=args.seed
+    )
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(telegram))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stop = threading.Event()
+    threading.Thread(target=telegram.simulation.run, args=(stop,), daemon=True).start()
+
+    print(f"Fake Bot API listening on http://{args.host}:{args.port} "
+          f"({args.groups} groups x {args.users} users)")
+    print(f"Start the bot with TELEGRAM_API_URL=http://{args.host}:{args.port}")
+
+    started = time.monotonic()
+    try:
+        while time.monotonic() - started < args.duration:
+            time.sleep(args.interval)
+            stats = telegram.take_stats()
+            print(f"[{time.monotonic() - started:6.1f}s] "
+                  f"updates/s={stats['updates_delivered'] / args.interval:7.1f} "
+                  f"backlog={stats['backlog']:5d} "
+                  f"ack p50/p95/p99={stats['callback_p50_ms']:.0f}/{stats['callback_p95_ms']:.0f}/"
+                  f"{stats['callback_p99_ms']:.0f}ms "
+                  f"reply p50/p95/p99={stats['command_p50_ms']:.0f}/{stats['command_p95_ms']:.0f}/"
+                  f"{stats['command_p99_ms']:.0f}ms "
+                  f"429s={sum(stats['rate_limited'].values())}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.shutdown()
+
+    print("Bot API calls:", json.dumps(telegram.method_counts, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,171 @@
+# Local stand-in for memcached, for running several bot processes against one
+# shared game store (GAME_STORE=memcached) without installing memcached.
+#
+# Speaks the subset of the text protocol that game_store.py and common clients
+# use (get, gets, set, add, replace, cas, delete, touch, flush_all, version),
+# including CAS tokens and expiry times.
+#
+#     python -m benchmarks.fake_memcached --port 11211
+#     GAME_STORE=memcached GAME_STORE_ADDRESS=127.0.0.1:11211 python bot.py
+#
+# In-process, for tests: server = serve_in_background(); port = server.server_address[1]
+import argparse
+import socketserver
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# memcached treats expiry times above 30 days as Unix timestamps
+_RELATIVE_EXPIRY_LIMIT = 60 * 60 * 24 * 30
+
+
+class MemcachedData:
+    """The key-value data: key -> (value, flags, cas token, expiry time or 0)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items: Dict[bytes, Tuple[bytes, int, int, float]] = {}
+        self.cas_counter = 0
+
+    @staticmethod
+    def expiry(exptime: int) -> float:
+        if exptime == 0:
+            return 0.0
+        if exptime > _RELATIVE_EXPIRY_LIMIT:
+            return float(exptime)
+        return time.time() + exptime
+
+    def lookup(self, key: bytes) -> Optional[Tuple[bytes, int, int, float]]:
+        """The live item for a key (expired items are dropped). Call with the lock held."""
+        item = self.items.get(key)
+        if item is not None and item[3] and item[3] <= time.time():
+            del self.items[key]
+            return None
+        return item
+
+    def store(self, command: bytes, key: bytes, flags: int, exptime: int, value: bytes,
+              token: Optional[int] = None) -> bytes:
+        with self.lock:
+            item = self.lookup(key)
+            if command == b'add' and item is not None:
+                return b'NOT_STORED'
+            if command == b'replace' and item is None:
+                return b'NOT_STORED'
+            if command == b'cas':
+                if item is None:
+                    return b'NOT_FOUND'
+                if item[2] != token:
+                    return b'EXISTS'
+            self.cas_counter += 1
+            self.items[key] = (value, flags, self.cas_counter, self.expiry(exptime))
+            return b'STORED'
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    data: MemcachedData = None
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.rstrip(b'\r\n').split()
+            if not parts:
+                self.wfile.write(b'ERROR\r\n')
+                continue
+            command, args = parts[0].lower(), parts[1:]
+            try:
+                if command == b'quit':
+                    return
+                reply = self.dispatch(command, args)
+            except (ValueError, IndexError):
+                reply = b'CLIENT_ERROR bad command line format\r\n'
+            self.wfile.write(reply)
+
+    def dispatch(self, command: bytes, args) -> bytes:
+        data = self.data
+        if command in (b'get', b'gets'):
+            out = []
+            with data.lock:
+                for key in args:
+                    item = data.lookup(key)
+                    if item is None:
+                        continue
+                    value, flags, token, _ = item
+                    header = b'VALUE %s %d %d' % (key, flags, len(value))
+                    if command == b'gets':
+                        header += b' %d' % token
+                    out.append(header + b'\r\n' + value + b'\r\n')
+            out.append(b'END\r\n')
+            return b''.join(out)
+
+        if command in (b'set', b'add', b'replace', b'cas'):
+            key, flags, exptime, length = args[0], int(args[1]), int(args[2]), int(args[3])
+            token = int(args[4]) if command == b'cas' else None
+            noreply = args[-1] == b'noreply'
+            value = self.rfile.read(length + 2)[:-2]
+            reply = data.store(command, key, flags, exptime, value, token)
+            return b'' if noreply else reply + b'\r\n'
+
+        if command == b'delete':
+            with data.lock:
+                found = data.lookup(args[0]) is not None
+                if found:
+                    del data.items[args[0]]
+            return b'DELETED\r\n' if found else b'NOT_FOUND\r\n'
+
+        if command == b'touch':
+            with data.lock:
+                item = data.lookup(args[0])
+                if item is None:
+                    return b'NOT_FOUND\r\n'
+                data.items[args[0]] = item[:3] + (data.expiry(int(args[1])),)
+            return b'TOUCHED\r\n'
+
+        if command == b'flush_all':
+            with data.lock:
+                data.items.clear()
+            return b'OK\r\n'
+
+        if command == b'version':
+            return b'VERSION 1.6.0-fake\r\n'
+
+        return b'ERROR\r\n'
+
+
+class MemcachedServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int]):
+        self.data = MemcachedData()
+        handler = type('Handler', (MemcachedHandler,), {'data': self.data})
+        super().__init__(address, handler)
+
+
+def serve_in_background(host: str = '127.0.0.1', port: int = 0) -> MemcachedServer:
+    """Start a server on a daemon thread (port 0 picks a free port). Stop it with shutdown()."""
+    server = MemcachedServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Fake memcached server for the shared game store")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11211)
+    args = parser.parse_args(argv)
+
+    server = MemcachedServer((args.host, args.port))
+    print(f"Fake memcached listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
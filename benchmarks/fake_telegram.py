@@ -0,0 +1,179 @@
+# Lightweight stand-ins for the Telegram objects the handlers in bot.py touch.
+# They implement only the attributes and coroutines the handlers use, which keeps
+# building thousands of synthetic updates cheap and avoids any network access.
+import asyncio
+import itertools
+import random
+import time
+from typing import Dict, List, Optional
+
+from telegram.error import NetworkError
+
+
+class FakeUser:
+    __slots__ = ('id', 'username', 'first_name')
+
+    def __init__(self, user_id: int, username: Optional[str] = None, first_name: str = "Player"):
+        self.id = user_id
+        self.username = username
+        self.first_name = first_name
+
+
+class FakeChat:
+    __slots__ = ('id', 'type')
+
+    def __init__(self, chat_id: int, chat_type: str = "private"):
+        self.id = chat_id
+        self.type = chat_type
+
+
+class FakeMessage:
+    """A message; reply_text() goes through the fake bot like the real one."""
+
+    def __init__(self, bot: 'FakeBot', message_id: int, chat: FakeChat, from_user: FakeUser,
+                 text: str = "", reply_to_message: Optional['FakeMessage'] = None):
+        self._bot = bot
+        self.message_id = message_id
+        self.chat = chat
+        self.chat_id = chat.id
+        self.from_user = from_user
+        self.text = text
+        self.reply_to_message = reply_to_message
+
+    async def reply_text(self, text: str, **kwargs) -> 'FakeMessage':
+        return await self._bot.send_message(chat_id=self.chat.id, text=text, **kwargs)
+
+
+class FakeCallbackQuery:
+    """A button press on a message sent by the bot."""
+
+    def __init__(self, bot: 'FakeBot', query_id: str, data: str, from_user: FakeUser, message: FakeMessage):
+        self._bot = bot
+        self.id = query_id
+        self.data = data
+        self.from_user = from_user
+        self.message = message
+
+    async def answer(self, text: Optional[str] = None, **kwargs) -> bool:
+        return await self._bot.answer_callback_query(self.id, text=text, **kwargs)
+
+    async def edit_message_text(self, text: str, **kwargs) -> FakeMessage:
+        return await self._bot.edit_message_text(
+            text=text, chat_id=self.message.chat.id, message_id=self.message.message_id, **kwargs
+        )
+
+
+class FakeUpdate:
+    def __init__(self, update_id: int, user: FakeUser, chat: FakeChat,
+                 message: Optional[FakeMessage] = None,
+                 callback_query: Optional[FakeCallbackQuery] = None):
+        self.update_id = update_id
+        self.effective_user = user
+        self.effective_chat = chat
+        self.message = message
+        self.callback_query = callback_query
+
+
+class FakeContext:
+    """The parts of CallbackContext the handlers use."""
+
+    def __init__(self, bot: 'FakeBot', args: Optional[List[str]] = None):
+        self.bot = bot
+        self.args = args or []
+
+
+class FakeBot:
+    """
+    Records every Bot API call instead of sending it.
+
+    Each call waits latency seconds (plus up to jitter seconds of random extra) to
+    model the network round trip, and fails with a NetworkError with probability
+    error_rate, so handler error paths get exercised too.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: Optional[int] = None, record: bool = True):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.record = record
+        self.calls: List[Dict] = []
+        self.call_counts: Dict[str, int] = {}
+        self.error_counts: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+
+    async def _call(self, method: str, **params) -> None:
+        self.call_counts[method] = self.call_counts.get(method, 0) + 1
+        if self.record:
+            self.calls.append({'method': method, 'time': time.perf_counter(), **params})
+        delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.error_counts[method] = self.error_counts.get(method, 0) + 1
+            raise NetworkError(f"Injected failure in {method}")
+
+    def _message(self, chat_id: int, text: str) -> FakeMessage:
+        chat = FakeChat(chat_id, "private" if chat_id > 0 else "supergroup")
+        return FakeMessage(self, next(self._message_ids), chat, FakeUser(0, "RPLSLBot"), text)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        await self._call('sendMessage', chat_id=chat_id, text=text)
+        return self._message(chat_id, text)
+
+    async def edit_message_text(self, text: str, chat_id: Optional[int] = None,
+                                message_id: Optional[int] = None, **kwargs) -> FakeMessage:
+        await self._call('editMessageText', chat_id=chat_id, message_id=message_id, text=text)
+        message = self._message(chat_id, text)
+        message.message_id = message_id
+        return message
+
+    async def answer_callback_query(self, callback_query_id: str, text: Optional[str] = None, **kwargs) -> bool:
+        await self._call('answerCallbackQuery', callback_query_id=callback_query_id)
+        return True
+
+    async def get_chat_member_count(self, chat_id: int) -> int:
+        await self._call('getChatMemberCount', chat_id=chat_id)
+        return 50
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.call_counts.clear()
+        self.error_counts.clear()
+
+
+class UpdateFactory:
+    """Builds synthetic command and callback updates with unique IDs."""
+
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self._query_ids = itertools.count(1)
+
+    def user(self, user_id: int) -> FakeUser:
+        return FakeUser(user_id, username=f"player{user_id}", first_name=f"Player {user_id}")
+
+    def command(self, user: FakeUser, chat: FakeChat, text: str,
+                reply_to: Optional[FakeMessage] = None) -> FakeUpdate:
+        """An update for a command message such as '/join'."""
+        message = FakeMessage(self.bot, next(self._message_ids), chat, user, text, reply_to)
+        return FakeUpdate(next(self._update_ids), user, chat, message=message)
+
+    def callback(self, user: FakeUser, chat: FakeChat, data: str) -> FakeUpdate:
+        """An update for a press of an inline button carrying callback data."""
+        message = FakeMessage(self.bot, next(self._message_ids), chat, FakeUser(0, "RPLSLBot"))
+        query = FakeCallbackQuery(self.bot, str(next(self._query_ids)), data, user, message)
+        return FakeUpdate(next(self._update_ids), user, chat, callback_query=query)
+
+    def tap_again(self, update: FakeUpdate) -> FakeUpdate:
+        """Another press of the same button on the same message (a new query and update)."""
+        pressed = update.callback_query
+        query = FakeCallbackQuery(self.bot, str(next(self._query_ids)), pressed.data, pressed.from_user,
+                                  pressed.message)
+        return FakeUpdate(next(self._update_ids), update.effective_user, update.effective_chat,
+                          callback_query=query)
+
+    def context(self, args: Optional[List[str]] = None) -> FakeContext:
+        return FakeContext(self.bot, args)
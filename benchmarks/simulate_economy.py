@@ -0,0 +1,204 @@
+# Monte Carlo simulation of the coin economy.
+#
+# Simulates a population of players who join multiplayer games, bet and play
+# random moves, with the bot's own rules: the starting balance and payouts from
+# settlement.py (resolved in bulk by batch.resolve_rounds, which is checked
+# against settlement.settle before the run), bets capped at the balance like
+# betting_callback does, and balances floored at 0 like update_user_currency.
+# The population is split over a process pool; players are matched with others
+# in their own slice. Reports money supply, inflation, Gini coefficient and the
+# balance distribution over time. Needs NumPy. Run from the repository root:
+#
+#     python -m benchmarks.simulate_economy --players 1000000 --steps 200 --workers 8
+#     python -m benchmarks.simulate_economy --win-reward 5 --win-reward-no-bet 2
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import batch
+from settlement import STARTING_BALANCE, WIN_REWARD, WIN_REWARD_NO_BET, settle
+from strategy import MOVES
+
+# Bets offered by the bet prompt (queue_bet_prompt) and how often players pick them
+DEFAULT_BETS = "0:0.25,10:0.4,25:0.2,50:0.15"
+
+# Balance ranges shown in the final distribution
+_BUCKETS = (0, 1, 10, 50, 100, 200, 500, 1000, 5000, 10000)
+
+
+def parse_bets(spec: str) -> Tuple[np.ndarray, np.ndarray]:
+    """'0:0.25,10:0.4' -> (bet amounts, probabilities)"""
+    amounts, weights = [], []
+    for part in spec.split(','):
+        amount, weight = part.split(':')
+        amounts.append(int(amount))
+        weights.append(float(weight))
+    weights = np.asarray(weights)
+    return np.asarray(amounts, dtype=np.int64), weights / weights.sum()
+
+
+def check_payouts(rounds: int = 2000, seed: int = 0) -> None:
+    """Make sure the batch resolver still pays out exactly like settlement.settle."""
+    rng = np.random.default_rng(seed)
+    seats = 6
+    moves = rng.integers(0, 4, size=(rounds, seats), dtype=np.uint8)
+    bets = rng.choice(np.array([0, 10, 25, 50]), size=(rounds, seats))
+    _, changes = batch.resolve_rounds(moves, bets)
+    for i in range(rounds):
+        players = {seat: {'name': '', 'bet': int(bets[i, seat]),
+                          'choice': MOVES[moves[i, seat]] if moves[i, seat] != batch.NO_MOVE else None}
+                   for seat in range(seats)}
+        for outcome in settle(players).outcomes:
+            if changes[i, outcome.user_id] != outcome.currency_change:
+                raise AssertionError(f"batch.resolve_rounds disagrees with settle() on {players}")
+
+
+def simulate_slice(players: int, steps: int, report_every: int, activity: float, min_seats: int,
+                   max_seats: int, bet_amounts: np.ndarray, bet_weights: np.ndarray, starting_balance: int,
+                   win_reward: int, win_reward_no_bet: int, seed) -> Dict:
+    """
+    Simulate one slice of the population (runs in a worker process).
+
+    Returns:
+        dict: Balances at every report step, and how many games were played
+    """
+    rng = np.random.default_rng(seed)
+    balances = np.full(players, starting_balance, dtype=np.int64)
+    snapshots = [balances.copy()]
+    games = 0
+    seat_index = np.arange(max_seats)
+
+    for step in range(1, steps + 1):
+        # Split this step's active players into games of min_seats to max_seats players
+        active = rng.permutation(players)[:int(players * activity)]
+        sizes = rng.integers(min_seats, max_seats + 1, size=len(active) // min_seats + 1)
+        ends = np.cumsum(sizes)
+        sizes = sizes[ends <= len(active)]
+        if len(sizes):
+            starts = ends[:len(sizes)] - sizes
+            seated = seat_index[None, :] < sizes[:, None]
+            who = np.where(seated, active[np.minimum(starts[:, None] + seat_index, len(active) - 1)], 0)
+
+            moves = rng.integers(0, 3, size=seated.shape, dtype=np.uint8)
+            moves[~seated] = batch.NO_MOVE
+            # Players can't bet more than they have (the bot offers their whole balance instead)
+            wanted = rng.choice(bet_amounts, size=seated.shape, p=bet_weights)
+            bets = np.where(seated, np.minimum(wanted, balances[who]), 0)
+
+            _, changes = batch.resolve_rounds(moves, bets, win_reward, win_reward_no_bet)
+            # Everyone plays at most one game per step, so the updates don't collide
+            players_seated = who[seated]
+            balances[players_seated] = np.maximum(0, balances[players_seated] + changes[seated])
+            games += len(sizes)
+
+        if step % report_every == 0 or step == steps:
+            snapshots.append(balances.copy())
+    return {'snapshots': snapshots, 'games': games}
+
+
+def gini(sorted_balances: np.ndarray) -> float:
+    """Gini coefficient of balances sorted in ascending order (0 = equal, 1 = one player has it all)."""
+    n = len(sorted_balances)
+    total = sorted_balances.sum()
+    if n == 0 or total == 0:
+        return 0.0
+    ranks = np.arange(1, n + 1, dtype=np.float64)
+    return float(2 * (ranks * sorted_balances).sum() / (n * total) - (n + 1) / n)
+
+
+def summarize(balances: np.ndarray) -> Dict[str, float]:
+    ordered = np.sort(balances)
+    return {
+        'supply': int(ordered.sum()),
+        'mean': float(ordered.mean()),
+        'p10': int(np.percentile(ordered, 10)),
+        'median': int(np.median(ordered)),
+        'p90': int(np.percentile(ordered, 90)),
+        'p99': int(np.percentile(ordered, 99)),
+        'max': int(ordered[-1]),
+        'broke': float((ordered == 0).mean()),
+        'gini': gini(ordered),
+    }
+
+
+def distribution(balances: np.ndarray) -> List[Tuple[str, float]]:
+    edges = list(_BUCKETS) + [np.iinfo(np.int64).max]
+    rows = []
+    for low, high in zip(edges, edges[1:]):
+        label = f"{low}" if high == low + 1 else (f"{low}-{high - 1}" if high != edges[-1] else f"{low}+")
+        rows.append((label, float(((balances >= low) & (balances < high)).mean())))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of the coin economy")
+    parser.add_argument("--players", type=int, default=1_000_000)
+    parser.add_argument("--steps", type=int, default=100, help="Rounds of play; active players play one game each")
+    parser.add_argument("--activity", type=float, default=0.5, help="Share of players who play in each step")
+    parser.add_argument("--min-seats", type=int, default=2)
+    parser.add_argument("--max-seats", type=int, default=8)
+    parser.add_argument("--bets", default=DEFAULT_BETS, help="Bet amounts and how often they're picked")
+    parser.add_argument("--starting-balance", type=int, default=STARTING_BALANCE)
+    parser.add_argument("--win-reward", type=int, default=WIN_REWARD)
+    parser.add_argument("--win-reward-no-bet", type=int, default=WIN_REWARD_NO_BET)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--report-every", type=int, default=10, help="Steps between reported rows")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    check_payouts(seed=args.seed)
+    bet_amounts, bet_weights = parse_bets(args.bets)
+    workers = max(1, min(args.workers, args.players // max(args.max_seats, 1) or 1))
+    slices = [args.players // workers + (1 if i < args.players % workers else 0) for i in range(workers)]
+    seeds = np.random.SeedSequence(args.seed).spawn(workers)
+
+    started = time.perf_counter()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        futures = [pool.submit(simulate_slice, size, args.steps, args.report_every, args.activity,
+                               args.min_seats, args.max_seats, bet_amounts, bet_weights,
+                               args.starting_balance, args.win_reward, args.win_reward_no_bet, seed)
+                   for size, seed in zip(slices, seeds)]
+        parts = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    games = sum(part['games'] for part in parts)
+    report_steps = [0] + [step for step in range(1, args.steps + 1)
+                          if step % args.report_every == 0 or step == args.steps]
+    print(f"{args.players:,} players, {games:,} games in {args.steps} steps, {workers} workers, "
+          f"{elapsed:.1f}s ({games / elapsed:,.0f} games/s)")
+    print(f"Rewards: +{args.win_reward} on a winning bet, +{args.win_reward_no_bet} without a bet, "
+          f"starting balance {args.starting_balance}")
+
+    header = (f"{'step':>6}{'supply':>16}{'inflation/step':>16}{'mean':>10}{'p10':>8}{'median':>8}"
+              f"{'p90':>8}{'p99':>8}{'max':>10}{'broke':>8}{'gini':>7}")
+    print(header)
+    print('-' * len(header))
+    previous = None
+    final = None
+    for index, step in enumerate(report_steps):
+        balances = np.concatenate([part['snapshots'][index] for part in parts])
+        summary = summarize(balances)
+        if previous is None or step == 0:
+            inflation = ""
+        else:
+            growth = summary['supply'] / previous['supply'] if previous['supply'] else float('inf')
+            inflation = f"{growth ** (1 / (step - previous_step)) - 1:+.3%}"
+        print(f"{step:>6}{summary['supply']:>16,}{inflation:>16}{summary['mean']:>10.1f}{summary['p10']:>8}"
+              f"{summary['median']:>8}{summary['p90']:>8}{summary['p99']:>8}{summary['max']:>10,}"
+              f"{summary['broke']:>8.1%}{summary['gini']:>7.3f}")
+        previous, previous_step, final = summary, step, balances
+
+    print()
+    print("Final balance distribution:")
+    for label, share in distribution(final):
+        print(f"  {label:>12} {share:>7.2%} {'#' * int(round(share * 50))}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
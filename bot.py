@@ -1,19 +1,36 @@
 import os
+import signal
+import asyncio
 import logging
 from typing import Dict, Set, Optional, List, Tuple
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler, 
+    Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, 
     ContextTypes, ConversationHandler, filters
 )
 
 from game import play_game, get_result_message
 from stats import (
-    get_user_stats, update_user_stats, find_user_by_username, 
-    get_all_players, user_stats, get_user_history, get_user_currency,
-    update_user_currency
+    get_user_stats, update_user_stats, find_users_by_username, 
+    get_all_players, get_user_history, get_user_currency,
+    get_leaderboard, get_user_ranks,
+    update_user_currency, currency_change_applied, init_persistence, sync_persistence, close_persistence,
+    apply_remote_events, store_sizes, result_totals
 )
 from game_manager import get_game_manager
+from settlement import settle
+from ledger import settlement_key
+from chat_locks import ChatSerializedUpdateProcessor
+from outbound import (
+    OutboundScheduler, get_outbound_scheduler,
+    PRIORITY_PROMPT, PRIORITY_STATUS
+)
+from status_updater import StatusUpdater, get_status_updater
+from callback_dedup import get_callback_deduplicator
+from strategy import get_strategy
+from metrics import metrics, time_calls, export_path, write_snapshot, METRICS_INTERVAL
+from profiler import profiler, PROFILE_ENABLED
 from responses import (
     START_MESSAGE, HELP_MESSAGE, 
     play_message, stats_message, format_game_history, currency_message,
@@ -25,12 +42,21 @@ from responses import (
     not_creator_message, successfully_left_message,
     not_in_game_message, game_already_started_message,
     choose_move_message, betting_message, player_not_found_message, 
-    multiple_matches_message
+    multiple_matches_message, leaderboard_message, rank_message
 )
 
 # Get token from environment variable
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
 
+# Telegram user IDs allowed to use admin commands such as /profile (comma-separated)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.environ.get("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# Updates processed at once; updates for the same chat or user still run one at a time
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "256"))
+
+# Bot API server to talk to (e.g. the local stand-in in benchmarks/fake_bot_api.py)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
 # Bot Configuration
 # Note: When creating the bot in BotFather, set the following:
 # - Bot name: RockPaperScissors Bot
@@ -53,6 +79,95 @@ def is_group_chat(update: Update) -> bool:
     """Check if the message is from a group chat."""
     return update.effective_chat.type in ["group", "supergroup"]
 
+def get_outbound(context: ContextTypes.DEFAULT_TYPE) -> OutboundScheduler:
+    """Get the scheduler that paces this bot's outgoing messages."""
+    return get_outbound_scheduler(context.bot)
+
+def get_status_updates(context: ContextTypes.DEFAULT_TYPE) -> StatusUpdater:
+    """Get the updater that coalesces this bot's group status messages."""
+    return get_status_updater(get_outbound(context))
+
+def queue_query_edit(context: ContextTypes.DEFAULT_TYPE, query, text: str, **kwargs) -> None:
+    """Queue an edit of the private message whose button was pressed."""
+    get_outbound(context).edit_message_text(
+        chat_id=query.message.chat_id,
+        message_id=query.message.message_id,
+        text=text,
+        priority=PRIORITY_PROMPT,
+        **kwargs
+    )
+
+def remember_message(chat_id: int, game, attribute: str):
+    """An on_sent callback that stores the sent message's ID on the chat's game."""
+    async def on_sent(message):
+        # Also on our copy, for status updates still queued if the game has ended by now
+        setattr(game, attribute, message.message_id)
+        await game_manager.set_message_id(chat_id, attribute, message.message_id)
+    return on_sent
+
+def queue_game_status(context: ContextTypes.DEFAULT_TYPE, chat_id: int, game) -> None:
+    """Queue an update of the game's status message in the group, coalesced with other recent changes."""
+    outbound = get_outbound(context)
+    
+    async def update_status(bot):
+        # Rendered when it's sent, so it shows everything that happened while it was queued
+        current = await game_manager.get_game(chat_id) or game
+        text = multiplayer_game_status(current)
+        if current.group_message_id:
+            try:
+                # Skipped for free if the status hasn't changed since the last update
+                return await outbound.edit_text_now(
+                    bot,
+                    chat_id,
+                    current.group_message_id,
+                    text,
+                    parse_mode="HTML"
+                )
+            except RetryAfter:
+                raise
+            except Exception as e:
+                logger.error(f"Error updating game status: {e}")
+        # If there's no status message yet or editing fails, send a new message
+        status_msg = await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+        outbound.remember_text(chat_id, status_msg.message_id, text)
+        game.group_message_id = status_msg.message_id
+        await game_manager.set_message_id(chat_id, 'group_message_id', status_msg.message_id)
+        return status_msg
+    
+    get_status_updates(context).request(chat_id, update_status)
+
+def queue_bet_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id: int, player_id: int,
+                     player_name: str, text: str) -> None:
+    """Queue the bet selection keyboard for a player, warning the group if it can't be delivered."""
+    bet_keyboard = [
+        [
+            InlineKeyboardButton("10 coins", callback_data=f"bet_10_{chat_id}"),
+            InlineKeyboardButton("25 coins", callback_data=f"bet_25_{chat_id}"),
+            InlineKeyboardButton("50 coins", callback_data=f"bet_50_{chat_id}"),
+        ],
+        [
+            InlineKeyboardButton("💰 Skip Betting (0 coins)", callback_data=f"bet_0_{chat_id}"),
+        ]
+    ]
+    
+    def warn_group(error):
+        logger.error(f"Error sending bet message to player {player_id}: {error}")
+        # Let the group know that a player might not have received their choice buttons
+        get_outbound(context).send_message(
+            chat_id=chat_id,
+            text=f"⚠️ <b>WARNING:</b> Could not send bet message to {player_name}. They may need to start the bot in private chat first.",
+            parse_mode="HTML"
+        )
+    
+    get_outbound(context).send_message(
+        chat_id=player_id,
+        text=text,
+        priority=PRIORITY_PROMPT,
+        reply_markup=InlineKeyboardMarkup(bet_keyboard),
+        parse_mode="HTML",
+        on_error=warn_group
+    )
+
 async def get_chat_member_count(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> int:
     """Get the number of members in a chat."""
     try:
@@ -80,9 +195,9 @@ async def play_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if the user is already in ANY game (not just this chat)
-    if game_manager.is_user_in_game(user_id):
+    if await game_manager.is_user_in_game(user_id):
         # Find which game they're already in
-        other_chat_id = game_manager.get_user_current_game(user_id)
+        other_chat_id = await game_manager.get_user_current_game(user_id)
         await update.message.reply_text(
             player_already_in_game_message(
                 is_group=is_group_chat(update), 
@@ -114,7 +229,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     
     # Play the game and get result
-    result, bot_choice = play_game(user_choice)
+    result, bot_choice = play_game(user_choice, user_id)
     
     # Update user stats with game history
     update_user_stats(
@@ -294,20 +409,11 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             username = username[:-12].strip()
             mode = 'multiplayer'
         
-        # Find the user ID from username
-        found_user_id, found_username = find_user_by_username(username)
+        # Find every user matching the username in a single indexed lookup
+        matches = find_users_by_username(username)
         
-        if found_user_id:
-            # Check if the username has "(multiple matches found)" suffix
-            if "multiple matches found" in found_username:
-                # There are multiple matches, find them all
-                matches = []
-                search_term = username.lower()
-                for uid, stats in user_stats.items():
-                    stored_username = stats.get('username', '').lower()
-                    if search_term in stored_username:
-                        matches.append((uid, stats['username']))
-                
+        if matches:
+            if len(matches) > 1:
                 # Show the list of matching users
                 await update.message.reply_text(
                     multiple_matches_message(matches),
@@ -315,6 +421,8 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             
+            found_user_id = matches[0][0]
+            
             # Show stats for the found user
             stats = get_user_stats(found_user_id, mode)
             await update.message.reply_text(
@@ -335,6 +443,64 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="HTML"
         )
 
+# Accepted /leaderboard arguments for each leaderboard metric
+LEADERBOARD_ALIASES = {
+    'wins': 'wins',
+    'victories': 'wins',
+    'winrate': 'win_percentage',
+    'rate': 'win_percentage',
+    'streak': 'best_streak',
+    'streaks': 'best_streak',
+    'coins': 'coins',
+    'wealth': 'coins',
+}
+
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the top players when the command /leaderboard is issued."""
+    metric = 'wins'
+    if context.args:
+        metric = LEADERBOARD_ALIASES.get(context.args[0].lower(), 'wins')
+    
+    await update.message.reply_text(
+        leaderboard_message(metric, get_leaderboard(metric, limit=10)),
+        parse_mode="HTML"
+    )
+
+async def rank_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show a user's rank on every leaderboard when the command /rank is issued."""
+    user_id = update.effective_user.id
+    username = update.effective_user.username or update.effective_user.first_name
+    
+    await update.message.reply_text(
+        rank_message(username, get_user_ranks(user_id)),
+        parse_mode="HTML"
+    )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Switch the profiler when an admin issues /profile on [sample rate], /profile off or /profile."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    
+    action = context.args[0].lower() if context.args else 'status'
+    if action == 'on':
+        try:
+            sample_rate = float(context.args[1]) if len(context.args) > 1 else None
+        except ValueError:
+            await update.message.reply_text("Usage: /profile on [sample rate between 0 and 1]")
+            return
+        path = profiler.enable(sample_rate)
+        text = f"Profiling {profiler.sample_rate:.1%} of updates into {path}"
+    elif action == 'off':
+        path = profiler.disable()
+        text = f"Profiling stopped; trace in {path}" if path else "Profiling is off"
+    else:
+        state = profiler.stats()
+        text = (f"Profiling {state['sample_rate']:.1%} of updates into {state['path']}" if state['enabled']
+                else "Profiling is off")
+        text += f" ({state['sampled']} updates sampled so far)"
+    
+    await update.message.reply_text(text)
+
 # Cancel command removed as it's not needed - users must play the game if started.
 
 # Multiplayer game commands
@@ -346,25 +512,28 @@ async def multiplayer_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Check if this is a group chat
     if not is_group_chat(update):
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             "⚠️ <b>SOLO WARRIOR!</b> Multiplayer battles can only be arranged in group chats! Invite your friends to a group and challenge them there!",
             parse_mode="HTML"
         )
         return ConversationHandler.END
     
     # Check if there's already a game in this chat
-    if game_manager.get_game(chat_id):
-        await update.message.reply_text(
+    if await game_manager.get_game(chat_id):
+        get_outbound(context).reply_to(
+            update.message,
             game_already_exists_message(),
             parse_mode="HTML"
         )
         return ConversationHandler.END
         
     # Check if the user is already in ANY game
-    if game_manager.is_user_in_game(user_id):
+    if await game_manager.is_user_in_game(user_id):
         # Find which game they're already in
-        other_chat_id = game_manager.get_user_current_game(user_id)
-        await update.message.reply_text(
+        other_chat_id = await game_manager.get_user_current_game(user_id)
+        get_outbound(context).reply_to(
+            update.message,
             player_already_in_game_message(
                 is_group=is_group_chat(update),
                 other_chat_id=other_chat_id
@@ -374,29 +543,25 @@ async def multiplayer_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
     
     # Create a new multiplayer game
-    game = game_manager.create_game(chat_id, user_id, username)
+    game = await game_manager.create_game(chat_id, user_id, username)
     
-    # Send the game creation message
-    message = await update.message.reply_text(
+    # Send the game creation message, storing its ID for updates once it's sent
+    get_outbound(context).reply_to(
+        update.message,
         create_multiplayer_game_message(username),
-        parse_mode="HTML"
+        parse_mode="HTML",
+        on_sent=remember_message(chat_id, game, 'message_id')
     )
     
-    # Store the message ID for updates
-    if game is not None and message is not None:
-        game.message_id = message.message_id
-    
-    # Send game status
-    status_msg = await context.bot.send_message(
+    # Send game status, storing the status message ID for updates
+    get_outbound(context).send_message(
         chat_id=chat_id,
         text=multiplayer_game_status(game),
-        parse_mode="HTML"
+        priority=PRIORITY_STATUS,
+        parse_mode="HTML",
+        on_sent=remember_message(chat_id, game, 'group_message_id')
     )
     
-    # Store the status message ID for updates
-    if game is not None and status_msg is not None:
-        game.group_message_id = status_msg.message_id
-    
     return ConversationHandler.END
 
 async def join_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -406,9 +571,10 @@ async def join_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     
     # Check if there's a game in this chat
-    game = game_manager.get_game(chat_id)
+    game = await game_manager.get_game(chat_id)
     if not game:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             no_game_in_chat_message(),
             parse_mode="HTML"
         )
@@ -416,35 +582,39 @@ async def join_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check if the game has already started
     if game.started:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             game_already_started_message(),
             parse_mode="HTML"
         )
         return ConversationHandler.END
     
     # If the user is already in this game, just confirm it
-    if game_manager.is_user_in_game(user_id, chat_id):
-        await update.message.reply_text(
+    if await game_manager.is_user_in_game(user_id, chat_id):
+        get_outbound(context).reply_to(
+            update.message,
             f"✓ <b>ALREADY ENLISTED!</b> You're already part of this epic battle, {username}!",
             parse_mode="HTML"
         )
         return ConversationHandler.END
         
     # If the user is in other games, they'll be automatically removed due to the one-game-per-user rule
-    if game_manager.is_user_in_game(user_id):
+    if await game_manager.is_user_in_game(user_id):
         # Find which game they're already in
-        other_chat_id = game_manager.get_user_current_game(user_id)
-        await update.message.reply_text(
+        other_chat_id = await game_manager.get_user_current_game(user_id)
+        get_outbound(context).reply_to(
+            update.message,
             f"⚠️ <b>ATTENTION WARRIOR!</b> You were in another battle in chat {other_chat_id}, but have been withdrawn from it to join this epic contest!",
             parse_mode="HTML"
         )
     
     # Join the game
-    success, game = game_manager.join_game(chat_id, user_id, username)
+    success, game = await game_manager.join_game(chat_id, user_id, username)
     
     if success and game:
         # Send confirmation message
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             f"🎭 <b>JOINED THE BATTLE!</b> {username} has entered the arena! Prepare for glory!",
             parse_mode="HTML"
         )
@@ -452,84 +622,36 @@ async def join_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Auto-start the game if we have at least 2 players
         if len(game.players) >= 2 and not game.started:
             # Start the game automatically
-            success, game = game_manager.start_game(chat_id)
+            success, game = await game_manager.start_game(chat_id)
             
             if success:
-                # Notify that the game has started
-                status_msg = await update.message.reply_text(
+                # Notify that the game has started and store the status message ID
+                get_outbound(context).reply_to(
+                    update.message,
                     game_started_message(),
-                    parse_mode="HTML"
+                    parse_mode="HTML",
+                    on_sent=remember_message(chat_id, game, 'group_message_id')
                 )
                 
-                # Store the status message ID
-                if game is not None and status_msg is not None:
-                    game.group_message_id = status_msg.message_id
-                
                 # Send individual messages to each player to make their choices
                 for player_id, player_data in game.players.items():
-                    # First send a bet selection keyboard
-                    bet_keyboard = [
-                        [
-                            InlineKeyboardButton("10 coins", callback_data=f"bet_10_{chat_id}"),
-                            InlineKeyboardButton("25 coins", callback_data=f"bet_25_{chat_id}"),
-                            InlineKeyboardButton("50 coins", callback_data=f"bet_50_{chat_id}"),
-                        ],
-                        [
-                            InlineKeyboardButton("💰 Skip Betting (0 coins)", callback_data=f"bet_0_{chat_id}"),
-                        ]
-                    ]
-                    bet_reply_markup = InlineKeyboardMarkup(bet_keyboard)
-                    
-                    try:
-                        # First ask for a bet
-                        await context.bot.send_message(
-                            chat_id=player_id,
-                            text="<b>💰 PLACE YOUR BET! 💰</b>\n\nHow many coins do you wish to wager on this epic battle?",
-                            reply_markup=bet_reply_markup,
-                            parse_mode="HTML"
-                        )
-                    except Exception as e:
-                        logger.error(f"Error sending bet message to player {player_id}: {e}")
-                        # Let the group know that a player might not have received their choice buttons
-                        await context.bot.send_message(
-                            chat_id=chat_id,
-                            text=f"⚠️ <b>WARNING:</b> Could not send bet message to {player_data['name']}. They may need to start the bot in private chat first.",
-                            parse_mode="HTML"
-                        )
+                    # First ask for a bet
+                    queue_bet_prompt(
+                        context, chat_id, player_id, player_data['name'],
+                        "<b>💰 PLACE YOUR BET! 💰</b>\n\nHow many coins do you wish to wager on this epic battle?"
+                    )
                 
                 # Send updated game status
-                await context.bot.send_message(
+                get_outbound(context).send_message(
                     chat_id=chat_id,
                     text=multiplayer_game_status(game),
+                    priority=PRIORITY_STATUS,
                     parse_mode="HTML"
                 )
             return ConversationHandler.END
                 
         # If the game didn't auto-start, just update status
-        try:
-            if game is not None and hasattr(game, 'group_message_id') and game.group_message_id:
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=game.group_message_id,
-                    text=multiplayer_game_status(game),
-                    parse_mode="HTML"
-                )
-            else:
-                status_msg = await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=multiplayer_game_status(game),
-                    parse_mode="HTML"
-                )
-                if game is not None and status_msg is not None:
-                    game.group_message_id = status_msg.message_id
-        except Exception as e:
-            logger.error(f"Error updating game status: {e}")
-            # If editing fails, send a new message
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=multiplayer_game_status(game),
-                parse_mode="HTML"
-            )
+        queue_game_status(context, chat_id, game)
     
     return ConversationHandler.END
 
@@ -539,9 +661,10 @@ async def start_game_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     # Check if there's a game in this chat
-    game = game_manager.get_game(chat_id)
+    game = await game_manager.get_game(chat_id)
     if not game:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             no_game_in_chat_message(),
             parse_mode="HTML"
         )
@@ -549,7 +672,8 @@ async def start_game_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Check if the user is the creator
     if game.creator_id != user_id:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             not_creator_message(),
             parse_mode="HTML"
         )
@@ -557,65 +681,41 @@ async def start_game_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Check if there are enough players
     if len(game.players) < 2:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             not_enough_players_message(),
             parse_mode="HTML"
         )
         return ConversationHandler.END
     
     # Start the game
-    success, _ = game_manager.start_game(chat_id)
+    success, _ = await game_manager.start_game(chat_id)
     
     if success:
-        # Notify that the game has started
-        status_msg = await update.message.reply_text(
+        # Notify that the game has started and store the status message ID
+        get_outbound(context).reply_to(
+            update.message,
             game_started_message(),
-            parse_mode="HTML"
+            parse_mode="HTML",
+            on_sent=remember_message(chat_id, game, 'group_message_id')
         )
         
-        # Store the status message ID
-        if game is not None and status_msg is not None:
-            game.group_message_id = status_msg.message_id
-        
         # Send individual messages to each player to make their bets first
         for player_id, player_data in game.players.items():
-            # First send a bet selection keyboard
-            bet_keyboard = [
-                [
-                    InlineKeyboardButton("10 coins", callback_data=f"bet_10_{chat_id}"),
-                    InlineKeyboardButton("25 coins", callback_data=f"bet_25_{chat_id}"),
-                    InlineKeyboardButton("50 coins", callback_data=f"bet_50_{chat_id}"),
-                ],
-                [
-                    InlineKeyboardButton("💰 Skip Betting (0 coins)", callback_data=f"bet_0_{chat_id}"),
-                ]
-            ]
-            bet_reply_markup = InlineKeyboardMarkup(bet_keyboard)
+            # Get the user's current balance
+            balance = get_user_currency(player_id)
             
-            try:
-                # Get the user's current balance
-                balance = get_user_currency(player_id)
-                
-                # First ask for a bet
-                await context.bot.send_message(
-                    chat_id=player_id,
-                    text=f"{betting_message()}\n\nYour current balance: <b>{balance} coins</b>\n\nHow many coins do you wish to wager on this epic battle?",
-                    reply_markup=bet_reply_markup,
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                logger.error(f"Error sending bet message to player {player_id}: {e}")
-                # Let the group know that a player might not have received their choice buttons
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ <b>WARNING:</b> Could not send bet message to {player_data['name']}. They may need to start the bot in private chat first.",
-                    parse_mode="HTML"
-                )
+            # First ask for a bet
+            queue_bet_prompt(
+                context, chat_id, player_id, player_data['name'],
+                f"{betting_message()}\n\nYour current balance: <b>{balance} coins</b>\n\nHow many coins do you wish to wager on this epic battle?"
+            )
         
         # Send updated game status
-        await context.bot.send_message(
+        get_outbound(context).send_message(
             chat_id=chat_id,
             text=multiplayer_game_status(game),
+            priority=PRIORITY_STATUS,
             parse_mode="HTML"
         )
     
@@ -627,17 +727,19 @@ async def leave_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if there's a game in this chat
-    game = game_manager.get_game(chat_id)
+    game = await game_manager.get_game(chat_id)
     if not game:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             no_game_in_chat_message(),
             parse_mode="HTML"
         )
         return ConversationHandler.END
     
     # Check if the user is in the game
-    if not game_manager.is_user_in_game(user_id, chat_id):
-        await update.message.reply_text(
+    if not await game_manager.is_user_in_game(user_id, chat_id):
+        get_outbound(context).reply_to(
+            update.message,
             not_in_game_message(),
             parse_mode="HTML"
         )
@@ -645,26 +747,29 @@ async def leave_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check if the game has already started
     if game.started:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             game_already_started_message(),
             parse_mode="HTML"
         )
         return ConversationHandler.END
     
     # Leave the game
-    success, updated_game = game_manager.leave_game(chat_id, user_id)
+    success, updated_game = await game_manager.leave_game(chat_id, user_id)
     
     if success:
-        await update.message.reply_text(
+        get_outbound(context).reply_to(
+            update.message,
             successfully_left_message(),
             parse_mode="HTML"
         )
         
         # If the game still exists (not all players left), send updated status
         if updated_game:
-            await context.bot.send_message(
+            get_outbound(context).send_message(
                 chat_id=chat_id,
                 text=multiplayer_game_status(updated_game),
+                priority=PRIORITY_STATUS,
                 parse_mode="HTML"
             )
     
@@ -700,20 +805,20 @@ async def betting_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(
+            queue_query_edit(context, query,
                 f"⚠️ <b>TREASURY SHORTAGE!</b> ⚠️\n\nYou only have {current_balance} coins in your treasury! Choose a smaller wager.",
                 reply_markup=reply_markup,
                 parse_mode="HTML"
             )
         else:
             # They have no currency, skip betting
-            await query.edit_message_text(
+            queue_query_edit(context, query,
                 "⚠️ <b>EMPTY COFFERS!</b> ⚠️\n\nYour treasury is empty! Play more games to earn coins for future bets.",
                 parse_mode="HTML"
             )
             
             # Automatically place a 0 bet
-            game_manager.make_bet(chat_id, user_id, 0)
+            await game_manager.make_bet(chat_id, user_id, 0)
             
             # Show them the RPS choices
             keyboard = [
@@ -726,26 +831,27 @@ async def betting_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             # Send a new message with the game choices
-            await context.bot.send_message(
+            get_outbound(context).send_message(
                 chat_id=user_id,
                 text=choose_move_message(),
+                priority=PRIORITY_PROMPT,
                 reply_markup=reply_markup,
                 parse_mode="HTML"
             )
         return
     
     # User has enough currency, record their bet
-    success, game = game_manager.make_bet(chat_id, user_id, bet_amount)
+    success, game = await game_manager.make_bet(chat_id, user_id, bet_amount)
     
     if success:
         # Confirm the bet
         if bet_amount > 0:
-            await query.edit_message_text(
+            queue_query_edit(context, query,
                 f"<b>💰 BET PLACED!</b>\n\nYou've wagered {bet_amount} coins on this battle!\n\n<i>Now make your choice...</i>",
                 parse_mode="HTML"
             )
         else:
-            await query.edit_message_text(
+            queue_query_edit(context, query,
                 "<b>NO BET PLACED</b>\n\nYou've chosen to skip betting for this battle.\n\n<i>Now make your choice...</i>",
                 parse_mode="HTML"
             )
@@ -761,21 +867,33 @@ async def betting_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         # Send a new message with the game choices
-        await context.bot.send_message(
+        get_outbound(context).send_message(
             chat_id=user_id,
             text=choose_move_message(),
+            priority=PRIORITY_PROMPT,
             reply_markup=reply_markup,
             parse_mode="HTML"
         )
     else:
         # Something went wrong with placing the bet
-        await query.edit_message_text(
+        queue_query_edit(context, query,
             "⚠️ <b>ERROR!</b> ⚠️\n\nThere was a problem placing your bet. The game may have ended or you're not a participant.",
             parse_mode="HTML"
         )
     
     return
 
+async def dedupe_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop repeated taps on a bet or move button before they reach the game handlers."""
+    query = update.callback_query
+    message_id = query.message.message_id if query.message else query.inline_message_id
+    if not get_callback_deduplicator().is_repeat(update.effective_user.id, query.data, message_id):
+        return
+    
+    # The first tap is already being handled; just stop the button's loading spinner
+    await query.answer()
+    raise ApplicationHandlerStop
+
 async def multiplayer_choice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle multiplayer game choices."""
     query = update.callback_query
@@ -792,26 +910,23 @@ async def multiplayer_choice_callback(update: Update, context: ContextTypes.DEFA
     username = update.effective_user.username or update.effective_user.first_name
     
     # Check if there's a game in this chat
-    game = game_manager.get_game(chat_id)
+    game = await game_manager.get_game(chat_id)
     if not game or not game.started:
-        await query.edit_message_text(
+        queue_query_edit(context, query,
             "⚠️ <b>GAME NOT FOUND!</b> This battle no longer exists or hasn't started yet!",
             parse_mode="HTML"
         )
         return
     
     # Check if the user is in the game - if not, try to join them (handle bot not started in private)
-    if not game_manager.is_user_in_game(user_id, chat_id):
+    if not await game_manager.is_user_in_game(user_id, chat_id):
         # Try to add user to player list (game already started)
         if user_id in game.players:
             # User exists but maybe wasn't properly tracked
-            if user_id not in game_manager.user_games:
-                game_manager.user_games[user_id] = set([chat_id])
-            else:
-                game_manager.user_games[user_id].add(chat_id)
+            await game_manager.track_player(user_id, chat_id)
         else:
             # User not in this game at all - they can't join now
-            await query.edit_message_text(
+            queue_query_edit(context, query,
                 "⚠️ <b>NOT IN BATTLE!</b> You are not part of this epic contest!",
                 parse_mode="HTML"
             )
@@ -821,134 +936,116 @@ async def multiplayer_choice_callback(update: Update, context: ContextTypes.DEFA
     # Timer check is now a no-op that always returns false due to our changes
     
     # Record the player's choice
-    success, game, all_chosen = game_manager.make_choice(chat_id, user_id, choice)
+    success, game, all_chosen = await game_manager.make_choice(chat_id, user_id, choice)
     
     if success:
         # Confirm the choice to the player
-        await query.edit_message_text(
+        queue_query_edit(context, query,
             f"<b>CHOICE LOCKED IN!</b> You selected <b>{choice.upper()}</b>!\n\nYour fate is now in the hands of the gods... 🔮",
             parse_mode="HTML"
         )
         
         # If all players have made their choices, calculate and announce results
         if all_chosen and game:
-            # Get the results
-            results = game.get_results()
+            # Resolve outcomes and payouts once, for both the message and the wallets
+            settlement = settle(game.players)
+            
+            # A redelivered last choice, or another process that got it too, may have settled this game already
+            first = settlement.outcomes[0]
+            if currency_change_applied(settlement_key(chat_id, game.creation_time, first.user_id)):
+                logger.info(f"Game in chat {chat_id} was already settled")
+                await game_manager.end_game(chat_id)
+                return
+            
+            # Show the final status before the results, without waiting for the window
+            get_status_updates(context).flush(chat_id)
             
             # Send the results to the group chat
-            await context.bot.send_message(
+            get_outbound(context).send_message(
                 chat_id=chat_id,
-                text=multiplayer_result_message(results, game),
+                text=multiplayer_result_message(settlement),
                 parse_mode="HTML"
             )
             
             # Update stats for all players
-            for player_id in game.players:
-                username = game.players[player_id]["name"]
-                result = "win" if player_id in results["winners"] else "lose"
-                if player_id in results["tied"]:
-                    result = "draw"
-                
-                # Get this player's choice and the choices of their opponents
-                player_choice = results["choices"][player_id]["choice"] if player_id in results["choices"] else None
-                
-                # Get opponent names and choices
-                opponents = []
-                opponent_choices = []
-                for opponent_id, choice_data in results["choices"].items():
-                    if opponent_id != player_id:
-                        opponents.append(choice_data["name"])
-                        opponent_choices.append(choice_data["choice"])
-                
-                # Format opponent info
-                opponent_name = ", ".join(opponents)
-                opponent_choice = ", ".join(opponent_choices)
-                
-                # Get the player's bet amount
-                bet_amount = game.players[player_id].get("bet", 0)
-                
-                # Calculate currency changes based on game result
-                currency_change = 0
-                if bet_amount > 0:
-                    if result == "win":
-                        # Winner gets their bet back plus a share of opponents' bets
-                        # Calculate total loser bets to share
-                        loser_bet_total = 0
-                        for loser_id in game.players:
-                            if loser_id not in results["winners"] and loser_id not in results["tied"]:
-                                loser_bet_total += game.players[loser_id].get("bet", 0)
-                        
-                        # Winner share is proportional to their bet compared to total winner bets
-                        winner_bet_total = 0
-                        for winner_id in results["winners"]:
-                            winner_bet_total += game.players[winner_id].get("bet", 0)
-                        
-                        if winner_bet_total > 0:
-                            winner_share = bet_amount / winner_bet_total
-                            currency_change = int(loser_bet_total * winner_share)
-                        
-                        # Add a base win reward
-                        currency_change += 10
-                        
-                    elif result == "lose":
-                        # Loser loses their bet
-                        currency_change = -bet_amount
-                    
-                    # Draw - no change to currency for bets
-                elif result == "win":
-                    # Even with no bet, winners get a small reward
-                    currency_change = 5
-                
-                # Update user's currency balance
-                if currency_change != 0:
-                    update_user_currency(player_id, currency_change)
+            for outcome in settlement.outcomes:
+                # Post everyone's payout to the ledger, even a zero one, so the key marks the game as settled
+                update_user_currency(outcome.user_id, outcome.currency_change,
+                                     key=settlement_key(chat_id, game.creation_time, outcome.user_id))
                 
                 # Update stats with game history and mode
                 update_user_stats(
-                    user_id=player_id, 
-                    username=username, 
-                    result=result, 
+                    user_id=outcome.user_id, 
+                    username=outcome.name, 
+                    result=outcome.result, 
                     mode='multiplayer',
-                    opponent=opponent_name,
-                    choice=player_choice,
-                    opponent_choice=opponent_choice,
-                    bet=bet_amount
+                    opponent=settlement.opponents_of(outcome),
+                    choice=outcome.choice,
+                    opponent_choice=settlement.opponent_choices_of(outcome),
+                    bet=outcome.bet,
+                    currency_change=outcome.currency_change
                 )
             
             # End the game
-            game_manager.end_game(chat_id)
+            await game_manager.end_game(chat_id)
         else:
             # Update the game status in the group by editing the status message
-            try:
-                if game is not None and hasattr(game, 'group_message_id') and game.group_message_id:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=game.group_message_id,
-                        text=multiplayer_game_status(game),
-                        parse_mode="HTML"
-                    )
-                else:
-                    # If no stored message ID, send a new message
-                    status_msg = await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=multiplayer_game_status(game),
-                        parse_mode="HTML"
-                    )
-                    if game is not None and status_msg is not None:
-                        game.group_message_id = status_msg.message_id
-            except Exception as e:
-                logger.error(f"Error updating game status: {e}")
-                # If editing fails, send a new message
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=multiplayer_game_status(game),
-                    parse_mode="HTML"
-                )
+            queue_game_status(context, chat_id, game)
     
     return
 
-def create_application():
-    """Create the application instance."""
+async def flush_outbound(application: Application) -> None:
+    """Send any messages still queued before the bot shuts down, then finish the trace file if profiling."""
+    outbound = get_outbound_scheduler(application.bot)
+    get_status_updater(outbound).flush_all()
+    await outbound.stop()
+    profiler.close()
+
+def instrument_handlers(handlers) -> None:
+    """Time every handler's callback for the metrics and the profiler, including those inside conversations."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+            continue
+        name = getattr(handler.callback, '__name__', type(handler).__name__)
+        callback = profiler.traced('handler', name)(handler.callback)
+        # Stopping the update on purpose isn't an error
+        handler.callback = time_calls(metrics, callback, 'rps_handler_seconds', name,
+                                      errors='rps_handler_errors_total', expected=(ApplicationHandlerStop,))
+
+def collect_metrics(application: Application):
+    """A collector setting the gauges that describe this process's games, queues and stores."""
+    def collect(metrics):
+        # Looked up when collecting, so that creating the application doesn't create the
+        # scheduler before the caller configures it (sharded workers lower its global rate)
+        outbound = get_outbound_scheduler(application.bot)
+        games = game_manager.stats()
+        metrics.set('rps_active_games', games['waiting'], ('waiting',))
+        metrics.set('rps_active_games', games['started'], ('started',))
+        metrics.set('rps_players_in_games', games['players'])
+        metrics.set('rps_outbound_queued', outbound.pending())
+        sizes = store_sizes()
+        sizes['sent_texts'] = outbound.stats()['remembered_texts']
+        sizes['status_chats'] = get_status_updater(outbound).stats()['chats']
+        sizes['button_presses'] = get_callback_deduplicator().stats()['remembered']
+        sizes['strategy_models'] = get_strategy().stats().get('users', 0)
+        for store, size in sizes.items():
+            metrics.set('rps_store_size', size, (store,))
+        for mode, totals in result_totals().items():
+            for result in ('wins', 'losses', 'draws'):
+                metrics.set('rps_player_results', totals[result], (mode, result))
+    return collect
+
+def create_application(backend=None):
+    """
+    Create the application instance.
+    
+    Args:
+        backend (StatsBackend, optional): Where to store stats (defaults to the STATS_BACKEND setting)
+    """
     if not TELEGRAM_TOKEN:
         logger.error("No Telegram token provided. Please set the TELEGRAM_TOKEN environment variable.")
         logger.info("To create a bot, use BotFather in Telegram and set:")
@@ -956,8 +1053,16 @@ def create_application():
         logger.info("- Bot username: @RPLSLBot")
         return None
     
+    # Restore saved stats and wallets before handling any updates
+    init_persistence(backend)
+    
     # Create application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    # Handle different chats in parallel, serializing each chat's (and user's) updates
+    builder = builder.concurrent_updates(ChatSerializedUpdateProcessor(UPDATE_CONCURRENCY))
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL.rstrip("/") + "/bot")
+    application = builder.post_stop(flush_outbound).build()
     
     # Add conversation handler for solo game
     solo_game_handler = ConversationHandler(
@@ -978,6 +1083,9 @@ def create_application():
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("history", history_command))
     application.add_handler(CommandHandler("wallet", wallet_command))
+    application.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    application.add_handler(CommandHandler("rank", rank_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(solo_game_handler)
     
     # Add multiplayer game command handlers
@@ -985,7 +1093,8 @@ def create_application():
     application.add_handler(CommandHandler("join", join_command))
     application.add_handler(CommandHandler("leave", leave_command))
     
-    # Add multiplayer game callback handlers
+    # Add multiplayer game callback handlers, behind a check that swallows repeated taps
+    application.add_handler(CallbackQueryHandler(dedupe_callback, pattern='^(mp|bet)_'), group=-1)
     application.add_handler(CallbackQueryHandler(multiplayer_choice_callback, pattern='^mp_'))
     application.add_handler(CallbackQueryHandler(betting_callback, pattern='^bet_'))
     
@@ -994,48 +1103,105 @@ def create_application():
         """Check for timed out games and notify users"""
         game_manager = get_game_manager()
         
-        # Before cleaning up, track games that will be removed due to timer expiration
-        timed_out_games = []
-        for chat_id, game in game_manager.games.items():
-            if game.is_timer_expired():
-                timed_out_games.append((chat_id, game.creator_name, game.group_message_id))
-                
-        # Clean up all expired games
-        expired_count = game_manager.clean_up_expired_games()
+        # End the games whose deadlines have passed (only those are looked at)
+        expired_games = await game_manager.pop_expired_games()
+        if not expired_games:
+            return
         
-        if expired_count > 0:
-            logger.info(f"Cleaned up {expired_count} expired or timed out games")
-            
-        # Send timeout notifications for each timed out game
+        logger.info(f"Cleaned up {len(expired_games)} expired or timed out games")
+        
+        # Send timeout notifications for games nobody joined in time
         from responses import game_timeout_message
-        for chat_id, creator_name, message_id in timed_out_games:
+        outbound = get_outbound(context)
+        status_updates = get_status_updates(context)
+        for chat_id, game, timed_out in expired_games:
+            # A status update still waiting would overwrite the notice
+            status_updates.discard(chat_id)
+            if not timed_out:
+                continue
+            # Try to edit the existing game message if available
+            if game.group_message_id:
+                outbound.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=game.group_message_id,
+                    text=game_timeout_message(game.creator_name),
+                    parse_mode="HTML"
+                )
+            else:
+                # Otherwise send a new message
+                outbound.send_message(
+                    chat_id=chat_id,
+                    text=game_timeout_message(game.creator_name),
+                    priority=PRIORITY_STATUS,
+                    parse_mode="HTML"
+                )
+    
+    # Expire games within about a second of their deadlines; each check only touches games that are due
+    job_queue = application.job_queue
+    job_queue.run_repeating(time_calls(metrics, check_game_timeouts, 'rps_job_seconds', 'check_game_timeouts'),
+                            interval=1, first=1)
+    
+    # Group-commit stats and wallet changes to storage every tick
+    async def sync_stats(context: ContextTypes.DEFAULT_TYPE):
+        """Make recent stats and wallet changes durable without blocking the event loop"""
+        pending = sync_persistence()
+        if pending is not None:
             try:
-                # Try to edit the existing game message if available
-                if message_id:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=game_timeout_message(creator_name),
-                        parse_mode="HTML"
-                    )
-                else:
-                    # Otherwise send a new message
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=game_timeout_message(creator_name),
-                        parse_mode="HTML"
-                    )
+                remote_events = await asyncio.wrap_future(pending)
             except Exception as e:
-                logger.error(f"Error sending timeout notification: {e}")
+                logger.error(f"Error persisting stats: {e}")
+                return
+            # With a shared store, apply the games recorded meanwhile (our own included) in log order
+            apply_remote_events(remote_events)
+    
+    job_queue.run_repeating(time_calls(metrics, sync_stats, 'rps_job_seconds', 'sync_stats'),
+                            interval=float(os.environ.get("STATS_COMMIT_INTERVAL", "0.5")), first=1)
+    
+    # Time the handlers and publish the metrics for the web server's /metrics endpoint
+    for handlers in application.handlers.values():
+        instrument_handlers(handlers)
+    if METRICS_INTERVAL > 0:
+        metrics.add_collector(collect_metrics(application))
+        metrics_file = export_path()
+        
+        async def export_metrics(context: ContextTypes.DEFAULT_TYPE):
+            """Write this process's metrics where the web server picks them up"""
+            snapshot = metrics.snapshot()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, write_snapshot, snapshot, metrics_file)
+            except OSError as e:
+                logger.error(f"Error exporting metrics: {e}")
+        
+        job_queue.run_repeating(export_metrics, interval=METRICS_INTERVAL, first=METRICS_INTERVAL)
     
-    # Clean up expired games every 30 seconds
-    job_queue = application.job_queue
-    job_queue.run_repeating(check_game_timeouts, interval=30, first=10)
+    # Profile sampled updates when asked to by /profile, SIGUSR2 or PROFILE_ENABLED
+    async def watch_profile_signal(context: ContextTypes.DEFAULT_TYPE):
+        """Let SIGUSR2 switch the profiler on and off"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, profiler.toggle)
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            # No SIGUSR2 on this platform, or the loop runs outside the main thread (webhook mode)
+            logger.info("Profiler can only be switched with /profile here")
+    
+    async def flush_profile(context: ContextTypes.DEFAULT_TYPE):
+        """Hand the spans recorded lately to the profiler's writer thread"""
+        profiler.flush()
+    
+    job_queue.run_once(watch_profile_signal, 0)
+    job_queue.run_repeating(flush_profile, interval=5, first=5)
+    if PROFILE_ENABLED:
+        profiler.enable()
     
     return application
 
 def start_bot():
     """Start the bot."""
+    # Spread chats over several worker processes if asked to
+    from sharding import BOT_SHARDS, run_sharded_bot
+    if BOT_SHARDS > 1:
+        run_sharded_bot(BOT_SHARDS)
+        return
+    
     # Create the application
     application = create_application()
     if not application:
@@ -1047,6 +1213,9 @@ def start_bot():
         application.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
         logger.error(f"Error starting bot: {e}")
+    finally:
+        # Snapshot the stats so the next start doesn't need to replay the log
+        close_persistence()
 
 async def start_bot_async():
     """Start the bot asynchronously."""
@@ -0,0 +1,66 @@
+import os
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+# Seconds during which another press of the same button on the same message is treated as a repeat
+CALLBACK_DEDUP_TTL = float(os.environ.get("CALLBACK_DEDUP_TTL", "3"))
+# Button presses remembered at most; the oldest are forgotten first
+CALLBACK_DEDUP_SIZE = int(os.environ.get("CALLBACK_DEDUP_SIZE", "10000"))
+
+
+class CallbackDeduplicator:
+    """
+    Recognizes repeated presses of the same inline button.
+
+    Users double- and triple-tap buttons, and every tap arrives as its own callback
+    query. A press is keyed on (user, callback data, message), and a press whose key
+    was seen less than `ttl` seconds ago is a repeat. Keys live in a dict kept in
+    least-recently-seen order, so both the lookup and the eviction of the oldest
+    key are O(1).
+    """
+
+    def __init__(self, ttl: float = CALLBACK_DEDUP_TTL, size: int = CALLBACK_DEDUP_SIZE):
+        self.ttl = ttl
+        self.size = size
+        # key -> when the press expires, soonest first
+        self._seen: Dict[Tuple[int, str, Hashable], float] = {}
+
+        self.checked = 0
+        self.repeats = 0
+
+    def is_repeat(self, user_id: int, data: Optional[str], message_id: Hashable,
+                  now: Optional[float] = None) -> bool:
+        """Record a button press. Returns True if the same press was seen within the TTL."""
+        if now is None:
+            now = time.monotonic()
+        self.checked += 1
+        key = (user_id, data or '', message_id)
+        seen = self._seen
+        expires = seen.pop(key, None)
+        if expires is not None and expires > now:
+            # A repeat doesn't extend the window, or a fast tapper would never get through again
+            seen[key] = expires
+            self.repeats += 1
+            return True
+        seen[key] = now + self.ttl
+        # Every key has the same TTL, so the oldest ones are the first to expire
+        while len(seen) > self.size:
+            del seen[next(iter(seen))]
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'checked': self.checked,
+            'repeats': self.repeats,
+            'remembered': len(self._seen),
+        }
+
+
+_deduplicator: Optional[CallbackDeduplicator] = None
+
+def get_callback_deduplicator() -> CallbackDeduplicator:
+    """Get the bot's callback deduplicator."""
+    global _deduplicator
+    if _deduplicator is None:
+        _deduplicator = CallbackDeduplicator()
+    return _deduplicator
@@ -0,0 +1,142 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import metrics
+from profiler import profiler
+
+# Callback data that refers to a game in a group: bet_{amount}_{chat_id} and mp_{choice}_{chat_id}
+_GAME_CALLBACK_PREFIXES = ('bet_', 'mp_')
+
+
+class _KeyLock:
+    __slots__ = ('lock', 'refs')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0  # Holders plus waiters; the entry is dropped when it reaches 0
+
+
+class KeyedLocks:
+    """
+    One asyncio lock per key, created on demand and dropped when nobody uses it.
+
+    hold() takes several keys at once, always in sorted order, so two tasks that
+    need overlapping sets of keys can't deadlock.
+    """
+
+    def __init__(self):
+        self._locks: Dict[int, _KeyLock] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def locked(self, key: int) -> bool:
+        entry = self._locks.get(key)
+        return entry is not None and entry.lock.locked()
+
+    @asynccontextmanager
+    async def hold(self, keys: Iterable[int]):
+        entries = []
+        for key in sorted(set(keys)):
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = _KeyLock()
+            entry.refs += 1
+            entries.append((key, entry))
+
+        acquired = 0
+        try:
+            for _, entry in entries:
+                await entry.lock.acquire()
+                acquired += 1
+            yield
+        finally:
+            for index, (key, entry) in enumerate(entries):
+                if index < acquired:
+                    entry.lock.release()
+                entry.refs -= 1
+                if entry.refs == 0:
+                    del self._locks[key]
+
+
+def game_chat_from_callback(data: Optional[str]) -> Optional[int]:
+    """The group chat ID a bet/move button refers to, or None for other callback data."""
+    if not data or not data.startswith(_GAME_CALLBACK_PREFIXES):
+        return None
+    try:
+        return int(data.rsplit('_', 1)[1])
+    except ValueError:
+        return None
+
+
+def update_lock_keys(update: object) -> Tuple[int, ...]:
+    """
+    Keys an update must hold while it's processed: its chat, its user and, for
+    bet/move buttons pressed in a private chat, the group the game is in.
+
+    Private chat IDs equal user IDs, so a user's private chat and the user share a key.
+    """
+    if not isinstance(update, Update):
+        return ()
+    keys = set()
+    if update.effective_chat is not None:
+        keys.add(update.effective_chat.id)
+    if update.effective_user is not None:
+        keys.add(update.effective_user.id)
+    if update.callback_query is not None:
+        game_chat = game_chat_from_callback(update.callback_query.data)
+        if game_chat is not None:
+            keys.add(game_chat)
+    return tuple(sorted(keys))
+
+
+def update_type(update: object) -> str:
+    """What kind of update this is, for the metrics."""
+    if not isinstance(update, Update):
+        return 'other'
+    if update.callback_query is not None:
+        return 'callback_query'
+    if update.message is not None:
+        return 'message'
+    return 'other'
+
+
+class ChatSerializedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates concurrently, except that updates sharing a chat or user
+    are handled one at a time.
+
+    Different chats progress in parallel while each game's join/bet/choice
+    sequence stays linearizable, because every update that touches a game holds
+    the lock of the game's group chat for its whole processing (handler lookup,
+    conversation state and the handler itself). Updates waiting for a lock occupy
+    one of the max_concurrent_updates slots, so keep that well above the number
+    of updates a single busy chat can have queued.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.locks = KeyedLocks()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        started = time.perf_counter()
+        kind = update_type(update)
+        try:
+            # A sampled update's trace is named after its update_id, so its spans share a row
+            with profiler.trace_update(update.update_id if isinstance(update, Update) else 0, kind):
+                async with self.locks.hold(update_lock_keys(update)):
+                    await coroutine
+        finally:
+            metrics.inc('rps_updates_total', (kind,))
+            metrics.observe('rps_update_seconds', time.perf_counter() - started)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
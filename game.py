@@ -1,17 +1,25 @@
 import random
 
-def play_game(user_choice):
+from strategy import MOVES, MOVE_CODES, get_strategy
+
+def play_game(user_choice, user_id=None):
     """
     Play a round of Rock Paper Scissors
     
     Args:
         user_choice (str): The user's choice ('rock', 'paper', or 'scissors')
+        user_id (int, optional): The player; the bot's strategy picks its move from their past moves
         
     Returns:
         tuple: (result, bot_choice) where result is 'win', 'lose', or 'draw'
     """
-    choices = ['rock', 'paper', 'scissors']
-    bot_choice = random.choice(choices)
+    if user_id is None or user_choice not in MOVE_CODES:
+        bot_choice = random.choice(MOVES)
+    else:
+        # The bot commits to its move before learning the player's
+        strategy = get_strategy()
+        bot_choice = MOVES[strategy.choose(user_id)]
+        strategy.observe(user_id, MOVE_CODES[user_choice])
     
     # Determine the result
     if user_choice == bot_choice:
@@ -1,13 +1,26 @@
+import heapq
 import logging
 import time
 import random
-from typing import Dict, List, Optional, Tuple, Set, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Set, Union
+
+from settlement import settle
+from profiler import profiler
+from game_store import (
+    GameStore, GameStoreError, MemoryGameStore, create_game_store, game_key, user_key
+)
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG,
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Games are removed this long after creation, whatever their state
+GAME_MAX_AGE_SECONDS = 300
+
+# How long the store keeps a game after its last change, in case no process is left to end it
+GAME_TTL_SECONDS = GAME_MAX_AGE_SECONDS + 60
+
+# Compare-and-set attempts before giving up on a contended game
+CAS_ATTEMPTS = 16
+
 class MultiplayerGame:
     """Represents a multiplayer game instance in a specific chat"""
     
@@ -24,6 +37,9 @@ class MultiplayerGame:
         self.betting_stage = False  # Whether we're currently in the betting stage
         self.timer_seconds = 180  # 3 minutes timeout if no one joins
         self.last_player_join_time = time.time()  # Track when the last player joined
+        self.expires_at = None  # Deadline the game manager has scheduled for this game
+        self.version = 0  # Bumped by every change to the players, bets, choices or stage
+        self._summary = None  # (version, players string, total bets) as last rendered
         
     def add_player(self, user_id: int, username: str) -> bool:
         """Add a player to the game. Returns True if player was added."""
@@ -34,6 +50,7 @@ class MultiplayerGame:
                 # Update username if provided and different
                 if username and self.players[user_id]["name"] != username:
                     self.players[user_id]["name"] = username
+                    self.version += 1
                 return True
             # We don't allow adding completely new players to started games
             return False
@@ -47,6 +64,7 @@ class MultiplayerGame:
             }
             # Update the last player join time when a new player joins
             self.last_player_join_time = time.time()
+            self.version += 1
             return True
         # Player already exists but we'll count it as success
         return True
@@ -55,6 +73,7 @@ class MultiplayerGame:
         """Remove a player from the game. Returns True if player was removed."""
         if user_id in self.players and not self.started:
             del self.players[user_id]
+            self.version += 1
             return True
         return False
             
@@ -63,6 +82,7 @@ class MultiplayerGame:
         if len(self.players) >= 2 and not self.started:
             self.started = True
             self.start_time = time.time()
+            self.version += 1
             return True
         return False
             
@@ -86,6 +106,7 @@ class MultiplayerGame:
             return False
             
         self.players[user_id]["bet"] = bet_amount
+        self.version += 1
         return True
     
     def make_choice(self, user_id: int, choice: str) -> bool:
@@ -94,61 +115,27 @@ class MultiplayerGame:
             return False
             
         self.players[user_id]["choice"] = choice
+        self.version += 1
         
         # Check if all players have made their choices
         return all(player["choice"] is not None for player in self.players.values())
             
     def get_results(self) -> Dict:
         """Calculate and return the results of the game."""
-        results = {
-            "players": len(self.players),
-            "choices": {},
-            "winners": [],
-            "losers": [],
-            "tied": []
-        }
-        
-        # Group players by their choices
-        choices = {"rock": [], "paper": [], "scissors": []}
-        for player_id, player_data in self.players.items():
-            player_choice = player_data["choice"]
-            if player_choice:
-                choices[player_choice].append(player_id)
-                results["choices"][player_id] = {
-                    "name": player_data["name"],
-                    "choice": player_choice
-                }
-        
-        # Check for a tie (everyone chooses the same)
-        if len([c for c in choices.values() if c]) == 1:
-            for choice_list in choices.values():
-                results["tied"].extend(choice_list)
-            return results
-        
-        # Rock beats scissors
-        if choices["rock"] and choices["scissors"]:
-            results["winners"].extend(choices["rock"])
-            results["losers"].extend(choices["scissors"])
-            
-        # Paper beats rock
-        if choices["paper"] and choices["rock"]:
-            results["winners"].extend(choices["paper"])
-            results["losers"].extend(choices["rock"])
-            
-        # Scissors beats paper
-        if choices["scissors"] and choices["paper"]:
-            results["winners"].extend(choices["scissors"])
-            results["losers"].extend(choices["paper"])
-            
-        # Anyone not in winners or losers is tied
-        all_players = set(self.players.keys())
-        decided_players = set(results["winners"] + results["losers"])
-        results["tied"] = list(all_players - decided_players)
-            
-        return results
+        return settle(self.players).as_results()
+
+    def summary(self) -> Tuple[str, int]:
+        """The players string and the total of all bets, rendered once per version."""
+        if self._summary is None or self._summary[0] != self.version:
+            self._summary = (self.version, self._render_players(),
+                             sum(player.get("bet", 0) for player in self.players.values()))
+        return self._summary[1], self._summary[2]
 
     def get_players_string(self) -> str:
         """Return a formatted string listing all players in the game."""
+        return self.summary()[0]
+
+    def _render_players(self) -> str:
         if not self.players:
             return "No players have joined yet!"
             
@@ -162,157 +149,254 @@ class MultiplayerGame:
             
         return "\n".join(player_list)
 
-    def is_expired(self, max_age_seconds: int = 300) -> bool:
+    def is_expired(self, max_age_seconds: int = GAME_MAX_AGE_SECONDS) -> bool:
         """Check if this game has expired (been inactive too long)"""
         return time.time() - self.creation_time > max_age_seconds
+    
+    def timer_deadline(self) -> Optional[float]:
+        """When the join timer runs out, or None if it isn't running (the game started or has other players)."""
+        if self.started or len(self.players) != 1:
+            return None
+        return self.last_player_join_time + self.timer_seconds
+    
+    def deadline(self, max_age_seconds: int = GAME_MAX_AGE_SECONDS) -> float:
+        """The earliest time this game expires or times out."""
+        expiry = self.creation_time + max_age_seconds
+        timer = self.timer_deadline()
+        return expiry if timer is None or timer > expiry else timer
 
 
 class GameManager:
-    """Manages all ongoing games across different chats"""
+    """
+    Manages all ongoing games across different chats
+
+    Games live in a GameStore (in this process by default, or in memcached so that
+    several bot processes can share them). Every change is a compare-and-set of the
+    game's key that is redone on the latest version if another process changed the
+    game in between. Games unpacked from a networked store are cached while their
+    CAS token stays the same.
+
+    Methods that touch the store are coroutines, so a networked store's round trips
+    don't hold up the event loop. With the in-memory store they never suspend.
+    """
     
-    def __init__(self):
-        # Maps chat_id -> game object 
+    def __init__(self, store: Optional[GameStore] = None):
+        self.store = store or MemoryGameStore()
+        # Maps chat_id -> game object, as last read from or written to the store
         self.games: Dict[int, MultiplayerGame] = {}
-        # Maps user_id -> set of chat_ids (to track which games a user is in)
-        self.user_games: Dict[int, Set[int]] = {}
+        # Maps chat_id -> CAS token of the cached game
+        self._tokens: Dict[int, Optional[int]] = {}
+        # Min-heap of (deadline, sequence, chat_id, game). An entry is stale once its game has
+        # ended or been given a new deadline; stale entries are skipped when they reach the top.
+        self._deadlines: List[Tuple[float, int, int, MultiplayerGame]] = []
+        self._sequence = 0
+        
+    @profiler.traced('store')
+    async def _fetch(self, chat_id: int) -> Optional[MultiplayerGame]:
+        """Read a game from the store, unpacking it only if it changed since we last saw it."""
+        data, token = await self.store.get(game_key(chat_id))
+        if data is None:
+            self._forget(chat_id)
+            return None
+        game = self.games.get(chat_id)
+        if game is None or token != self._tokens.get(chat_id):
+            game = self.store.unpack_game(data)
+            self._remember(game, token)
+        return game
         
-    def create_game(self, chat_id: int, user_id: int, username: str) -> Optional[MultiplayerGame]:
+    def _remember(self, game: MultiplayerGame, token: Optional[int]) -> None:
+        self.games[game.chat_id] = game
+        self._tokens[game.chat_id] = token
+        self._schedule_deadline(game)
+        
+    def _forget(self, chat_id: int) -> None:
+        self.games.pop(chat_id, None)
+        self._tokens.pop(chat_id, None)
+        
+    @profiler.traced('store')
+    async def _modify(self, chat_id: int,
+                      change: Callable[[MultiplayerGame], Any]) -> Tuple[Optional[MultiplayerGame], Any]:
+        """
+        Apply change(game) to a game and write it back atomically.
+        Returns (game, whatever change returned), or (None, None) if there's no game in the chat.
+        """
+        key = game_key(chat_id)
+        for _ in range(CAS_ATTEMPTS):
+            data, token = await self.store.get(key)
+            if data is None:
+                self._forget(chat_id)
+                return None, None
+            # A networked store hands out a private copy, so other updates never see an unsaved change
+            game = self.store.unpack_game(data)
+            result = change(game)
+            stored = await self.store.put(key, self.store.pack_game(game), token, ttl=GAME_TTL_SECONDS)
+            if stored is not None:
+                self._remember(game, stored)
+                return game, result
+            # Another process changed the game first: redo the change on theirs
+        raise GameStoreError(f"Gave up updating the game in chat {chat_id} after {CAS_ATTEMPTS} conflicts")
+        
+    @profiler.traced('store')
+    async def _update_user_games(self, user_ids: Iterable[int], change: Callable[[Set[int]], Any]) -> None:
+        """Apply change(chat_ids) to the set of games of each of the users, atomically per user."""
+        keys = [user_key(user_id) for user_id in user_ids]
+        for _ in range(CAS_ATTEMPTS):
+            if not keys:
+                return
+            # One round trip to read every user's set and one to write those that changed
+            items = []
+            for key, (data, token) in zip(keys, await self.store.get_many(keys)):
+                before = set(self.store.unpack_chat_ids(data))
+                chat_ids = set(before)
+                change(chat_ids)
+                if chat_ids != before:
+                    items.append((key, self.store.pack_chat_ids(chat_ids) if chat_ids else None,
+                                  token, GAME_TTL_SECONDS))
+            stored = await self.store.put_many(items)
+            # Redo the users whose sets another process changed in between
+            keys = [item[0] for item, token in zip(items, stored) if token is None]
+        raise GameStoreError(f"Gave up updating the games of {len(keys)} users after {CAS_ATTEMPTS} conflicts")
+        
+    async def get_user_games(self, user_id: int) -> Set[int]:
+        """The chat IDs of the games a user has joined (may include games that have since ended)."""
+        data, _ = await self.store.get(user_key(user_id))
+        return set(self.store.unpack_chat_ids(data))
+        
+    async def create_game(self, chat_id: int, user_id: int, username: str) -> Optional[MultiplayerGame]:
         """Create a new game in a chat. Returns the game object or None if creation fails."""
         # If there's already a game in this chat, return None
-        if chat_id in self.games:
+        data, token = await self.store.get(game_key(chat_id))
+        if data is not None:
             logger.warning(f"Game already exists in chat {chat_id}")
-            return self.games[chat_id]  # Return existing game instead of None
+            return await self._fetch(chat_id)  # Return existing game instead of None
             
         # End all other games this user might be in
-        self.remove_user_from_all_games(user_id)
+        await self.remove_user_from_all_games(user_id)
             
         game = MultiplayerGame(chat_id, user_id, username)
         game.add_player(user_id, username)  # Creator joins automatically
         
-        self.games[chat_id] = game
+        # A deleted game's key may linger as a tombstone, which is overwritten with its token
+        stored = await self.store.put(game_key(chat_id), self.store.pack_game(game), token, ttl=GAME_TTL_SECONDS)
+        if stored is None:
+            # Another process created a game in this chat first
+            logger.warning(f"Game already exists in chat {chat_id}")
+            return await self._fetch(chat_id)
+        self._remember(game, stored)
         
         # Track that this user is in this game
-        if user_id not in self.user_games:
-            self.user_games[user_id] = set()
-        self.user_games[user_id].add(chat_id)
+        await self.track_player(user_id, chat_id)
         
         return game
         
-    def remove_user_from_all_games(self, user_id: int) -> None:
+    async def remove_user_from_all_games(self, user_id: int) -> None:
         """Remove a user from all games they're currently in."""
-        if user_id not in self.user_games:
-            return
-            
-        # Copy the set to avoid modifying during iteration
-        chat_ids = list(self.user_games[user_id])
-        
-        for chat_id in chat_ids:
-            self.leave_game(chat_id, user_id)
+        for chat_id in await self.get_user_games(user_id):
+            await self.leave_game(chat_id, user_id)
         
-    def join_game(self, chat_id: int, user_id: int, username: str) -> Tuple[bool, Optional[MultiplayerGame]]:
+    async def join_game(self, chat_id: int, user_id: int, username: str) -> Tuple[bool, Optional[MultiplayerGame]]:
         """Join an existing game. Returns (success, game)."""
-        if chat_id not in self.games:
+        if await self._fetch(chat_id) is None:
             return False, None
         
         # First remove user from any other games they might be in
-        self.remove_user_from_all_games(user_id)
+        await self.remove_user_from_all_games(user_id)
             
-        game = self.games[chat_id]
-        success = game.add_player(user_id, username)
+        game, success = await self._modify(chat_id, lambda game: game.add_player(user_id, username))
+        if game is None:
+            return False, None
         
         if success:
             # Track that this user is in this game
-            if user_id not in self.user_games:
-                self.user_games[user_id] = set()
-            self.user_games[user_id].add(chat_id)
+            await self.track_player(user_id, chat_id)
             
         return success, game
         
-    def leave_game(self, chat_id: int, user_id: int) -> Tuple[bool, Optional[MultiplayerGame]]:
+    async def leave_game(self, chat_id: int, user_id: int) -> Tuple[bool, Optional[MultiplayerGame]]:
         """Leave a game. Returns (success, updated_game)."""
-        if chat_id not in self.games:
+        game, success = await self._modify(chat_id, lambda game: game.remove_player(user_id))
+        if game is None:
             return False, None
-            
-        game = self.games[chat_id]
-        success = game.remove_player(user_id)
         
         if success:
+            # Remove this chat from user's games
+            await self._update_user_games((user_id,), lambda chat_ids: chat_ids.discard(chat_id))
+            
             # If this was the last player, remove the game
             if not game.players:
-                self.end_game(chat_id)
+                await self.end_game(chat_id)
                 return success, None
-                
-            # Remove this chat from user's games
-            if user_id in self.user_games:
-                self.user_games[user_id].discard(chat_id)
-                # Clean up if user has no more games
-                if not self.user_games[user_id]:
-                    del self.user_games[user_id]
                     
         return success, game
         
-    def start_game(self, chat_id: int) -> Tuple[bool, Optional[MultiplayerGame]]:
+    async def start_game(self, chat_id: int) -> Tuple[bool, Optional[MultiplayerGame]]:
         """Start a game in a specific chat. Returns (success, game)."""
-        if chat_id not in self.games:
+        game, success = await self._modify(chat_id, lambda game: game.start_game())
+        if game is None:
             return False, None
-            
-        game = self.games[chat_id]
-        success = game.start_game()
         return success, game
         
-    def make_bet(self, chat_id: int, user_id: int, bet_amount: int) -> Tuple[bool, Optional[MultiplayerGame]]:
+    async def make_bet(self, chat_id: int, user_id: int, bet_amount: int) -> Tuple[bool, Optional[MultiplayerGame]]:
         """
         Record a player's bet.
         Returns (success, game)
         """
-        if chat_id not in self.games:
+        game, success = await self._modify(chat_id, lambda game: game.make_bet(user_id, bet_amount))
+        if game is None:
             return False, None
-            
-        game = self.games[chat_id]
-        if user_id not in game.players:
-            return False, game
-            
-        success = game.make_bet(user_id, bet_amount)
         return success, game
         
-    def make_choice(self, chat_id: int, user_id: int, choice: str) -> Tuple[bool, Optional[MultiplayerGame], bool]:
+    async def make_choice(self, chat_id: int, user_id: int,
+                          choice: str) -> Tuple[bool, Optional[MultiplayerGame], bool]:
         """
         Record a player's choice. 
         Returns (success, game, all_chosen) where all_chosen indicates if all players have made choices.
         """
-        if chat_id not in self.games:
+        def choose(game):
+            if user_id not in game.players:
+                return None
+            return game.make_choice(user_id, choice)
+        
+        game, all_chosen = await self._modify(chat_id, choose)
+        if game is None:
             return False, None, False
-            
-        game = self.games[chat_id]
-        if user_id not in game.players:
+        if all_chosen is None:
             return False, game, False
-            
-        all_chosen = game.make_choice(user_id, choice)
         return True, game, all_chosen
         
-    def get_game(self, chat_id: int) -> Optional[MultiplayerGame]:
+    async def set_message_id(self, chat_id: int, attribute: str, message_id: int) -> None:
+        """Remember a sent message ('message_id' or 'group_message_id') on a game, if it's still running."""
+        await self._modify(chat_id, lambda game: setattr(game, attribute, message_id))
+        
+    async def track_player(self, user_id: int, chat_id: int) -> None:
+        """Record that a user is in the game in a chat."""
+        await self._update_user_games((user_id,), lambda chat_ids: chat_ids.add(chat_id))
+        
+    async def get_game(self, chat_id: int) -> Optional[MultiplayerGame]:
         """Get the game for a specific chat."""
-        return self.games.get(chat_id)
+        return await self._fetch(chat_id)
+        
+    async def _delete(self, chat_id: int, game: MultiplayerGame) -> None:
+        """Forget a game deleted from the store, and remove it from all its players' sets in one batch."""
+        self._forget(chat_id)
+        await self._update_user_games(game.players, lambda chat_ids: chat_ids.discard(chat_id))
         
-    def end_game(self, chat_id: int) -> bool:
+    @profiler.traced('store')
+    async def end_game(self, chat_id: int) -> bool:
         """End a game and clean up references. Returns success."""
-        if chat_id not in self.games:
-            return False
-            
-        # Remove all player references to this game
-        game = self.games[chat_id]
-        for user_id in game.players:
-            if user_id in self.user_games:
-                self.user_games[user_id].discard(chat_id)
-                # Clean up if user has no more games
-                if not self.user_games[user_id]:
-                    del self.user_games[user_id]
-                    
-        # Remove the game
-        del self.games[chat_id]
+        for _ in range(CAS_ATTEMPTS):
+            game = await self._fetch(chat_id)
+            if game is None:
+                return False
+            if await self.store.delete(game_key(chat_id), self._tokens[chat_id]):
+                break
+            self._forget(chat_id)
+        else:
+            raise GameStoreError(f"Gave up ending the game in chat {chat_id} after {CAS_ATTEMPTS} conflicts")
+        await self._delete(chat_id, game)
         return True
         
-    def is_user_in_game(self, user_id: int, chat_id: Optional[int] = None) -> bool:
+    async def is_user_in_game(self, user_id: int, chat_id: Optional[int] = None) -> bool:
         """
         Check if a user is in a game.
         If chat_id is None, checks if user is in any game.
@@ -320,42 +404,86 @@ class GameManager:
         """
         if chat_id is None:
             # Check if user is in any game
-            return user_id in self.user_games and bool(self.user_games[user_id])
+            return await self.get_user_current_game(user_id) is not None
         else:
             # Check if user is in a specific game
-            return (user_id in self.user_games and 
-                    chat_id in self.user_games[user_id] and
-                    chat_id in self.games and 
-                    user_id in self.games[chat_id].players)
+            if chat_id not in await self.get_user_games(user_id):
+                return False
+            game = await self._fetch(chat_id)
+            return game is not None and user_id in game.players
             
-    def get_user_current_game(self, user_id: int) -> Optional[int]:
+    async def get_user_current_game(self, user_id: int) -> Optional[int]:
         """
         Returns the chat_id of a game the user is currently in, or None if they're not in any game.
         """
-        if user_id in self.user_games and bool(self.user_games[user_id]):
-            # Return the first chat_id in the user's games
-            for chat_id in self.user_games[user_id]:
+        for chat_id in await self.get_user_games(user_id):
+            # The user's list and the games are separate keys, so check the game still has them
+            game = await self._fetch(chat_id)
+            if game is not None and user_id in game.players:
                 return chat_id
         return None
                 
-    def clean_up_expired_games(self, max_age_seconds: int = 300) -> int:
-        """Remove expired games. Returns the number of games removed."""
-        expired_chats = []
-        timed_out_chats = []
+    def _schedule_deadline(self, game: MultiplayerGame) -> None:
+        """(Re)schedule a game's expiry after anything that can change its deadline."""
+        deadline = game.deadline()
+        if deadline == game.expires_at:
+            return
+        game.expires_at = deadline
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (deadline, self._sequence, game.chat_id, game))
         
-        for chat_id, game in self.games.items():
-            # Check for overall game expiration (inactive for too long)
-            if game.is_expired(max_age_seconds):
-                expired_chats.append(chat_id)
-            # Check for game timeout (no one joined for timer_seconds)
-            elif game.is_timer_expired():
-                timed_out_chats.append(chat_id)
+        # Joins and starts leave stale entries behind; rebuild once they dominate the heap
+        if len(self._deadlines) > 4 * len(self.games) + 64:
+            self._deadlines = [entry for entry in self._deadlines
+                               if self.games.get(entry[2]) is entry[3] and entry[0] == entry[3].expires_at]
+            heapq.heapify(self._deadlines)
+    
+    def next_deadline(self) -> Optional[float]:
+        """When the next game expires or times out, or None if there are no games."""
+        while self._deadlines:
+            deadline, _, chat_id, game = self._deadlines[0]
+            if self.games.get(chat_id) is game and deadline == game.expires_at:
+                return deadline
+            heapq.heappop(self._deadlines)
+        return None
+    
+    async def pop_expired_games(self, now: Optional[float] = None) -> List[Tuple[int, MultiplayerGame, bool]]:
+        """
+        End every game whose deadline has passed, in deadline order.
+        Returns (chat_id, game, timed_out) for each, where timed_out means nobody joined in time
+        (as opposed to the game reaching its maximum age). Costs O(expired log n).
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        while self._deadlines and self._deadlines[0][0] < now:
+            deadline, _, chat_id, game = heapq.heappop(self._deadlines)
+            if self.games.get(chat_id) is not game or deadline != game.expires_at:
+                continue  # Stale: the game ended or its deadline moved
+            # Only end the version that expired; if another process changed or ended the game,
+            # its new version (if any) has just been scheduled
+            if await self._fetch(chat_id) is not game:
+                continue
+            if not await self.store.delete(game_key(chat_id), self._tokens[chat_id]):
+                self._forget(chat_id)
+                continue
+            await self._delete(chat_id, game)
+            timer = game.timer_deadline()
+            expired.append((chat_id, game, timer is not None and timer <= deadline))
+        return expired
                 
-        # End all expired or timed out games
-        for chat_id in expired_chats + timed_out_chats:
-            self.end_game(chat_id)
-            
-        return len(expired_chats) + len(timed_out_chats)
+    def stats(self) -> Dict[str, int]:
+        """Games this process knows of, by stage, and the players seated in them."""
+        started = sum(1 for game in self.games.values() if game.started)
+        return {
+            'waiting': len(self.games) - started,
+            'started': started,
+            'players': sum(len(game.players) for game in self.games.values()),
+        }
+                
+    async def clean_up_expired_games(self) -> int:
+        """Remove expired games. Returns the number of games removed."""
+        return len(await self.pop_expired_games())
 
 
 # Singleton instance of the game manager
@@ -365,5 +493,5 @@ def get_game_manager() -> GameManager:
     """Get the global game manager instance."""
     global _game_manager
     if _game_manager is None:
-        _game_manager = GameManager()
+        _game_manager = GameManager(create_game_store())
     return _game_manager
\ No newline at end of file
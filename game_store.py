@@ -0,0 +1,395 @@
+import os
+import socket
+import struct
+import asyncio
+import logging
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Prefix for every key, so several bots can share one memcached
+KEY_PREFIX = os.environ.get("GAME_STORE_PREFIX", "rps:")
+
+# Connections (and threads making requests) to a networked game store
+GAME_STORE_CONNECTIONS = int(os.environ.get("GAME_STORE_CONNECTIONS", "4"))
+
+# Deleted games leave an empty value behind for this long, so a delete can be compare-and-set too
+TOMBSTONE_TTL = 60
+
+# Fixed part of an encoded game: chat_id, creator_id, creation_time, start_time,
+# last_player_join_time, message_id, group_message_id, timer_seconds, version, flags, player count
+_GAME = struct.Struct('<qqdddqqiIBH')
+# Fixed part of an encoded player: user_id, bet, choice
+_PLAYER = struct.Struct('<qiB')
+_STR_LEN = struct.Struct('<H')
+
+_STARTED = 1
+_BETTING_STAGE = 2
+_HAS_START_TIME = 4
+
+CHOICES = (None, 'rock', 'paper', 'scissors')
+_CHOICE_CODES = {name: code for code, name in enumerate(CHOICES)}
+
+
+class GameStoreError(Exception):
+    """The game store couldn't be reached or gave an unexpected answer."""
+
+
+def game_key(chat_id: int) -> str:
+    return f"{KEY_PREFIX}game:{chat_id}"
+
+
+def user_key(user_id: int) -> str:
+    return f"{KEY_PREFIX}user:{user_id}"
+
+
+def _pack_str(value: str) -> bytes:
+    data = (value or '').encode('utf-8')[:0xFFFF]
+    return _STR_LEN.pack(len(data)) + data
+
+
+def _unpack_str(data: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _STR_LEN.unpack_from(data, offset)
+    offset += _STR_LEN.size
+    return data[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+
+def encode_game(game) -> bytes:
+    """Encode a MultiplayerGame compactly (about 20 bytes plus the name per player)."""
+    flags = ((_STARTED if game.started else 0) |
+             (_BETTING_STAGE if game.betting_stage else 0) |
+             (_HAS_START_TIME if game.start_time is not None else 0))
+    parts = [
+        _GAME.pack(game.chat_id, game.creator_id, game.creation_time, game.start_time or 0.0,
+                   game.last_player_join_time, game.message_id or 0, game.group_message_id or 0,
+                   game.timer_seconds, game.version & 0xFFFFFFFF, flags, len(game.players)),
+        _pack_str(game.creator_name),
+    ]
+    for user_id, player in game.players.items():
+        parts.append(_PLAYER.pack(user_id, player.get('bet', 0), _CHOICE_CODES[player.get('choice')]))
+        parts.append(_pack_str(player['name']))
+    return b''.join(parts)
+
+
+def decode_game(data: bytes):
+    """Decode a game encoded by encode_game() into a new MultiplayerGame."""
+    from game_manager import MultiplayerGame
+
+    (chat_id, creator_id, creation_time, start_time, last_join, message_id, group_message_id,
+     timer_seconds, version, flags, count) = _GAME.unpack_from(data, 0)
+    creator_name, offset = _unpack_str(data, _GAME.size)
+
+    game = MultiplayerGame.__new__(MultiplayerGame)
+    game.chat_id = chat_id
+    game.creator_id = creator_id
+    game.creator_name = creator_name
+    game.players = {}
+    game.started = bool(flags & _STARTED)
+    game.creation_time = creation_time
+    game.start_time = start_time if flags & _HAS_START_TIME else None
+    game.message_id = message_id or None
+    game.group_message_id = group_message_id or None
+    game.betting_stage = bool(flags & _BETTING_STAGE)
+    game.timer_seconds = timer_seconds
+    game.last_player_join_time = last_join
+    game.expires_at = None
+    game.version = version
+    game._summary = None
+    for _ in range(count):
+        user_id, bet, choice = _PLAYER.unpack_from(data, offset)
+        name, offset = _unpack_str(data, offset + _PLAYER.size)
+        game.players[user_id] = {"name": name, "choice": CHOICES[choice], "bet": bet}
+    return game
+
+
+def encode_chat_ids(chat_ids: Iterable[int]) -> bytes:
+    return array('q', chat_ids).tobytes()
+
+
+def decode_chat_ids(data: Optional[bytes]) -> Tuple[int, ...]:
+    if not data:
+        return ()
+    values = array('q')
+    values.frombytes(data)
+    return tuple(values)
+
+
+class GameStore:
+    """
+    Key-value store holding live games, shared by every process that serves the bot.
+
+    Values carry a CAS token; put() with the token from get() only succeeds if nobody
+    changed the key in between, which is how GameManager keeps read-modify-write
+    updates atomic across processes. An empty value is a deleted key.
+
+    Games and users' chat ID sets go through pack_*() before put() and unpack_*()
+    after get(). Stores shared over the network pack them into bytes, so unpacking
+    gives the caller a private copy to change; a store in this process may keep the
+    objects themselves.
+    """
+
+    name = 'store'
+
+    async def get(self, key: str) -> Tuple[Optional[Any], Optional[int]]:
+        """
+        Returns:
+            tuple: (value or None if missing or deleted, CAS token or None if the key doesn't exist)
+        """
+        raise NotImplementedError
+
+    async def put(self, key: str, value: Any, token: Optional[int] = None, ttl: int = 0) -> Optional[int]:
+        """
+        Store a value if the key still has the given token (or, with token None, doesn't exist yet).
+
+        Returns:
+            int: The new CAS token (0 if the store doesn't report it), or None if the key had changed
+        """
+        raise NotImplementedError
+
+    async def delete(self, key: str, token: int) -> bool:
+        """Delete a key if it still has the given token. Returns False if it had changed."""
+        return await self.put(key, b'', token, ttl=TOMBSTONE_TTL) is not None
+
+    async def get_many(self, keys: List[str]) -> List[Tuple[Optional[Any], Optional[int]]]:
+        """get() several keys at once. Returns their (value, token) pairs in the same order."""
+        return [await self.get(key) for key in keys]
+
+    async def put_many(self, items: List[Tuple[str, Optional[Any], Optional[int], int]]) -> List[Optional[int]]:
+        """
+        put() several (key, value, token, ttl) items at once; a value of None deletes the key instead.
+        Returns their new tokens (0 for a deletion) in the same order, with None for each key that had changed.
+        """
+        results = []
+        for key, value, token, ttl in items:
+            if value is None:
+                results.append(0 if token is not None and await self.delete(key, token) else None)
+            else:
+                results.append(await self.put(key, value, token, ttl))
+        return results
+
+    def pack_game(self, game) -> Any:
+        return encode_game(game)
+
+    def unpack_game(self, value: Any):
+        return decode_game(value)
+
+    def pack_chat_ids(self, chat_ids: Set[int]) -> Any:
+        return encode_chat_ids(chat_ids)
+
+    def unpack_chat_ids(self, value: Optional[Any]) -> Iterable[int]:
+        return decode_chat_ids(value)
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryGameStore(GameStore):
+    """
+    Keeps games in this process; the default, for a single bot process.
+
+    Games are kept as the live MultiplayerGame objects and only a version counter
+    changes on put(), so changing a game costs the same however many players it
+    has. None of the calls suspend, so nothing else runs between a get() and the
+    put() that follows it and the compare-and-set can't fail.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[Any, int]] = {}
+        self._version = 0
+
+    async def get(self, key):
+        entry = self._values.get(key)
+        if entry is None:
+            return None, None
+        # delete() removes keys outright, so there are no empty values here
+        return entry
+
+    async def put(self, key, value, token=None, ttl=0):
+        entry = self._values.get(key)
+        if (entry[1] if entry else None) != token:
+            return None
+        self._version += 1
+        self._values[key] = (value, self._version)
+        return self._version
+
+    async def delete(self, key, token):
+        entry = self._values.get(key)
+        if entry is None or entry[1] != token:
+            return False
+        del self._values[key]
+        return True
+
+    def pack_game(self, game):
+        return game
+
+    def unpack_game(self, value):
+        return value
+
+    def pack_chat_ids(self, chat_ids):
+        return frozenset(chat_ids)
+
+    def unpack_chat_ids(self, value):
+        return value or ()
+
+
+class _Connection:
+    __slots__ = ('sock', 'reader')
+
+    def __init__(self, address: Tuple[str, int], timeout: float):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def readline(self) -> bytes:
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ValueError("connection closed")
+        line = line[:-2]
+        if line.startswith((b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR')):
+            raise ValueError(line.decode('utf-8', 'replace'))
+        return line
+
+    def read(self, length: int) -> bytes:
+        return self.reader.read(length)
+
+    def close(self) -> None:
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class MemcachedGameStore(GameStore):
+    """
+    Games in memcached (or anything speaking its text protocol), shared by several processes.
+
+    Requests run on a small thread pool, each thread with its own connection, so
+    a slow or unreachable server holds up the game it's asked about but never the
+    event loop. get_many() and put_many() send all their requests in one write and
+    cost a single round trip. Games are stored with a TTL, so lobbies left behind
+    by a crashed process disappear on their own.
+    """
+
+    name = 'memcached'
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 11211, timeout: float = 1.0,
+                 connections: int = GAME_STORE_CONNECTIONS):
+        self.address = (host, port)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="game-store")
+        self._lock = threading.Lock()
+        self._idle: List[_Connection] = []
+
+    async def _run(self, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _call(self, request: bytes, handler: Callable[[_Connection], Any]):
+        """Send requests and parse their responses with handler(connection), reconnecting on errors."""
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        try:
+            if connection is None:
+                connection = _Connection(self.address, self.timeout)
+            connection.sock.sendall(request)
+            result = handler(connection)
+        except (OSError, ValueError) as e:
+            # The connection is in an unknown state; the next call opens a new one
+            if connection is not None:
+                connection.close()
+            raise GameStoreError(f"memcached at {self.address[0]}:{self.address[1]}: {e}") from e
+        with self._lock:
+            self._idle.append(connection)
+        return result
+
+    @staticmethod
+    def _parse_values(connection: _Connection) -> Dict[bytes, Tuple[bytes, int]]:
+        values = {}
+        while True:
+            line = connection.readline()
+            if line == b'END':
+                return values
+            # VALUE <key> <flags> <bytes> <cas>
+            _, key, _, length, token = line.split()
+            values[key] = (connection.read(int(length) + 2)[:-2], int(token))
+
+    def _get_many(self, keys: List[str]) -> List[Tuple[Optional[bytes], Optional[int]]]:
+        encoded = [key.encode() for key in keys]
+        values = self._call(b'gets ' + b' '.join(encoded) + b'\r\n', self._parse_values)
+        results = []
+        for key in encoded:
+            value, token = values.get(key, (None, None))
+            results.append((value or None, token))
+        return results
+
+    def _put_many(self, items: List[Tuple[str, bytes, Optional[int], int]]) -> List[Optional[int]]:
+        requests = []
+        for key, value, token, ttl in items:
+            if value is None:
+                value, ttl = b'', TOMBSTONE_TTL
+            if token is None:
+                requests.append(b'add %s 0 %d %d\r\n' % (key.encode(), ttl, len(value)))
+            else:
+                requests.append(b'cas %s 0 %d %d %d\r\n' % (key.encode(), ttl, len(value), token))
+            requests.append(value + b'\r\n')
+
+        def parse(connection):
+            results = []
+            for _ in items:
+                reply = connection.readline()
+                if reply == b'STORED':
+                    results.append(0)
+                elif reply in (b'EXISTS', b'NOT_FOUND', b'NOT_STORED'):
+                    results.append(None)
+                else:
+                    raise ValueError(f"unexpected response {reply!r}")
+            return results
+        return self._call(b''.join(requests), parse)
+
+    async def get(self, key):
+        return (await self._run(self._get_many, [key]))[0]
+
+    async def put(self, key, value, token=None, ttl=0):
+        return (await self._run(self._put_many, [(key, value, token, ttl)]))[0]
+
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        return await self._run(self._get_many, keys)
+
+    async def put_many(self, items):
+        if not items:
+            return []
+        return await self._run(self._put_many, items)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle.clear()
+
+
+def create_game_store(name: Optional[str] = None) -> GameStore:
+    """
+    Create the game store selected by name or by the GAME_STORE environment variable
+
+    Args:
+        name (str, optional): 'memory' (default) or 'memcached' (address in GAME_STORE_ADDRESS)
+
+    Returns:
+        GameStore: The store instance
+    """
+    name = (name or os.environ.get("GAME_STORE", "memory")).lower()
+    if name == 'memcached':
+        host, _, port = os.environ.get("GAME_STORE_ADDRESS", "127.0.0.1:11211").rpartition(':')
+        return MemcachedGameStore(host or '127.0.0.1', int(port),
+                                  timeout=float(os.environ.get("GAME_STORE_TIMEOUT", "1.0")))
+    if name != 'memory':
+        logger.warning(f"Unknown game store '{name}', keeping games in memory")
+    return MemoryGameStore()
@@ -0,0 +1,326 @@
+import os
+from array import array
+from itertools import accumulate, chain, compress, repeat
+from typing import Dict, List, Optional
+
+from event_log import MODES, RESULTS, CHOICES
+
+# How many games are kept per user (at least one: a ring needs a slot to write to)
+HISTORY_DEPTH = max(1, int(os.environ.get("HISTORY_DEPTH", "10")))
+
+_MODE_CODES = {name: code for code, name in enumerate(MODES)}
+_RESULT_CODES = {name: code for code, name in enumerate(RESULTS)}
+_CHOICE_CODES = {name: code for code, name in enumerate(CHOICES)}
+
+# Positions in a compact record tuple
+_TIMESTAMP, _MODE, _RESULT, _CHOICE, _OPPONENT_CHOICE, _OPPONENT, _BET, _CURRENCY_CHANGE = range(8)
+
+# Record keys exposed by GameRecord, in the order the original dicts used
+RECORD_KEYS = ('timestamp', 'mode', 'result', 'choice', 'opponent_choice', 'opponent', 'bet', 'currency_change')
+
+# Typecodes of the record fields PackedHistory keeps in arrays; the others may hold
+# strings or None and are kept as lists
+_PACKED_TYPECODES = {_TIMESTAMP: 'q', _MODE: 'b', _RESULT: 'b', _BET: 'q'}
+
+
+def _encode_choice(choice):
+    # Single moves are stored as small ints, lists of opponents' moves as their string
+    return _CHOICE_CODES.get(choice, choice)
+
+
+def _decode_choice(value):
+    return CHOICES[value] if isinstance(value, int) else value
+
+
+def encode_record(game_data: Dict) -> tuple:
+    """
+    Pack a game record dict into a compact tuple
+
+    Args:
+        game_data (dict): Record with the keys built by update_user_stats
+
+    Returns:
+        tuple: (timestamp, mode, result, choice, opponent_choice, opponent, bet, currency_change)
+    """
+    return (
+        int(game_data.get('timestamp', 0)),
+        _MODE_CODES.get(game_data.get('mode'), 0),
+        _RESULT_CODES.get(game_data.get('result'), 2),
+        _encode_choice(game_data.get('choice')),
+        _encode_choice(game_data.get('opponent_choice')),
+        game_data.get('opponent'),
+        game_data.get('bet', 0),
+        game_data.get('currency_change'),
+    )
+
+
+class GameRecord:
+    """
+    Read-only dict-like view of a compact history record.
+
+    'bet' and 'currency_change' are only present when a bet was placed,
+    like in the original dict records.
+    """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data: tuple):
+        self._data = data
+
+    def __contains__(self, key) -> bool:
+        if key == 'bet':
+            return self._data[_BET] > 0
+        if key == 'currency_change':
+            return self._data[_CURRENCY_CHANGE] is not None
+        return key in RECORD_KEYS
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        data = self._data
+        if key == 'mode':
+            return MODES[data[_MODE]]
+        if key == 'result':
+            return RESULTS[data[_RESULT]]
+        if key == 'choice':
+            return _decode_choice(data[_CHOICE])
+        if key == 'opponent_choice':
+            return _decode_choice(data[_OPPONENT_CHOICE])
+        return data[RECORD_KEYS.index(key)]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [key for key in RECORD_KEYS if key in self]
+
+    def to_dict(self) -> Dict:
+        return {key: self[key] for key in self.keys()}
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+
+class HistoryRing:
+    """
+    Fixed-capacity ring buffer of a user's most recent games.
+
+    Adding a game is O(1) whatever the capacity: the buffer grows until it is
+    full, then each new record overwrites the oldest one in place.
+    """
+
+    __slots__ = ('capacity', '_items', '_next')
+
+    def __init__(self, capacity: int = HISTORY_DEPTH):
+        self.capacity = capacity
+        self._items: List[tuple] = []
+        self._next = 0  # Slot the next record goes into once the buffer is full
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def append(self, record: tuple) -> None:
+        if len(self._items) < self.capacity:
+            self._items.append(record)
+        else:
+            self._items[self._next] = record
+            self._next = (self._next + 1) % self.capacity
+
+    def newest(self, limit: Optional[int] = None) -> List[GameRecord]:
+        """The most recent records (up to limit), newest first."""
+        items = self._items
+        if not items:
+            return []
+        count = len(items) if limit is None else min(limit, len(items))
+        # The newest record sits just before the next slot to overwrite
+        last = (self._next - 1) % len(items) if len(items) == self.capacity else len(items) - 1
+        return [GameRecord(items[(last - i) % len(items)]) for i in range(count)]
+
+    def ordered(self) -> List[tuple]:
+        """The records, oldest first."""
+        items = self._items
+        if len(items) < self.capacity:
+            return items[:]
+        return items[self._next:] + items[:self._next]
+
+    def copy(self) -> 'HistoryRing':
+        ring = HistoryRing.__new__(HistoryRing)
+        ring.capacity = self.capacity
+        ring._items = self._items[:]
+        ring._next = self._next
+        return ring
+
+    @classmethod
+    def from_records(cls, records, capacity: int = HISTORY_DEPTH) -> 'HistoryRing':
+        """Build a ring from records ordered newest first (dicts or GameRecords)."""
+        ring = cls(capacity)
+        for record in reversed(list(records)[:capacity]):
+            ring.append(record._data if isinstance(record, GameRecord) else encode_record(record))
+        return ring
+
+
+class PackedHistory:
+    """
+    Every user's records in flat columns, the way snapshots store history.
+
+    A user's records are contiguous and oldest first; counts holds how many each
+    user has. Loading and saving the columns is a handful of C-speed array and
+    JSON calls, however many users there are, and a user's ring is only rebuilt
+    from them when it's needed.
+    """
+
+    __slots__ = ('user_ids', 'counts', 'fields', '_starts', '_index')
+
+    def __init__(self, user_ids: array, counts: array, fields: List):
+        self.user_ids = user_ids
+        self.counts = counts
+        self.fields = fields  # One column per record position
+        self._starts = array('q', [0, *accumulate(counts)])
+        self._index = dict(zip(user_ids, range(len(user_ids))))
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._index
+
+    def ring(self, user_id: int, capacity: int = HISTORY_DEPTH) -> Optional[HistoryRing]:
+        """A new ring holding the user's records, or None if they have none."""
+        i = self._index.get(user_id)
+        if i is None:
+            return None
+        start, end = self._starts[i], self._starts[i + 1]
+        ring = HistoryRing(capacity)
+        for record in list(zip(*[field[start:end] for field in self.fields]))[-capacity:]:
+            ring.append(record)
+        return ring
+
+    @classmethod
+    def pack(cls, rings: Dict[int, HistoryRing], base: Optional['PackedHistory'] = None) -> 'PackedHistory':
+        """Pack rings, plus the users in base that have no ring in rings."""
+        records = []
+        counts = array('I')
+        for ring in rings.values():
+            ordered = ring.ordered()
+            records.extend(ordered)
+            counts.append(len(ordered))
+        new_fields = list(zip(*records)) if records else [()] * len(RECORD_KEYS)
+
+        user_ids = array('q', rings.keys())
+        fields = [array(_PACKED_TYPECODES[i]) if i in _PACKED_TYPECODES else [] for i in range(len(RECORD_KEYS))]
+        if base is not None and len(base):
+            # Keep base's users that rings doesn't replace, dropping the others' records wholesale
+            replaced = rings.keys()
+            keep = [user_id not in replaced for user_id in base.user_ids]
+            mask = list(chain.from_iterable(map(repeat, keep, base.counts)))
+            user_ids = array('q', compress(base.user_ids, keep)) + user_ids
+            counts = array('I', compress(base.counts, keep)) + counts
+            for field, old in zip(fields, base.fields):
+                field.extend(compress(old, mask))
+        for field, new in zip(fields, new_fields):
+            field.extend(new)
+        return cls(user_ids, counts, fields)
+
+    def to_columns(self) -> Dict[str, object]:
+        """The columns, for event_log.encode_columns."""
+        columns: Dict[str, object] = {'user_ids': self.user_ids, 'counts': self.counts}
+        for key, field in zip(RECORD_KEYS, self.fields):
+            if isinstance(field, list):
+                # Moves are small ints unless some record holds a string; arrays load much faster than JSON
+                try:
+                    field = array('b', field)
+                except (TypeError, OverflowError):
+                    pass
+            columns[key] = field
+        return columns
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, object]) -> 'PackedHistory':
+        return cls(columns['user_ids'], columns['counts'], [columns[key] for key in RECORD_KEYS])
+
+
+class HistoryRings(dict):
+    """
+    Every user's HistoryRing by user_id, with cheap snapshots.
+
+    snapshot() copies just the mapping, at C speed, and leaves the rings shared
+    with the copy. From then on writable() copies a ring the first time it's
+    changed instead of changing it in place, so the snapshot keeps showing the
+    history as it was while another thread serializes it.
+
+    History loaded from a snapshot stays packed (see PackedHistory): reads decode
+    a user's ring on the fly, and a ring only joins the mapping once it changes.
+    Lookups and len() cover both; iterating covers only the unpacked rings, so use
+    pack() to get at everything.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Users whose rings were copied (or created) since the last snapshot; None before the first one
+        self._owned: Optional[set] = None
+        self._packed: Optional[PackedHistory] = None
+        self._still_packed = 0  # Users in _packed without a ring in the mapping
+
+    def __reduce__(self):
+        return HistoryRings, (dict(self),)
+
+    def __len__(self) -> int:
+        return super().__len__() + self._still_packed
+
+    def __contains__(self, user_id) -> bool:
+        return super().__contains__(user_id) or (self._packed is not None and user_id in self._packed)
+
+    def __missing__(self, user_id):
+        ring = self._packed.ring(user_id) if self._packed is not None else None
+        if ring is None:
+            raise KeyError(user_id)
+        return ring
+
+    def get(self, user_id, default=None):
+        try:
+            return self[user_id]
+        except KeyError:
+            return default
+
+    def clear(self) -> None:
+        super().clear()
+        self._owned = None
+        self._packed = None
+        self._still_packed = 0
+
+    def load_packed(self, packed: PackedHistory) -> None:
+        """Replace the contents with packed history."""
+        self.clear()
+        self._packed = packed
+        self._still_packed = len(packed)
+
+    def snapshot(self) -> 'HistoryRings':
+        copied = HistoryRings(self)
+        copied._packed = self._packed
+        copied._still_packed = self._still_packed
+        self._owned = set()
+        return copied
+
+    def pack(self) -> PackedHistory:
+        """Every user's history, packed ones included, as a PackedHistory."""
+        return PackedHistory.pack(self, self._packed)
+
+    def writable(self, user_id: int, capacity: int = HISTORY_DEPTH) -> HistoryRing:
+        """The user's ring, safe to append to (created if they have none yet)."""
+        ring = super().get(user_id)
+        owned = self._owned
+        if ring is None:
+            packed = self._packed
+            ring = packed.ring(user_id, capacity) if packed is not None else None
+            if ring is not None:
+                self._still_packed -= 1
+            else:
+                ring = HistoryRing(capacity)
+            self[user_id] = ring
+        elif owned is None or user_id in owned:
+            return ring
+        else:
+            ring = self[user_id] = ring.copy()
+        if owned is not None:
+            owned.add(user_id)
+        return ring
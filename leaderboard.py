@@ -0,0 +1,169 @@
+import random
+from typing import Dict, List, Optional, Tuple
+
+# Maximum height of a skip list tower (enough for billions of entries with p = 1/4)
+MAX_LEVEL = 32
+_P = 0.25
+
+
+class _Node:
+    __slots__ = ('key', 'forward', 'span')
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.forward: List[Optional['_Node']] = [None] * level
+        # span[i] = how many level-0 steps forward[i] jumps over
+        self.span: List[int] = [0] * level
+
+
+class IndexableSkipList:
+    """
+    Sorted set with O(log n) insert, remove, rank-of-key and key-at-rank.
+
+    Every forward pointer also records how many elements it skips, which is what
+    makes rank queries logarithmic (the same layout Redis uses for sorted sets).
+    """
+
+    def __init__(self):
+        self._head = _Node(None, MAX_LEVEL)
+        self._level = 1
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @staticmethod
+    def _random_level() -> int:
+        level = 1
+        while level < MAX_LEVEL and random.random() < _P:
+            level += 1
+        return level
+
+    def insert(self, key) -> None:
+        """Insert a key (keys must be unique)."""
+        update = [self._head] * MAX_LEVEL
+        rank = [0] * MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while node.forward[i] is not None and node.forward[i].key < key:
+                rank[i] += node.span[i]
+                node = node.forward[i]
+            update[i] = node
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.span[i] = self._length
+            self._level = level
+
+        new_node = _Node(key, level)
+        for i in range(level):
+            new_node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = new_node
+            new_node.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = (rank[0] - rank[i]) + 1
+
+        # Pointers above the new tower now jump over one more element
+        for i in range(level, self._level):
+            update[i].span[i] += 1
+        self._length += 1
+
+    def remove(self, key) -> bool:
+        """Remove a key. Returns True if it was present."""
+        update = [self._head] * MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.forward[i] is not None and node.forward[i].key < key:
+                node = node.forward[i]
+            update[i] = node
+
+        node = node.forward[0]
+        if node is None or node.key != key:
+            return False
+
+        for i in range(self._level):
+            if update[i].forward[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].forward[i] = node.forward[i]
+            else:
+                update[i].span[i] -= 1
+        while self._level > 1 and self._head.forward[self._level - 1] is None:
+            self._level -= 1
+        self._length -= 1
+        return True
+
+    def rank(self, key) -> Optional[int]:
+        """1-based position of a key, or None if it isn't present."""
+        traversed = 0
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.forward[i] is not None and node.forward[i].key <= key:
+                traversed += node.span[i]
+                node = node.forward[i]
+            if node.key == key and node is not self._head:
+                return traversed
+        return None
+
+    def slice(self, start: int, count: int) -> list:
+        """Up to count keys starting at 1-based position start."""
+        if start < 1 or start > self._length:
+            return []
+        traversed = 0
+        node = self._head
+        # Jump to the node just before start
+        for i in range(self._level - 1, -1, -1):
+            while node.forward[i] is not None and traversed + node.span[i] < start:
+                traversed += node.span[i]
+                node = node.forward[i]
+        keys = []
+        node = node.forward[0]
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.forward[0]
+        return keys
+
+
+class Leaderboard:
+    """Ranks users by a score, highest first (ties go to the lower user ID)."""
+
+    def __init__(self):
+        self._list = IndexableSkipList()
+        self._scores: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._list)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._scores
+
+    def update(self, user_id: int, score: float) -> None:
+        """Set a user's score, moving them to their new position."""
+        old = self._scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._list.remove((-old, user_id))
+        self._list.insert((-score, user_id))
+        self._scores[user_id] = score
+
+    def remove(self, user_id: int) -> None:
+        old = self._scores.pop(user_id, None)
+        if old is not None:
+            self._list.remove((-old, user_id))
+
+    def score(self, user_id: int) -> Optional[float]:
+        return self._scores.get(user_id)
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """1-based rank of a user, or None if they aren't on the board."""
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+        return self._list.rank((-score, user_id))
+
+    def top(self, count: int = 10, start: int = 1) -> List[Tuple[int, float]]:
+        """The (user_id, score) entries ranked start .. start + count - 1."""
+        return [(user_id, -negated) for negated, user_id in self._list.slice(start, count)]
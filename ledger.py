@@ -0,0 +1,115 @@
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Idempotency keys remembered; a change is only recognized as a repeat while its key is among this many newest
+LEDGER_KEY_CAPACITY = int(os.environ.get("LEDGER_KEY_CAPACITY", "200000"))
+
+
+def settlement_key(chat_id: int, created: float, user_id: int) -> str:
+    """Idempotency key of a player's payout from a multiplayer game (created = the game's creation_time)."""
+    return f"mp:{chat_id}:{created!r}:{user_id}"
+
+
+class Ledger:
+    """
+    Wallet balances, changed only by posting entries.
+
+    An entry is (user_id, change, resulting balance, key). Posting one updates the
+    materialized balance in place, so reading a balance stays a dict lookup, and
+    hands the entry back for the storage backend to append to its log, where it
+    is committed with everything else recorded in the same tick.
+
+    Entries may carry an idempotency key derived from what caused them (a game,
+    a callback). Posting a key that was already applied changes nothing, so a
+    redelivered update or a settlement that runs twice can't pay out twice. Keys
+    come back from storage with the entries, so this holds across restarts and
+    across processes sharing a log. The newest `capacity` keys are kept.
+    """
+
+    def __init__(self, starting_balance: int, capacity: int = LEDGER_KEY_CAPACITY):
+        self.starting_balance = starting_balance
+        self.capacity = capacity
+        self.balances: Dict[int, int] = {}
+        # Applied keys, oldest first (a dict keeps insertion order and looks up in O(1))
+        self._keys: Dict[str, None] = {}
+        self.posted = 0
+        self.duplicates = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def balance(self, user_id: int) -> int:
+        balance = self.balances.get(user_id)
+        return self.starting_balance if balance is None else balance
+
+    def _remember(self, key: Optional[str]) -> bool:
+        """Remember a key. Returns False if it was already applied."""
+        if key is None:
+            return True
+        keys = self._keys
+        if key in keys:
+            self.duplicates += 1
+            return False
+        keys[key] = None
+        if len(keys) > self.capacity:
+            del keys[next(iter(keys))]
+        return True
+
+    def post(self, user_id: int, amount: int, key: Optional[str] = None) -> Optional[Tuple[int, int]]:
+        """
+        Apply a change to a wallet, never taking it below 0
+
+        Args:
+            user_id (int): The wallet's owner
+            amount (int): Coins to add (positive) or take (negative)
+            key (str, optional): Idempotency key of the change
+
+        Returns:
+            tuple: (new balance, change actually applied), or None if the key was already applied
+        """
+        if not self._remember(key):
+            return None
+        current = self.balance(user_id)
+        balance = max(0, current + amount)
+        self.balances[user_id] = balance
+        self.posted += 1
+        return balance, balance - current
+
+    def replay_balance(self, user_id: int, balance: int, key: Optional[str] = None) -> bool:
+        """Apply a stored entry by its resulting balance. Returns False if its key was already applied."""
+        if not self._remember(key):
+            return False
+        self.balances[user_id] = balance
+        return True
+
+    def replay_change(self, user_id: int, change: int, key: Optional[str] = None) -> bool:
+        """
+        Apply a stored entry by its change. Returns False if its key was already applied.
+
+        Not clamped at 0, so processes applying each other's entries in different
+        orders end up with the same balances.
+        """
+        if not self._remember(key):
+            return False
+        self.balances[user_id] = self.balance(user_id) + change
+        return True
+
+    def keys(self) -> List[str]:
+        """The remembered keys, oldest first (for snapshots)."""
+        return list(self._keys)
+
+    def load(self, balances: Dict[int, int], keys: Iterable[str] = ()) -> None:
+        """Replace the balances and keys with saved ones."""
+        self.balances.clear()
+        self.balances.update(balances)
+        self._keys = dict.fromkeys(keys)
+        while len(self._keys) > self.capacity:
+            del self._keys[next(iter(self._keys))]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'wallets': len(self.balances),
+            'posted': self.posted,
+            'duplicates': self.duplicates,
+            'keys': len(self._keys),
+        }
@@ -1,24 +1,28 @@
 import os
+import sys
 import logging
-import asyncio
-import threading
 import subprocess
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Import after loading environment variables
-from bot import start_bot
+# The bot (and with it telegram, httpx and APScheduler) is only imported by the
+# process that runs it, so the web server starts in a few milliseconds
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# "polling" runs the bot in a separate long-polling process,
+# "webhook" receives updates from Telegram on this web server
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+
 # Use a file lock to ensure only one bot process runs at a time
 bot_lock_file = "bot.lock"
 bot_process = None
+webhook_bridge = None
 
 # Start the bot directly in a separate process
 def start_bot_process():
@@ -35,9 +39,8 @@ def start_bot_process():
         with open(bot_lock_file, 'w') as f:
             f.write(str(os.getpid()))
         
-        # Run the bot script directly with dotenv
-        bot_process = subprocess.Popen(["python", "-c", 
-            "from dotenv import load_dotenv; load_dotenv(); from bot import start_bot; start_bot()"])
+        # Run the bot with this interpreter; it inherits the environment loaded from .env
+        bot_process = subprocess.Popen([sys.executable, "-c", "from bot import start_bot; start_bot()"])
         return "Bot started as a separate process"
     except Exception as e:
         # Clean up lock file if startup fails
@@ -46,11 +49,52 @@ def start_bot_process():
         logger.error(f"Error starting bot process: {e}")
         return f"Failed to start bot: {e}"
 
-# Start the bot when this module is imported
-bot_status = start_bot_process()
+# Run the bot inside this process and take updates over HTTP
+def start_webhook():
+    global webhook_bridge
+    from webhook import WebhookBridge
+    logger.info("Starting Telegram Bot in webhook mode")
+    
+    bridge = WebhookBridge()
+    try:
+        if not bridge.start():
+            return "Bot is not configured"
+    except Exception as e:
+        logger.error(f"Error starting webhook: {e}")
+        return f"Failed to start bot: {e}"
+    webhook_bridge = bridge
+    return "Bot is receiving updates by webhook"
+
+# Start the bot when this module is imported. The shard processes of BOT_SHARDS > 1
+# import it again as __mp_main__ when it's the script being run, and must not start
+# (or, on exit, clean up after) another bot
+IS_SHARD_PROCESS = __name__ == "__mp_main__"
+if IS_SHARD_PROCESS:
+    bot_status = "Bot shard"
+elif BOT_MODE == "webhook":
+    bot_status = start_webhook()
+else:
+    bot_status = start_bot_process()
 
 # The app variable is needed for Gunicorn
 def app(environ, start_response):
+    if webhook_bridge is not None and environ.get('PATH_INFO') == webhook_bridge.path:
+        return webhook_bridge.handle_request(environ, start_response)
+    if BOT_MODE == "webhook" and webhook_bridge is None and environ.get('REQUEST_METHOD') == 'POST':
+        # The bot didn't start in this process; make Telegram deliver the update again later
+        start_response("503 Service Unavailable", [("Content-Type", "text/plain"), ("Content-Length", "0")])
+        return [b""]
+    
+    if environ.get('PATH_INFO') == '/metrics':
+        # Written by the bot process(es) every METRICS_INTERVAL seconds
+        from metrics import scrape
+        data = scrape().encode('utf-8')
+        start_response("200 OK", [
+            ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+            ("Content-Length", str(len(data)))
+        ])
+        return [data]
+    
     data = f"Rock Paper Scissors Telegram Bot (@RPLSLBot) - {bot_status}".encode('utf-8')
     start_response("200 OK", [
         ("Content-Type", "text/plain"),
@@ -60,9 +104,17 @@ def app(environ, start_response):
 
 # Clean up when the process exits
 def cleanup():
-    global bot_process
+    global bot_process, webhook_bridge
     logger.info("Cleaning up bot process")
     
+    # Stop the in-process bot and save its stats
+    if webhook_bridge is not None:
+        try:
+            webhook_bridge.stop()
+        except Exception as e:
+            logger.error(f"Error stopping webhook bot: {e}")
+        webhook_bridge = None
+    
     # Terminate the bot process if it's running
     if bot_process is not None:
         try:
@@ -81,7 +133,8 @@ def cleanup():
 
 # Register cleanup on exit
 import atexit
-atexit.register(cleanup)
+if not IS_SHARD_PROCESS:
+    atexit.register(cleanup)
 
 # Handle keyboard interrupts
 import signal
@@ -90,11 +143,29 @@ def signal_handler(sig, frame):
     cleanup()
     exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+if not IS_SHARD_PROCESS:
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
-if __name__ == '__main__':
+if __name__ == '__main__' and BOT_MODE == "webhook":
+    # Serve the webhook without gunicorn
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import make_server, WSGIServer
+    
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+    
+    port = int(os.environ.get("PORT", "8080"))
+    logger.info(f"Serving webhook on port {port}")
+    try:
+        make_server("", port, app, server_class=ThreadingWSGIServer).serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Keyboard interrupt received, shutting down")
+    finally:
+        cleanup()
+elif __name__ == '__main__':
     # If running directly, just start the bot (no web server)
+    from bot import start_bot
     logger.info("Starting Telegram Bot directly")
     try:
         start_bot()
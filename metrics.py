@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import socket
+import logging
+import functools
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Where bot processes leave their metrics for the web server's /metrics endpoint
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(os.environ.get("STATS_DATA_DIR", "data"), "metrics"))
+# Seconds between two exports by a bot process (0 turns exporting off)
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "5"))
+
+# Upper bounds of the latency histograms' buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Families every process records into: name -> (type, help, label names)
+FAMILIES = {
+    'rps_updates_total': (COUNTER, "Updates processed, by type", ('type',)),
+    'rps_update_seconds': (HISTOGRAM, "Time to process an update, including waiting for its chat's lock", ()),
+    'rps_handler_seconds': (HISTOGRAM, "Time spent in each handler", ('handler',)),
+    'rps_handler_errors_total': (COUNTER, "Exceptions raised by each handler", ('handler',)),
+    'rps_api_request_seconds': (HISTOGRAM, "Latency of the Bot API calls made by the outbound queue", ('method',)),
+    'rps_api_errors_total': (COUNTER, "Failed Bot API calls of the outbound queue, by method and error", ('method', 'error')),
+    'rps_outbound_queued': (GAUGE, "Messages waiting in the outbound queue or in flight", ()),
+    'rps_job_seconds': (HISTOGRAM, "Duration of each scheduled job run", ('job',)),
+    'rps_active_games': (GAUGE, "Multiplayer games in progress, by stage", ('stage',)),
+    'rps_players_in_games': (GAUGE, "Players seated in multiplayer games in progress", ()),
+    'rps_store_size': (GAUGE, "Entries in each in-memory store", ('store',)),
+    'rps_player_results': (GAUGE, "Results recorded in every player's stats, by mode and result", ('mode', 'result')),
+}
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one process.
+
+    Recording is a dict lookup (plus a bisect over the bucket bounds for a
+    histogram), cheap enough for every update and every API call. Gauges are set
+    by collectors right before a snapshot is taken. Bot processes write their
+    snapshots to METRICS_DIR, and the web server sums the snapshots of all of
+    them into one page in Prometheus' text format when /metrics is scraped.
+    """
+
+    def __init__(self, families: Optional[Dict[str, Tuple[str, str, Tuple[str, ...]]]] = None,
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.families = dict(FAMILIES if families is None else families)
+        self.buckets = buckets
+        # name -> label values -> count, value, or per-bucket counts with +Inf and then the sum last
+        self.values: Dict[str, Dict[Tuple[str, ...], Any]] = {name: {} for name in self.families}
+        self._collectors: List[Callable[['Metrics'], None]] = []
+
+    def inc(self, name: str, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        series = self.values[name]
+        series[labels] = series.get(labels, 0) + amount
+
+    def set(self, name: str, value: float, labels: Tuple[str, ...] = ()) -> None:
+        self.values[name][labels] = value
+
+    def observe(self, name: str, value: float, labels: Tuple[str, ...] = ()) -> None:
+        series = self.values[name]
+        counts = series.get(labels)
+        if counts is None:
+            counts = series[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def add_collector(self, collect: Callable[['Metrics'], None]) -> None:
+        """Have collect(metrics) set gauges before every snapshot."""
+        self._collectors.append(collect)
+
+    def snapshot(self) -> Dict:
+        """Everything recorded so far, as JSON-serializable data."""
+        for collect in self._collectors:
+            try:
+                collect(self)
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {e}")
+        return {
+            'families': {name: [kind, help, list(labels)] for name, (kind, help, labels) in self.families.items()},
+            'buckets': list(self.buckets),
+            'values': {name: [[list(labels), value] for labels, value in series.items()]
+                       for name, series in self.values.items()},
+        }
+
+
+def time_calls(metrics: Metrics, callback: Callable[..., Awaitable], histogram: str, label: str,
+               errors: Optional[str] = None, expected: Tuple[type, ...] = ()) -> Callable[..., Awaitable]:
+    """
+    Wrap an async callback so every call records its duration under label
+
+    Args:
+        histogram (str): Histogram family to record into
+        label (str): Its label value for this callback
+        errors (str, optional): Counter family to count exceptions in, except those of the expected types
+    """
+    labels = (label,)
+
+    @functools.wraps(callback)
+    async def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except expected:
+            raise
+        except Exception:
+            if errors is not None:
+                metrics.inc(errors, labels)
+            raise
+        finally:
+            metrics.observe(histogram, time.perf_counter() - started, labels)
+    return timed
+
+
+def export_path(directory: str = METRICS_DIR) -> str:
+    """The file this process exports its snapshots to."""
+    return os.path.join(directory, f"metrics-{socket.gethostname()}-{os.getpid()}.json")
+
+
+def write_snapshot(snapshot: Dict, path: str) -> None:
+    """Replace the snapshot file atomically, so the web server never reads half of it."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def read_snapshots(directory: str = METRICS_DIR, max_age: Optional[float] = None) -> List[Dict]:
+    """
+    Read the snapshots bot processes exported
+
+    Args:
+        max_age (float, optional): Skip files not updated for this many seconds (processes that are gone)
+    """
+    if not os.path.isdir(directory):
+        return []
+    now = time.time()
+    snapshots = []
+    for name in os.listdir(directory):
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if max_age is not None and now - os.path.getmtime(path) > max_age:
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping metrics file {name}: {e}")
+    return snapshots
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(snapshots: Iterable[Dict]) -> str:
+    """Sum the series of several snapshots and format them in Prometheus' text exposition format."""
+    families: Dict[str, List] = {}
+    buckets: Dict[str, List[float]] = {}
+    merged: Dict[str, Dict[Tuple, Any]] = {}
+    for snapshot in snapshots:
+        for name, family in snapshot['families'].items():
+            families.setdefault(name, family)
+            merged.setdefault(name, {})
+            if family[0] == HISTOGRAM:
+                buckets.setdefault(name, snapshot['buckets'])
+        for name, series in snapshot['values'].items():
+            target = merged[name]
+            histogram = families[name][0] == HISTOGRAM
+            if histogram and snapshot['buckets'] != buckets[name]:
+                continue  # Exported with other bounds (a process from another version); can't be added up
+            for labels, value in series:
+                key = tuple(labels)
+                current = target.get(key)
+                if current is None:
+                    target[key] = list(value) if histogram else value
+                elif histogram:
+                    target[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target[key] = current + value
+
+    lines = []
+    for name in sorted(families):
+        kind, help, label_names = families[name]
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(merged[name].items()):
+            if kind != HISTOGRAM:
+                lines.append(f"{name}{_format_labels(label_names, labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets[name] + ['+Inf'], value[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{bound}"'
+                lines.append(f"{name}_bucket{_format_labels(label_names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(label_names, labels)} {_format_value(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(label_names, labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def scrape(directory: str = METRICS_DIR) -> str:
+    """The /metrics page: every live bot process's latest snapshot, added up."""
+    # A process that hasn't exported for a few intervals has stopped
+    return render(read_snapshots(directory, max_age=max(3 * METRICS_INTERVAL, 30)))
+
+
+metrics = Metrics()
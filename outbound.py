@@ -0,0 +1,491 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import deque
+from datetime import timedelta
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from metrics import metrics
+from profiler import profiler
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first
+PRIORITY_PROMPT = 0   # Private bet and move prompts that players are waiting on
+PRIORITY_REPLY = 1    # Direct replies to commands
+PRIORITY_STATUS = 2   # Group status messages and edits
+
+# Telegram's limits for bots: about 30 messages per second overall, 20 per minute
+# in a group and about 1 per second in a private chat (edits count too)
+GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE_PER_MINUTE", "20")) / 60
+GROUP_BURST = int(os.environ.get("OUTBOUND_GROUP_BURST", "20"))
+PRIVATE_RATE = float(os.environ.get("OUTBOUND_PRIVATE_RATE", "1"))
+PRIVATE_BURST = int(os.environ.get("OUTBOUND_PRIVATE_BURST", "3"))
+# Bot API requests in flight at once
+MAX_CONCURRENT = int(os.environ.get("OUTBOUND_CONCURRENCY", "8"))
+# Attempts after a network error before a message is given up on, for calls that are
+# safe to repeat (see OutboundScheduler.submit)
+MAX_RETRIES = 3
+
+# Messages whose last sent text is remembered, to skip edits that wouldn't change anything
+TEXT_CACHE_SIZE = int(os.environ.get("OUTBOUND_TEXT_CACHE_SIZE", "10000"))
+
+# Idle chats are forgotten once their bucket has refilled; checked this often
+_SWEEP_INTERVAL = 60.0
+
+# Returned by a queued call that decided not to make its request; it costs no rate-limit tokens
+NOT_SENT = object()
+
+
+class TokenBucket:
+    """Allows rate operations per second on average, in bursts of up to capacity."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def give_back(self) -> None:
+        """Return a token taken for a request that wasn't made."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundMessage:
+    """A queued Bot API call and what to do with its result."""
+
+    __slots__ = ('chat_id', 'call', 'priority', 'sequence', 'future', 'on_sent', 'on_error', 'attempts', 'method',
+                 'trace', 'retry')
+
+    def __init__(self, chat_id: int, call: Callable[..., Awaitable], priority: int, sequence: int,
+                 future: asyncio.Future, on_sent: Optional[Callable] = None,
+                 on_error: Optional[Callable] = None, method: str = 'other', retry: bool = True):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.sequence = sequence
+        self.future = future
+        self.on_sent = on_sent
+        self.on_error = on_error
+        self.attempts = 0
+        self.method = method  # Bot API method the call makes, for the metrics
+        self.trace = profiler.current_trace()  # Sampled update that queued the call, if any
+        self.retry = retry  # Whether a network error sends the call again
+
+
+class _ChatQueue:
+    """Messages waiting for one chat, sent strictly in order and one at a time."""
+
+    __slots__ = ('messages', 'bucket', 'busy', 'scheduled', 'blocked_until')
+
+    def __init__(self, bucket: Optional[TokenBucket]):
+        self.messages: Deque[OutboundMessage] = deque()
+        self.bucket = bucket
+        self.busy = False          # A request for this chat is in flight
+        self.scheduled = False     # The chat is in the ready or delayed heap
+        self.blocked_until = 0.0   # Set from RetryAfter
+
+
+class OutboundScheduler:
+    """
+    Central queue for messages the bot sends, paced to stay within Telegram's limits.
+
+    Handlers enqueue a send or edit and return immediately. A dispatcher task picks
+    the most urgent message whose chat has a token in its bucket (and the global
+    bucket has one too) and sends it, with up to max_concurrent requests in flight.
+    Messages to the same chat keep their order. RetryAfter pauses just that chat,
+    network errors are retried for calls that are safe to repeat (edits, not sends),
+    and anything else fails the message's future.
+    """
+
+    def __init__(self, bot, global_rate: float = GLOBAL_RATE, group_rate: float = GROUP_RATE,
+                 group_burst: int = GROUP_BURST, private_rate: float = PRIVATE_RATE,
+                 private_burst: int = PRIVATE_BURST, max_concurrent: int = MAX_CONCURRENT,
+                 rate_limits: bool = True):
+        self.bot = bot
+        self.rate_limits = rate_limits
+        self.global_rate = global_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_concurrent = max_concurrent
+        self._global = TokenBucket(global_rate, global_rate, time.monotonic()) if rate_limits else None
+
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._ready: List[Tuple[int, int, int]] = []        # (priority, sequence, chat_id)
+        self._delayed: List[Tuple[float, int, int]] = []    # (ready_at, sequence, chat_id)
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._queued = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._deliveries = set()  # Keeps in-flight delivery tasks from being garbage collected
+        self._last_sweep = time.monotonic()
+        # (chat_id, message_id) -> last text sent, oldest first
+        self._texts: Dict[Tuple[int, int], str] = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.skipped = 0
+        self.max_queue_depth = 0
+
+    # ------------------------------------------------------------------
+    # Enqueueing
+    # ------------------------------------------------------------------
+    def submit(self, chat_id: int, call: Callable[..., Awaitable], priority: int = PRIORITY_REPLY,
+               on_sent: Optional[Callable] = None, on_error: Optional[Callable] = None,
+               method: str = 'other', retry: bool = True) -> asyncio.Future:
+        """
+        Queue call(bot) to run against chat_id's limits. Returns a future for its result.
+
+        on_sent(result) and on_error(exception) run on the event loop once the call
+        has succeeded or been given up on. If on_sent returns an awaitable, the chat's
+        next message waits for it. method names the Bot API method the call
+        makes, for the metrics. A network error or timeout may come after Telegram
+        has already carried out the call, so it's only made again if retry is set;
+        RetryAfter means the call was refused, and is always retried.
+        """
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        message = OutboundMessage(chat_id, call, priority, next(self._sequence),
+                                  loop.create_future(), on_sent, on_error, method, retry)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(self._new_bucket(chat_id))
+        chat.messages.append(message)
+        self._queued += 1
+        if self._queued > self.max_queue_depth:
+            self.max_queue_depth = self._queued
+        self._idle.clear()
+        if not chat.busy and not chat.scheduled:
+            self._schedule(chat_id, chat)
+        return message.future
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_REPLY,
+                     on_sent: Optional[Callable] = None, on_error: Optional[Callable] = None,
+                     retry: bool = False, **kwargs) -> asyncio.Future:
+        """
+        Queue bot.send_message(chat_id=chat_id, text=text, **kwargs).
+
+        Not sent again after a network error unless retry is set, since the first
+        attempt may have posted the message already.
+        """
+        async def call(bot):
+            message = await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            self.remember_text(chat_id, message.message_id, text)
+            return message
+        return self.submit(chat_id, call, priority, on_sent, on_error, 'sendMessage', retry)
+
+    def reply_to(self, message, text: str, priority: int = PRIORITY_REPLY,
+                 on_sent: Optional[Callable] = None, on_error: Optional[Callable] = None,
+                 **kwargs) -> asyncio.Future:
+        """
+        Queue a reply to message, quoting it outside private chats as Message.reply_text does.
+
+        The reply still goes out if the message is deleted while the reply waits its turn.
+        """
+        if message.chat.type != 'private':
+            kwargs.setdefault('reply_to_message_id', message.message_id)
+            kwargs.setdefault('allow_sending_without_reply', True)
+        return self.send_message(message.chat_id, text, priority, on_sent, on_error, **kwargs)
+
+    def edit_message_text(self, chat_id: int, message_id: int, text: str, priority: int = PRIORITY_STATUS,
+                          on_sent: Optional[Callable] = None, on_error: Optional[Callable] = None,
+                          **kwargs) -> asyncio.Future:
+        """
+        Queue bot.edit_message_text(...) for a message in chat_id.
+
+        Skipped (resolving to None without calling on_sent) if the message already
+        shows this text when its turn comes.
+        """
+        async def call(bot):
+            return await self.edit_text_now(bot, chat_id, message_id, text, **kwargs)
+        return self.submit(chat_id, call, priority, on_sent, on_error, 'editMessageText')
+
+    async def edit_text_now(self, bot, chat_id: int, message_id: int, text: str, **kwargs):
+        """
+        Edit a message from inside a queued call, unless it already shows this text.
+
+        Returns:
+            The edited message, or NOT_SENT if the edit was skipped
+        """
+        if self._texts.get((chat_id, message_id)) == text:
+            return NOT_SENT
+        try:
+            result = await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+        except BadRequest as e:
+            # Someone else (another process, or a lost reply) already put this text there
+            if 'not modified' not in str(e).lower():
+                raise
+            result = NOT_SENT
+        self.remember_text(chat_id, message_id, text)
+        return result
+
+    def remember_text(self, chat_id: int, message_id: int, text: str) -> None:
+        """Record the text a message shows now, so identical edits can be skipped."""
+        key = (chat_id, message_id)
+        texts = self._texts
+        # Re-insert so the dict stays ordered from least to most recently changed
+        texts.pop(key, None)
+        texts[key] = text
+        if len(texts) > TEXT_CACHE_SIZE:
+            del texts[next(iter(texts))]
+
+    def _new_bucket(self, chat_id: int) -> Optional[TokenBucket]:
+        if not self.rate_limits:
+            return None
+        now = time.monotonic()
+        if chat_id < 0:
+            return TokenBucket(self.group_rate, self.group_burst, now)
+        return TokenBucket(self.private_rate, self.private_burst, now)
+
+    def _schedule(self, chat_id: int, chat: _ChatQueue) -> None:
+        """Put a chat with queued messages in the ready heap, or the delayed heap until it may send."""
+        now = time.monotonic()
+        wait = max(chat.blocked_until - now, chat.bucket.delay(now) if chat.bucket else 0.0)
+        chat.scheduled = True
+        if wait > 0:
+            heapq.heappush(self._delayed, (now + wait, next(self._sequence), chat_id))
+        else:
+            head = chat.messages[0]
+            heapq.heappush(self._ready, (head.priority, head.sequence, chat_id))
+        self._wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Dispatching
+    # ------------------------------------------------------------------
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = self._wakeup or asyncio.Event()
+            if self._idle is None:
+                self._idle = asyncio.Event()
+                self._idle.set()
+            self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                chat = self._chats[chat_id]
+                chat.scheduled = False
+                self._schedule(chat_id, chat)
+
+            if now - self._last_sweep > _SWEEP_INTERVAL:
+                self._sweep(now)
+
+            if not self._ready or self._in_flight >= self.max_concurrent:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if self._global is not None:
+                wait = self._global.delay(now)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self._global.take(now)
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            chat.scheduled = False
+            if chat.bucket is not None:
+                chat.bucket.take(now)
+            message = chat.messages.popleft()
+            chat.busy = True
+            self._in_flight += 1
+            delivery = asyncio.get_running_loop().create_task(self._deliver(chat, message))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat: _ChatQueue, message: OutboundMessage) -> None:
+        done = True
+        try:
+            message.attempts += 1
+            started = time.perf_counter()
+            try:
+                with profiler.span(message.method, 'api', trace=message.trace):
+                    result = await message.call(self.bot)
+            except Exception as e:
+                self._record_call(message, started, e)
+                raise
+            if result is not NOT_SENT:
+                self._record_call(message, started)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self.rate_limited += 1
+            logger.warning(f"Rate limited in chat {message.chat_id}, retrying in {retry_after}s")
+            chat.blocked_until = time.monotonic() + retry_after
+            done = False
+        except (BadRequest, Forbidden) as e:
+            self._fail(message, e)
+        except NetworkError as e:
+            if message.retry and message.attempts <= MAX_RETRIES:
+                self.retried += 1
+                chat.blocked_until = time.monotonic() + 0.5 * 2 ** (message.attempts - 1)
+                done = False
+            else:
+                self._fail(message, e)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            if result is NOT_SENT:
+                # Nothing went out, so the tokens taken for it are still unused
+                self.skipped += 1
+                if chat.bucket is not None:
+                    chat.bucket.give_back()
+                if self._global is not None:
+                    self._global.give_back()
+                if not message.future.done():
+                    message.future.set_result(None)
+            else:
+                self.sent += 1
+                if not message.future.done():
+                    message.future.set_result(result)
+                if message.on_sent is not None:
+                    try:
+                        pending = message.on_sent(result)
+                        if pending is not None:
+                            await pending
+                    except Exception as e:
+                        logger.error(f"Error in on_sent callback for chat {message.chat_id}: {e}")
+        finally:
+            if not done:
+                # Send it again before anything queued after it
+                chat.messages.appendleft(message)
+            else:
+                self._queued -= 1
+            chat.busy = False
+            self._in_flight -= 1
+            if chat.messages:
+                self._schedule(message.chat_id, chat)
+            else:
+                self._wakeup.set()
+                if self._queued == 0 and self._in_flight == 0:
+                    self._idle.set()
+
+    @staticmethod
+    def _record_call(message: OutboundMessage, started: float, error: Optional[Exception] = None) -> None:
+        metrics.observe('rps_api_request_seconds', time.perf_counter() - started, (message.method,))
+        if error is not None:
+            metrics.inc('rps_api_errors_total', (message.method, type(error).__name__))
+
+    def _fail(self, message: OutboundMessage, error: Exception) -> None:
+        self.failed += 1
+        logger.error(f"Error sending message to chat {message.chat_id}: {error}")
+        if not message.future.done():
+            message.future.set_exception(error)
+            # Nobody has to await the future; mark the exception as retrieved
+            message.future.exception()
+        if message.on_error is not None:
+            try:
+                message.on_error(error)
+            except Exception as e:
+                logger.error(f"Error in on_error callback for chat {message.chat_id}: {e}")
+
+    def _sweep(self, now: float) -> None:
+        """Forget idle chats whose buckets are full again."""
+        self._last_sweep = now
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.messages and not chat.busy and not chat.scheduled
+                and chat.blocked_until <= now and (chat.bucket is None or chat.bucket.full(now))]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+    def pending(self) -> int:
+        """Messages queued or in flight."""
+        return self._queued
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued has been sent. Returns False on timeout."""
+        if self._idle is None or self._idle.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Send what's queued (waiting at most timeout seconds), then stop the dispatcher."""
+        if not await self.drain(timeout):
+            logger.warning(f"Stopping with {self._queued} outbound messages unsent")
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'skipped': self.skipped,
+            'queued': self._queued,
+            'max_queue_depth': self.max_queue_depth,
+            'remembered_texts': len(self._texts),
+        }
+
+
+# One scheduler per bot: Telegram's rate limits apply per bot token
+_schedulers: Dict[int, OutboundScheduler] = {}
+
+def get_outbound_scheduler(bot, **options) -> OutboundScheduler:
+    """
+    Get the outbound scheduler for a bot, creating it with options on first use.
+
+    Raises:
+        ValueError: If the scheduler already exists with other options, which it would keep
+    """
+    scheduler = _schedulers.get(id(bot))
+    if scheduler is None or scheduler.bot is not bot:
+        scheduler = _schedulers[id(bot)] = OutboundScheduler(bot, **options)
+        return scheduler
+    conflicting = {name: value for name, value in options.items() if getattr(scheduler, name) != value}
+    if conflicting:
+        raise ValueError(f"The outbound scheduler already exists with options other than {conflicting}; "
+                         f"pass them on the first get_outbound_scheduler() call")
+    return scheduler
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import random
+import inspect
+import logging
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Where trace files are written
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.environ.get("STATS_DATA_DIR", "data"), "profiles"))
+# Share of updates traced while profiling is on
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.01"))
+# Profile from startup instead of waiting for /profile or SIGUSR2
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "").lower() in ("1", "true", "yes")
+# Spans per trace file; profiling moves on to a new file after that many
+PROFILE_MAX_EVENTS = int(os.environ.get("PROFILE_MAX_EVENTS", "200000"))
+
+# The trace the code running now belongs to (its update's ID), or None if it isn't sampled
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('profiler_trace', default=None)
+
+# Recorded span: (name, category, start in µs, duration in µs, trace ID)
+Span = Tuple[str, str, float, float, int]
+
+
+class _NoSpan:
+    """What span() returns outside sampled updates: entering and leaving it costs nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('profiler', 'trace', 'name', 'category', 'started')
+
+    def __init__(self, profiler: 'Profiler', trace: int, name: str, category: str):
+        self.profiler = profiler
+        self.trace = trace
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        ended = time.perf_counter()
+        self.profiler.record(self.name, self.category, self.started, ended, self.trace)
+        return False
+
+
+class _UpdateTrace(_Span):
+    """Root span of a sampled update; code run inside it belongs to the update's trace."""
+
+    __slots__ = ('token',)
+
+    def __enter__(self):
+        self.token = _current_trace.set(self.trace)
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        _current_trace.reset(self.token)
+        return False
+
+
+class Profiler:
+    """
+    Sampling profiler that records span timings of updates as Chrome traces.
+
+    While it's on, a sample_rate share of updates is traced: the update itself and
+    every span opened while handling it (handlers, game store access, rendering,
+    the outbound Bot API calls it queued). Updates that aren't sampled only pay for
+    a context variable lookup per span, and nothing at all is recorded while the
+    profiler is off, so it can stay installed in production.
+
+    Spans are appended to one file per profiling session in PROFILE_DIR, on a
+    writer thread, in Chrome's trace event format: open it in chrome://tracing or
+    https://ui.perfetto.dev, where each traced update gets its own row.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 max_events: int = PROFILE_MAX_EVENTS):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.enabled = False
+        self.path: Optional[str] = None
+        self.sampled = 0
+        self._pid = os.getpid()
+        self._files = 0
+        self._events: List[Span] = []
+        self._written = 0      # Spans handed to the writer for the current file
+        self._writer: Optional[ThreadPoolExecutor] = None
+        # Only touched on the writer thread
+        self._file = None
+        self._first = True
+
+    # ------------------------------------------------------------------
+    # Switching on and off
+    # ------------------------------------------------------------------
+    def enable(self, sample_rate: Optional[float] = None) -> str:
+        """Start profiling (or change the sample rate). Returns the trace file being written."""
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+        if not self.enabled:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profiler")
+            self._start_file()
+            self.enabled = True
+            logger.info(f"Profiling {self.sample_rate:.1%} of updates into {self.path}")
+        return self.path
+
+    def disable(self) -> Optional[str]:
+        """Stop profiling and finish the trace file. Returns its path, or None if profiling was off."""
+        if not self.enabled:
+            return None
+        self.enabled = False
+        self.flush()
+        self._writer.submit(self._close)
+        logger.info(f"Profiling stopped after {self.sampled} sampled updates; trace in {self.path}")
+        return self.path
+
+    def toggle(self) -> None:
+        """Switch profiling on or off (the SIGUSR2 handler)."""
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def close(self) -> None:
+        """Finish the trace file, if any, and stop the writer thread."""
+        self.disable()
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+
+    # ------------------------------------------------------------------
+    # Recording
+    # ------------------------------------------------------------------
+    def trace_update(self, update_id: int, name: str = 'update'):
+        """Context manager around the processing of an update, which samples it (or not)."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return _NO_SPAN
+        self.sampled += 1
+        return _UpdateTrace(self, update_id, name, 'update')
+
+    def span(self, name: str, category: str, trace: Optional[int] = None):
+        """
+        Context manager timing a span of the current update's trace
+
+        Args:
+            trace (int, optional): Record into this trace instead (see current_trace), for work
+                done later on behalf of an update, such as its queued API calls
+        """
+        if trace is None:
+            trace = _current_trace.get()
+        if trace is None or not self.enabled:
+            return _NO_SPAN
+        return _Span(self, trace, name, category)
+
+    @staticmethod
+    def current_trace() -> Optional[int]:
+        """The trace of the update being handled, or None if it isn't sampled."""
+        return _current_trace.get()
+
+    def record(self, name: str, category: str, started: float, ended: float, trace: int) -> None:
+        events = self._events
+        events.append((name, category, started * 1e6, (ended - started) * 1e6, trace))
+        if len(events) >= 1000:
+            self.flush()
+
+    def traced(self, category: str, name: Optional[str] = None) -> Callable:
+        """Decorator recording each call of a function (or coroutine function) as a span."""
+        def decorate(function):
+            span_name = name or function.__name__
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def traced_coroutine(*args, **kwargs):
+                    with self.span(span_name, category):
+                        return await function(*args, **kwargs)
+                return traced_coroutine
+
+            @functools.wraps(function)
+            def traced_function(*args, **kwargs):
+                if _current_trace.get() is None:
+                    return function(*args, **kwargs)
+                with self.span(span_name, category):
+                    return function(*args, **kwargs)
+            return traced_function
+        return decorate
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+    def flush(self) -> None:
+        """Hand the recorded spans to the writer thread."""
+        events = self._events
+        if not events or self._writer is None:
+            return
+        self._events = []
+        self._writer.submit(self._write, events)
+        self._written += len(events)
+        if self.enabled and self._written >= self.max_events:
+            # Keep files small enough for the trace viewers
+            self._writer.submit(self._close)
+            self._start_file()
+
+    def _start_file(self) -> None:
+        self._files += 1
+        self.path = os.path.join(self.directory,
+                                 f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{self._pid}-{self._files}.json")
+        self._written = 0
+        self._writer.submit(self._open, self.path)
+
+    def _open(self, path: str) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(path, 'w')
+            self._file.write('[\n')
+            self._first = True
+        except OSError as e:
+            logger.error(f"Can't write trace file {path}: {e}")
+            self._file = None
+
+    def _write(self, events: List[Span]) -> None:
+        if self._file is None:
+            return
+        pid = self._pid
+        lines = []
+        for name, category, ts, duration, trace in events:
+            lines.append(json.dumps({'name': name, 'cat': category, 'ph': 'X', 'ts': round(ts, 1),
+                                     'dur': round(duration, 1), 'pid': pid, 'tid': trace},
+                                    separators=(',', ':')))
+        separator = '' if self._first else ',\n'
+        self._first = False
+        self._file.write(separator + ',\n'.join(lines))
+        self._file.flush()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.write('\n]\n')
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'sampled': self.sampled,
+            'path': self.path,
+        }
+
+
+profiler = Profiler()
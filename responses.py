@@ -1,6 +1,8 @@
 import random
 import time
 
+from profiler import profiler
+
 # Welcome and help messages with supercool captions
 START_MESSAGE = """
 <b>🎲 WELCOME TO THE ARENA! 🎲</b>
@@ -21,6 +23,8 @@ The legendary battleground where legends are forged!
 /stats - Reveal your legendary battle record
 /wallet - View your coin treasury for betting
 /history - Browse your recent battle chronicles
+/leaderboard - Behold the greatest champions
+/rank - Discover your place among legends
 /help - Discover the ancient rules of combat
 
 💰 <b>RICHES AND GLORY:</b>
@@ -59,6 +63,11 @@ HELP_MESSAGE = """
 /wallet - Check your coin balance for betting
 /history - View your recent battle chronicles 
 
+<b>👑 HALL OF LEGENDS:</b>
+/leaderboard - Top warriors by victories
+/leaderboard [wins|winrate|streak|coins] - Top warriors by another measure
+/rank - Your rank on every leaderboard
+
 <b>🛡️ SPECIAL FEATURES:</b>
 • One-game restriction: Warriors can only battle in one arena at a time
 • Quick-join: Players can make choices even without private messaging the bot first
@@ -221,6 +230,11 @@ def currency_message(currency):
     
     return message
 
+# Rendered stats pages kept for users whose stats haven't changed since
+STATS_RENDER_CACHE_SIZE = 5000
+_stats_render_cache = {}
+
+@profiler.traced('render')
 def stats_message(stats, mode=None):
     """
     Generate a formatted message with the user's statistics
@@ -232,6 +246,54 @@ def stats_message(stats, mode=None):
     Returns:
         str: A formatted message with the statistics
     """
+    # Stats views carry a version that changes with every game, so everything but the
+    # balance can be reused until the user plays again
+    version = getattr(stats, 'version', None)
+    if version is None or 'user_id' not in stats:
+        return _render_stats(stats, mode)
+    
+    from stats import get_user_currency
+    
+    user_id = stats['user_id']
+    key = (user_id, mode, version, stats.get('username'))
+    parts = _stats_render_cache.get(key)
+    if parts is None:
+        parts = _render_stats_parts(stats, mode)
+        if len(_stats_render_cache) >= STATS_RENDER_CACHE_SIZE:
+            del _stats_render_cache[next(iter(_stats_render_cache))]
+        _stats_render_cache[key] = parts
+    return _join_stats_parts(parts, get_user_currency(user_id))
+
+def _render_stats(stats, mode):
+    if 'user_id' not in stats:
+        return _render_stats_summary(stats, mode)
+    
+    from stats import get_user_currency
+    return _join_stats_parts(_render_stats_parts(stats, mode), get_user_currency(stats['user_id']))
+
+def _render_stats_parts(stats, mode):
+    """The summary and the history section of a user's stats page."""
+    from stats import get_user_history
+    
+    # Get history items limited to 5
+    history_items = get_user_history(stats['user_id'], limit=5)
+    return _render_stats_summary(stats, mode), format_game_history(history_items)
+
+def _join_stats_parts(parts, currency):
+    summary, history_text = parts
+    message = summary
+    
+    # Add currency information
+    message += f"\n\n<b>━━━━━━━━━━━━━━━━━━━━━━</b>\n\n"
+    message += currency_message(currency)
+    
+    # Add game history section
+    message += f"\n<b>━━━━━━━━━━━━━━━━━━━━━━</b>\n\n"
+    message += f"<b>🏹 RECENT BATTLE CHRONICLES 🏹</b>\n\n"
+    message += history_text
+    return message
+
+def _render_stats_summary(stats, mode):
     username = stats.get('username', 'Warrior')
     
     # Main header
@@ -356,27 +418,71 @@ def stats_message(stats, mode=None):
     else:
         message += "🌟 <b>DESTINY AWAITS!</b> Every legend begins with perseverance! 🌟"
     
-    # Import the needed functions if this is not the stats for a queried user
-    from stats import get_user_currency, get_user_history
+    return message
+
+# Leaderboard messages
+LEADERBOARD_TITLES = {
+    'wins': "🌟 MOST VICTORIES",
+    'win_percentage': "📊 HIGHEST TRIUMPH RATE",
+    'best_streak': "👑 LEGENDARY STREAKS",
+    'coins': "💰 RICHEST WARRIORS",
+}
+
+def _format_score(metric, score):
+    if metric == 'win_percentage':
+        return f"{score}%"
+    if metric == 'coins':
+        return f"{score} coins"
+    return str(score)
+
+@profiler.traced('render')
+def leaderboard_message(metric, entries):
+    """
+    Generate a formatted leaderboard
     
-    # If there's a user_id in the stats, this is the user's own stats
-    if 'user_id' in stats:
-        user_id = stats['user_id']
-        
-        # Add currency information
-        message += f"\n\n<b>━━━━━━━━━━━━━━━━━━━━━━</b>\n\n"
-        message += currency_message(get_user_currency(user_id))
-        
-        # Add game history section
-        message += f"\n<b>━━━━━━━━━━━━━━━━━━━━━━</b>\n\n"
-        message += f"<b>🏹 RECENT BATTLE CHRONICLES 🏹</b>\n\n"
+    Args:
+        metric (str): The metric the players are ranked by
+        entries (list): (rank, user_id, username, score) tuples, best first
         
-        # Get history items limited to 5
-        history_items = get_user_history(user_id, limit=5)
-        history_text = format_game_history(history_items)
-        message += history_text
+    Returns:
+        str: A formatted leaderboard message
+    """
+    lines = [f"<b>🏆 HALL OF LEGENDS: {LEADERBOARD_TITLES[metric]} 🏆</b>\n"]
+    
+    if not entries:
+        lines.append("<i>The hall stands empty! Battle now to carve your name in history!</i>")
+        return "\n".join(lines)
+    
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    for rank, user_id, username, score in entries:
+        medal = medals.get(rank, f"{rank}.")
+        lines.append(f"{medal} <b>{username}</b> - {_format_score(metric, score)}")
+    
+    return "\n".join(lines)
+
+def rank_message(username, ranks):
+    """
+    Generate a message with a player's position on every leaderboard
+    
+    Args:
+        username (str): The player's name
+        ranks (dict): metric -> (rank, players_ranked, score) or None
         
-    return message
+    Returns:
+        str: A formatted rank message
+    """
+    lines = [f"<b>🎖️ RANKINGS OF {username.upper()} 🎖️</b>\n"]
+    
+    for metric, title in LEADERBOARD_TITLES.items():
+        entry = ranks.get(metric)
+        if entry is None:
+            lines.append(f"<b>{title}:</b> <i>Unranked</i>")
+        else:
+            rank, total, score = entry
+            lines.append(f"<b>{title}:</b> #{rank} of {total} ({_format_score(metric, score)})")
+    
+    lines.append("\n<i>Every battle brings you closer to the summit!</i>")
+    return "\n".join(lines)
 
 # Multiplayer game messages
 def create_multiplayer_game_message(creator_name):
@@ -390,11 +496,11 @@ def create_multiplayer_game_message(creator_name):
 Use /join to accept the challenge and prove your worth!
     """
 
+@profiler.traced('render')
 def multiplayer_game_status(game):
-    players = game.get_players_string()
+    # Players and total bets are only re-rendered when the game changes
+    players, total_bets = game.summary()
     
-    # Calculate total bets for the game
-    total_bets = sum(player_data.get("bet", 0) for player_id, player_data in game.players.items())
     betting_info = f"\n\n💰 <b>TREASURY POOL:</b> {total_bets} coins" if total_bets > 0 else ""
     
     # Calculate timer information for games that aren't started yet
@@ -435,15 +541,16 @@ Use /join to enter the arena!</i>
     
     return message
 
-def multiplayer_result_message(results, game):
+@profiler.traced('render')
+def multiplayer_result_message(settlement):
     message = f"🏆 <b>BATTLE CONCLUDED!</b> 🏆\n\n"
     
     # Show all player choices and bets
-    message += "<b>WARRIOR CHOICES:</b>\n"
-    for player_id, choice_data in results["choices"].items():
-        player_name = choice_data["name"]
-        choice = choice_data["choice"]
-        bet_amount = game.players[player_id].get("bet", 0)
+    lines = ["<b>WARRIOR CHOICES:</b>"]
+    for outcome in settlement.outcomes:
+        choice = outcome.choice
+        if not choice:
+            continue
         
         if choice == "rock":
             emoji = "🪨"
@@ -453,66 +560,46 @@ def multiplayer_result_message(results, game):
             emoji = "✂️"
         
         # Add bet information if any
-        bet_info = f" [BET: {bet_amount} coins]" if bet_amount > 0 else ""
-        message += f"{player_name}: {choice.upper()} {emoji}{bet_info}\n"
-    
-    message += "\n"
+        bet_info = f" [BET: {outcome.bet} coins]" if outcome.bet > 0 else ""
+        lines.append(f"{outcome.name}: {choice.upper()} {emoji}{bet_info}")
+    message += "\n".join(lines) + "\n\n"
     
     # Show winners and their winnings
-    if results["winners"]:
-        winner_names = [game.players[player_id]["name"] for player_id in results["winners"]]
-        if len(winner_names) == 1:
-            message += f"🌟 <b>CHAMPION OF THE ARENA:</b> {winner_names[0]} 🌟\n"
+    if settlement.winners:
+        if len(settlement.winners) == 1:
+            message += f"🌟 <b>CHAMPION OF THE ARENA:</b> {settlement.winners[0].name} 🌟\n"
         else:
-            winners_text = ", ".join(winner_names)
+            winners_text = ", ".join(outcome.name for outcome in settlement.winners)
             message += f"🌟 <b>VICTORIOUS ALLIANCE:</b> {winners_text} 🌟\n"
         
         # Show betting results if there were any bets
-        total_bets = sum(game.players[player_id].get("bet", 0) for player_id in game.players)
-        if total_bets > 0:
-            message += "\n💰 <b>TREASURY RESULTS:</b>\n"
-            
-            # Calculate losers' total bets
-            loser_bet_total = sum(game.players[loser_id].get("bet", 0) 
-                              for loser_id in game.players 
-                              if loser_id not in results["winners"] and loser_id not in results["tied"])
+        if settlement.total_bets > 0:
+            lines = ["", "💰 <b>TREASURY RESULTS:</b>"]
             
             # Show each winner and their winnings
-            for winner_id in results["winners"]:
-                winner_name = game.players[winner_id]["name"]
-                winner_bet = game.players[winner_id].get("bet", 0)
-                
-                if winner_bet > 0:
-                    # Calculate their share of the pot based on their bet
-                    winner_bet_total = sum(game.players[w_id].get("bet", 0) for w_id in results["winners"])
-                    winner_share = winner_bet / winner_bet_total if winner_bet_total > 0 else 0
-                    winnings = int(loser_bet_total * winner_share) + 10  # +10 is the base win reward
-                    message += f"{winner_name} gains {winnings} coins (bet: {winner_bet})\n"
+            for outcome in settlement.winners:
+                if outcome.bet > 0:
+                    lines.append(f"{outcome.name} gains {outcome.currency_change} coins (bet: {outcome.bet})")
                 else:
-                    message += f"{winner_name} gains 5 coins (no bet placed)\n"
+                    lines.append(f"{outcome.name} gains {outcome.currency_change} coins (no bet placed)")
             
             # Show losers
-            for loser_id in game.players:
-                if loser_id not in results["winners"] and loser_id not in results["tied"]:
-                    loser_name = game.players[loser_id]["name"]
-                    loser_bet = game.players[loser_id].get("bet", 0)
-                    if loser_bet > 0:
-                        message += f"{loser_name} loses {loser_bet} coins\n"
+            for outcome in settlement.losers:
+                if outcome.bet > 0:
+                    lines.append(f"{outcome.name} loses {outcome.bet} coins")
+            message += "\n".join(lines) + "\n"
     
     # Show tied players if any
-    if results["tied"] and len(results["tied"]) == len(game.players):
+    if settlement.tied and settlement.everyone_tied:
         message += "\n⚖️ <b>COSMIC STANDOFF!</b> All warriors have reached perfect equilibrium! ⚖️"
-    elif results["tied"]:
-        tied_names = [game.players[player_id]["name"] for player_id in results["tied"]]
-        tied_text = ", ".join(tied_names)
+    elif settlement.tied:
+        tied_text = ", ".join(outcome.name for outcome in settlement.tied)
         message += f"\n⚖️ <b>BALANCED FORCES:</b> {tied_text} ⚖️"
         
         # Show that tied players keep their bets
-        for tied_id in results["tied"]:
-            tied_bet = game.players[tied_id].get("bet", 0)
-            if tied_bet > 0:
-                tied_name = game.players[tied_id]["name"]
-                message += f"\n{tied_name} keeps their bet of {tied_bet} coins"
+        for outcome in settlement.tied:
+            if outcome.bet > 0:
+                message += f"\n{outcome.name} keeps their bet of {outcome.bet} coins"
     
     message += "\n\n<i>The arena awaits new challengers! Use /multiplayer to create a new battle.</i>"
     
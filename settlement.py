@@ -0,0 +1,138 @@
+from typing import Dict, List, Optional
+
+# The move each move beats
+BEATS = {'rock': 'scissors', 'paper': 'rock', 'scissors': 'paper'}
+
+# Coins every player starts with
+STARTING_BALANCE = 100
+
+# Coins a winner gets on top of their share of the losers' bets
+WIN_REWARD = 10
+# Coins a winner who didn't bet gets
+WIN_REWARD_NO_BET = 5
+
+# Opponents named in each player's history; bigger games list these and count the rest
+MAX_LISTED_OPPONENTS = 5
+
+
+class PlayerOutcome:
+    """How a multiplayer game ended for one player."""
+
+    __slots__ = ('user_id', 'name', 'choice', 'bet', 'result', 'currency_change')
+
+    def __init__(self, user_id: int, name: str, choice: Optional[str], bet: int):
+        self.user_id = user_id
+        self.name = name
+        self.choice = choice
+        self.bet = bet
+        self.result = 'draw'
+        self.currency_change = 0
+
+
+class Settlement:
+    """
+    Outcome, payout and stats of every player of a finished multiplayer game.
+
+    Built in O(players) by settle(), then shared by the payout code and the
+    result message, so neither needs to rescan the players.
+    """
+
+    def __init__(self, outcomes: List[PlayerOutcome], move_counts: Dict[str, int],
+                 winning_choice: Optional[str]):
+        self.outcomes = outcomes
+        self.move_counts = move_counts
+        self.winning_choice = winning_choice
+        self.winners = [o for o in outcomes if o.result == 'win']
+        self.losers = [o for o in outcomes if o.result == 'lose']
+        self.tied = [o for o in outcomes if o.result == 'draw']
+        self.winner_bet_total = sum(o.bet for o in self.winners)
+        self.loser_bet_total = sum(o.bet for o in self.losers)
+        self.total_bets = self.winner_bet_total + self.loser_bet_total + sum(o.bet for o in self.tied)
+        # Enough players to name MAX_LISTED_OPPONENTS others for anyone
+        self._listed = outcomes[:MAX_LISTED_OPPONENTS + 1]
+
+    @property
+    def everyone_tied(self) -> bool:
+        return len(self.tied) == len(self.outcomes)
+
+    def _listed_opponents(self, outcome: PlayerOutcome) -> List[PlayerOutcome]:
+        return [o for o in self._listed if o is not outcome][:MAX_LISTED_OPPONENTS]
+
+    def opponents_of(self, outcome: PlayerOutcome) -> str:
+        """A player's opponents for their history: their names, or the first few and a count."""
+        listed = self._listed_opponents(outcome)
+        names = ", ".join(o.name for o in listed)
+        hidden = len(self.outcomes) - 1 - len(listed)
+        if hidden > 0:
+            names += f" and {hidden} others"
+        return names
+
+    def opponent_choices_of(self, outcome: PlayerOutcome) -> str:
+        """The opponents' moves, in the same order as opponents_of(), or counted per move for big games."""
+        if len(self.outcomes) - 1 <= MAX_LISTED_OPPONENTS:
+            return ", ".join(o.choice for o in self._listed_opponents(outcome) if o.choice)
+        counts = dict(self.move_counts)
+        if outcome.choice:
+            counts[outcome.choice] -= 1
+        return ", ".join(f"{count} {move}" for move, count in counts.items() if count)
+
+    def as_results(self) -> Dict:
+        """The results in the dict form returned by MultiplayerGame.get_results()."""
+        return {
+            "players": len(self.outcomes),
+            "choices": {o.user_id: {"name": o.name, "choice": o.choice} for o in self.outcomes if o.choice},
+            "winners": [o.user_id for o in self.winners],
+            "losers": [o.user_id for o in self.losers],
+            "tied": [o.user_id for o in self.tied],
+        }
+
+
+def settle(players: Dict[int, Dict]) -> Settlement:
+    """
+    Resolve a multiplayer game
+
+    With exactly two different moves on the table, everyone who played the
+    stronger one wins and everyone else loses. One move, or all three, is a draw
+    for everybody. Winners who bet split the losers' bets in proportion to their
+    own bets and get WIN_REWARD on top; winners who didn't bet get WIN_REWARD_NO_BET.
+    Losers lose their bet. Players who didn't choose a move draw.
+
+    Args:
+        players (dict): The game's players, user_id -> {name, choice, bet}
+
+    Returns:
+        Settlement: Everyone's outcome, in seat order
+    """
+    outcomes = []
+    move_counts = {'rock': 0, 'paper': 0, 'scissors': 0}
+    move_bets = {'rock': 0, 'paper': 0, 'scissors': 0}
+    for user_id, player in players.items():
+        choice = player["choice"]
+        bet = player.get("bet", 0)
+        outcomes.append(PlayerOutcome(user_id, player["name"], choice, bet))
+        if choice:
+            move_counts[choice] += 1
+            move_bets[choice] += bet
+
+    played = [move for move, count in move_counts.items() if count]
+    winning_choice = None
+    if len(played) == 2:
+        first, second = played
+        winning_choice = first if BEATS[first] == second else second
+
+    if winning_choice is not None:
+        losing_choice = BEATS[winning_choice]
+        winner_bets = move_bets[winning_choice]
+        loser_bets = move_bets[losing_choice]
+        for outcome in outcomes:
+            if outcome.choice == winning_choice:
+                outcome.result = 'win'
+                if outcome.bet > 0:
+                    outcome.currency_change = loser_bets * outcome.bet // winner_bets + WIN_REWARD
+                else:
+                    outcome.currency_change = WIN_REWARD_NO_BET
+            elif outcome.choice == losing_choice:
+                outcome.result = 'lose'
+                outcome.currency_change = -outcome.bet
+
+    return Settlement(outcomes, move_counts, winning_choice)
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import fcntl
+import signal
+import asyncio
+import logging
+import multiprocessing
+from typing import Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, TelegramError
+
+from chat_locks import game_chat_from_callback
+
+logger = logging.getLogger(__name__)
+
+# Worker processes to spread chats over; 1 runs everything in a single process as before
+BOT_SHARDS = int(os.environ.get("BOT_SHARDS", "1"))
+
+# Seconds a long-poll getUpdates waits for new updates
+POLL_TIMEOUT = int(os.environ.get("SHARD_POLL_TIMEOUT", "30"))
+
+# Held while the shards run, so a second front process can't start another set next to them
+SHARDS_LOCK_PATH = os.environ.get("BOT_SHARDS_LOCK", os.path.join(os.environ.get("STATS_DATA_DIR", "data"),
+                                                                   "shards.lock"))
+
+# Update fields that carry a message-like object with a chat (and usually a sender)
+_UPDATE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                  'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def update_shard_key(data: Dict) -> int:
+    """
+    The ID that decides which shard handles a raw update: the chat it belongs to.
+
+    Bet and move buttons are pressed in private chats but change a game in a group,
+    so they go to the group's shard (their callback data names it). Updates without
+    a chat go by user.
+    """
+    query = data.get('callback_query')
+    if query is not None:
+        game_chat = game_chat_from_callback(query.get('data'))
+        if game_chat is not None:
+            return game_chat
+        message = query.get('message')
+        if message and 'chat' in message:
+            return message['chat']['id']
+        return query['from']['id']
+
+    for field in _UPDATE_FIELDS:
+        value = data.get(field)
+        if value is not None:
+            return value['chat']['id']
+
+    # Inline queries, polls and the like: whoever sent them, if anyone
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+    return 0
+
+
+def shard_for_update(data: Dict, shards: int) -> int:
+    """The index of the shard that handles a raw update."""
+    return update_shard_key(data) % shards
+
+
+def _worker_main(index: int, shards: int, inbox) -> None:
+    """Entry point of a worker process: run the bot on the updates routed to this shard."""
+    # The front process coordinates shutdown; don't let Ctrl+C in a terminal kill workers halfway
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from bot import create_application
+    from storage import create_backend
+    from outbound import GLOBAL_RATE, get_outbound_scheduler
+
+    backend = create_backend('shared')
+    if index != 0:
+        # The first shard keeps the shared log compact for everyone
+        backend.snapshot_every = 0
+    application = create_application(backend)
+    if not application:
+        return
+
+    # The global message limit applies to the bot as a whole; group and private limits are per chat,
+    # and every chat lives on one shard
+    get_outbound_scheduler(application.bot, global_rate=GLOBAL_RATE / shards)
+
+    logger.info(f"Shard {index + 1}/{shards} started (pid {os.getpid()})")
+    asyncio.run(_serve_shard(application, inbox))
+
+
+async def _serve_shard(application, inbox) -> None:
+    from stats import close_persistence
+
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except Exception as e:
+                logger.error(f"Invalid update routed to shard: {e}")
+                continue
+            await application.update_queue.put(update)
+    finally:
+        await application.stop()
+        # Run the post_stop hook like run_polling() does (it flushes queued messages)
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        close_persistence()
+
+
+class ShardedRuntime:
+    """
+    Worker processes that each run the bot for a slice of the chats.
+
+    dispatch() routes every update by its chat ID (see update_shard_key), so all
+    updates of a chat, including the bet and move buttons of its game, reach the
+    same worker, in order. Each worker keeps its own games, conversations and
+    outgoing message queue. Stats and wallets go to a log shared by all workers
+    (STATS_SHARED_PATH) and every worker catches up with the others once per
+    tick, so stats read in one chat can lag games played on other shards by
+    about STATS_COMMIT_INTERVAL.
+
+    Processes forked after start() share the workers' inboxes, so web server
+    workers forked from the process that started the shards (gunicorn --preload)
+    can all dispatch() updates. Only the process that started them stops them.
+    """
+
+    def __init__(self, shards: int, lock_path: str = SHARDS_LOCK_PATH):
+        self.shards = shards
+        self.lock_path = lock_path
+        self._context = multiprocessing.get_context('spawn')
+        self._inboxes = []
+        self._processes: List[multiprocessing.Process] = []
+        self._owner: Optional[int] = None
+        self._lock = None
+
+    def start(self) -> None:
+        """Start the workers. Raises RuntimeError if another process is already running shards."""
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        lock = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise RuntimeError(f"Bot shards are already running ({self.lock_path} is locked); web servers "
+                               f"with several workers must start them once, with gunicorn --preload")
+        self._lock = lock
+        self._owner = os.getpid()
+        os.register_at_fork(after_in_child=self._after_fork)
+        for index in range(self.shards):
+            inbox = self._context.Queue()
+            process = self._context.Process(target=_worker_main, args=(index, self.shards, inbox),
+                                            name=f"bot-shard-{index}", daemon=True)
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        logger.info(f"Started {self.shards} bot shards")
+
+    def _after_fork(self) -> None:
+        # The workers are children of the process that started them. multiprocessing
+        # terminates the children it knows of when a process exits, so a forked web
+        # server worker must forget them or its exit would take every shard down.
+        for process in self._processes:
+            multiprocessing.process._children.discard(process)
+
+    def dispatch(self, data: Dict) -> int:
+        """Hand a raw update (as received from Telegram) to its shard. Returns the shard index."""
+        index = shard_for_update(data, self.shards)
+        self._inboxes[index].put(data)
+        return index
+
+    def stop(self, timeout: float = 30) -> None:
+        """Let every worker finish its queued updates and messages, then wait for it to exit."""
+        if self._owner != os.getpid():
+            # A forked web server worker exiting; the workers belong to the process that started them
+            self._inboxes = []
+            self._processes = []
+            return
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, terminating it")
+                process.terminate()
+        self._inboxes = []
+        self._processes = []
+        self._lock.close()
+        self._lock = None
+        self._owner = None
+
+
+def create_front_bot() -> Bot:
+    """A plain Bot for the front process, which only receives updates."""
+    from bot import TELEGRAM_TOKEN, TELEGRAM_API_URL
+    if TELEGRAM_API_URL:
+        return Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL.rstrip("/") + "/bot")
+    return Bot(TELEGRAM_TOKEN)
+
+
+async def poll_updates(runtime: ShardedRuntime, bot: Bot) -> None:
+    """Long-poll Telegram for updates and route them to the shards."""
+    offset: Optional[int] = None
+    async with bot:
+        await bot.delete_webhook()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                                allowed_updates=Update.ALL_TYPES)
+            except NetworkError as e:
+                logger.warning(f"Error fetching updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            except TelegramError as e:
+                logger.error(f"Error fetching updates: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                runtime.dispatch(update.to_dict())
+                offset = update.update_id + 1
+
+
+def run_sharded_bot(shards: int = BOT_SHARDS) -> None:
+    """Run the bot as a polling front process plus one worker process per shard."""
+    from bot import TELEGRAM_TOKEN
+    if not TELEGRAM_TOKEN:
+        logger.error("No Telegram token provided. Please set the TELEGRAM_TOKEN environment variable.")
+        return
+
+    # Shut the workers down cleanly when the process manager stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    runtime = ShardedRuntime(shards)
+    runtime.start()
+    logger.info(f"Starting Telegram Bot with {shards} shards")
+    try:
+        asyncio.run(poll_updates(runtime, create_front_bot()))
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Stopping bot shards")
+    finally:
+        runtime.stop()
+
+
+def dispatch_raw_update(runtime: ShardedRuntime, body: bytes) -> bool:
+    """Route an update body posted to the webhook. Returns False if it couldn't be parsed."""
+    try:
+        data = json.loads(body)
+        runtime.dispatch(data)
+    except Exception as e:
+        logger.error(f"Invalid update received on webhook: {e}")
+        return False
+    return True
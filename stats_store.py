@@ -0,0 +1,338 @@
+from array import array
+from collections.abc import Mapping
+from operator import add
+from typing import Dict, Iterator, List, Optional
+
+# Game modes with their own columns, in addition to the combined totals
+MODES = ('solo', 'multiplayer')
+
+# Compact codes for last_result columns
+RESULT_CODES = {None: -1, 'win': 0, 'lose': 1, 'draw': 2}
+RESULT_NAMES = {code: name for name, code in RESULT_CODES.items()}
+
+# Counters stored per mode; the combined wins/losses/draws/total_games are the sums over modes
+MODE_COUNTERS = ('wins', 'losses', 'draws')
+# Streak columns stored for each mode and for the combined stats
+STREAK_FIELDS = ('current_streak', 'best_streak')
+
+# Keys exposed by the dict-like views, in the same order as the original nested dicts
+MODE_KEYS = ('wins', 'losses', 'draws', 'total_games', 'current_streak',
+             'best_streak', 'last_result', 'win_percentage')
+USER_KEYS = ('username', 'user_id') + MODE_KEYS + MODES
+
+DEFAULT_USERNAME = 'Player'
+
+
+def _win_percentage(wins: int, total_games: int) -> float:
+    return round((wins / total_games) * 100, 1) if total_games > 0 else 0.0
+
+
+class StatsStore(Mapping):
+    """
+    Column-oriented store for every user's statistics.
+
+    Each user gets a dense row number, and every statistic lives in a typed array
+    indexed by that row (int32 counters and streaks, int8 result codes), so a user
+    costs a few dozen bytes instead of three nested dicts. Looking up a user that
+    has never played doesn't allocate a row. Indexing the store by user_id returns
+    a UserStatsView, which reads like the nested dict the rest of the bot expects.
+    """
+
+    def __init__(self):
+        self._rows: Dict[int, int] = {}  # user_id -> row
+        self.user_ids = array('q')
+        self.usernames: List[str] = []
+        self.columns: Dict[str, Dict[str, array]] = {
+            mode: dict(
+                [(field, array('i')) for field in MODE_COUNTERS + STREAK_FIELDS] +
+                [('last_result', array('b'))]
+            )
+            for mode in MODES
+        }
+        self.columns['combined'] = dict(
+            [(field, array('i')) for field in STREAK_FIELDS] +
+            [('last_result', array('b'))]
+        )
+
+    # ------------------------------------------------------------------
+    # Mapping interface (user_id -> UserStatsView)
+    # ------------------------------------------------------------------
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._rows)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._rows
+
+    def __getitem__(self, user_id) -> 'UserStatsView':
+        return UserStatsView(self, user_id, self._rows[user_id])
+
+    def view(self, user_id: int) -> 'UserStatsView':
+        """A view of a user's stats, with all-zero stats if they have never played."""
+        return UserStatsView(self, user_id, self._rows.get(user_id))
+
+    # ------------------------------------------------------------------
+    # Rows
+    # ------------------------------------------------------------------
+    def row_of(self, user_id: int) -> Optional[int]:
+        return self._rows.get(user_id)
+
+    def ensure_row(self, user_id: int) -> int:
+        """Return the user's row, allocating a zeroed one if needed."""
+        row = self._rows.get(user_id)
+        if row is not None:
+            return row
+        row = len(self.user_ids)
+        self._rows[user_id] = row
+        self.user_ids.append(user_id)
+        self.usernames.append(DEFAULT_USERNAME)
+        for columns in self.columns.values():
+            for name, column in columns.items():
+                column.append(-1 if name == 'last_result' else 0)
+        return row
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def copy(self) -> 'StatsStore':
+        """An independent copy; the columns are copied as whole arrays, so this is cheap even for many users."""
+        copied = StatsStore.__new__(StatsStore)
+        copied._rows = self._rows.copy()
+        copied.user_ids = self.user_ids[:]
+        copied.usernames = self.usernames[:]
+        copied.columns = {name: {field: column[:] for field, column in columns.items()}
+                          for name, columns in self.columns.items()}
+        return copied
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+    def record_result(self, user_id: int, username: str, mode: str, result: str) -> int:
+        """
+        Apply one game result to a user's combined and mode-specific stats
+
+        Returns:
+            int: The user's row
+        """
+        row = self.ensure_row(user_id)
+        self.usernames[row] = username
+        win_code = RESULT_CODES['win']
+        result_code = RESULT_CODES.get(result, RESULT_CODES['draw'])
+
+        mode_columns = self.columns[mode]
+        if result == 'win':
+            mode_columns['wins'][row] += 1
+        elif result == 'lose':
+            mode_columns['losses'][row] += 1
+        else:
+            mode_columns['draws'][row] += 1
+
+        # Streaks are tracked separately for the combined stats and each mode
+        for columns in (self.columns['combined'], mode_columns):
+            if result == 'win':
+                if columns['last_result'][row] == win_code:
+                    columns['current_streak'][row] += 1
+                else:
+                    columns['current_streak'][row] = 1
+                if columns['current_streak'][row] > columns['best_streak'][row]:
+                    columns['best_streak'][row] = columns['current_streak'][row]
+            else:
+                columns['current_streak'][row] = 0
+            columns['last_result'][row] = result_code
+
+        return row
+
+    # ------------------------------------------------------------------
+    # Conversion to and from the original nested dict format
+    # ------------------------------------------------------------------
+    def to_dict(self, user_id: int) -> Dict:
+        """A user's stats as the original nested dict."""
+        view = self.view(user_id)
+        record = {key: view[key] for key in USER_KEYS if key not in MODES}
+        for mode in MODES:
+            record[mode] = dict(view[mode].items())
+        return record
+
+    def import_dict(self, user_id: int, record: Dict) -> None:
+        """Load a user's stats from the original nested dict format."""
+        row = self.ensure_row(user_id)
+        self.usernames[row] = record.get('username', DEFAULT_USERNAME)
+        for mode in MODES:
+            mode_record = record.get(mode, {})
+            for field in MODE_COUNTERS + STREAK_FIELDS:
+                self.columns[mode][field][row] = mode_record.get(field, 0)
+            self.columns[mode]['last_result'][row] = RESULT_CODES.get(mode_record.get('last_result'), -1)
+        for field in STREAK_FIELDS:
+            self.columns['combined'][field][row] = record.get(field, 0)
+        self.columns['combined']['last_result'][row] = RESULT_CODES.get(record.get('last_result'), -1)
+
+    def load(self, saved) -> None:
+        """Replace the contents with a saved StatsStore or a {user_id: nested dict} mapping."""
+        if isinstance(saved, StatsStore):
+            self.__dict__.update(saved.__dict__)
+            # Stores saved before the counters were narrowed to int32 hold 'l' arrays
+            for columns in self.columns.values():
+                for field, values in columns.items():
+                    if values.typecode == 'l':
+                        columns[field] = array('i', values)
+            return
+        self.clear()
+        for user_id, record in saved.items():
+            self.import_dict(user_id, record)
+
+    # ------------------------------------------------------------------
+    # Aggregates
+    # ------------------------------------------------------------------
+    def column(self, field: str, mode: Optional[str] = None) -> array:
+        """
+        The column holding a statistic for every row
+
+        Stored columns are returned as they are, not copied, so don't modify them.
+        Combined wins/losses/draws and total_games aren't stored; those are built by
+        chaining map(operator.add) over the stored columns, so the sum never calls back into
+        Python and is built in a single pass.
+        """
+        if field == 'total_games':
+            counters = [self.columns[m][counter] for m in ([mode] if mode else MODES)
+                        for counter in MODE_COUNTERS]
+        elif mode is None and field in MODE_COUNTERS:
+            counters = [self.columns[m][field] for m in MODES]
+        else:
+            return self.columns[mode or 'combined'][field]
+        total = iter(counters[0])
+        for counter in counters[1:]:
+            total = map(add, total, counter)
+        return array('q', total)
+
+    def totals(self, mode: Optional[str] = None) -> Dict[str, int]:
+        """Sum of wins, losses, draws and total games across all users."""
+        modes = [mode] if mode else MODES
+        totals = {field: sum(sum(self.columns[m][field]) for m in modes) for field in MODE_COUNTERS}
+        totals['total_games'] = totals['wins'] + totals['losses'] + totals['draws']
+        return totals
+
+    def to_columns(self) -> Dict[str, object]:
+        """The whole store as named columns, for event_log.encode_columns."""
+        columns: Dict[str, object] = {'user_ids': self.user_ids, 'usernames': self.usernames}
+        for name, fields in self.columns.items():
+            for field, values in fields.items():
+                columns[f'{name}.{field}'] = values
+        return columns
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, object]) -> 'StatsStore':
+        """Rebuild a store from to_columns() output; columns it lacks start out zeroed."""
+        store = cls()
+        store.user_ids = columns['user_ids']
+        store.usernames = columns['usernames']
+        rows = len(store.user_ids)
+        store._rows = dict(zip(store.user_ids, range(rows)))
+        for name, fields in store.columns.items():
+            for field, empty in fields.items():
+                saved = columns.get(f'{name}.{field}')
+                if saved is None:
+                    saved = array(empty.typecode, [-1 if field == 'last_result' else 0]) * rows
+                elif saved.typecode != empty.typecode:
+                    saved = array(empty.typecode, saved)
+                fields[field] = saved
+        return store
+
+
+class ModeStatsView(Mapping):
+    """Read-only dict-like view of one mode's stats for one user."""
+
+    __slots__ = ('_store', '_row', '_mode')
+
+    def __init__(self, store: StatsStore, row: Optional[int], mode: str):
+        self._store = store
+        self._row = row
+        self._mode = mode
+
+    def __len__(self) -> int:
+        return len(MODE_KEYS)
+
+    def __iter__(self):
+        return iter(MODE_KEYS)
+
+    def __getitem__(self, key):
+        row = self._row
+        if key not in MODE_KEYS:
+            raise KeyError(key)
+        if row is None:
+            return None if key == 'last_result' else (0.0 if key == 'win_percentage' else 0)
+
+        columns = self._store.columns[self._mode]
+        if key in ('total_games', 'win_percentage'):
+            total = columns['wins'][row] + columns['losses'][row] + columns['draws'][row]
+            if key == 'total_games':
+                return total
+            return _win_percentage(columns['wins'][row], total)
+        if key == 'last_result':
+            return RESULT_NAMES[columns['last_result'][row]]
+        return columns[key][row]
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+class UserStatsView(Mapping):
+    """
+    Read-only dict-like view of a user's stats.
+
+    Supports the same keys as the original nested dict: combined counters at the
+    top level, and 'solo' / 'multiplayer' returning a ModeStatsView.
+    """
+
+    __slots__ = ('_store', '_user_id', '_row')
+
+    def __init__(self, store: StatsStore, user_id: int, row: Optional[int]):
+        self._store = store
+        self._user_id = user_id
+        self._row = row
+
+    def __len__(self) -> int:
+        return len(USER_KEYS)
+
+    def __iter__(self):
+        return iter(USER_KEYS)
+
+    def __getitem__(self, key):
+        store = self._store
+        row = self._row
+        if key == 'user_id':
+            return self._user_id
+        if key == 'username':
+            return store.usernames[row] if row is not None else DEFAULT_USERNAME
+        if key in MODES:
+            return ModeStatsView(store, row, key)
+        if key not in MODE_KEYS:
+            raise KeyError(key)
+        if row is None:
+            return None if key == 'last_result' else (0.0 if key == 'win_percentage' else 0)
+
+        if key in STREAK_FIELDS:
+            return store.columns['combined'][key][row]
+        if key == 'last_result':
+            return RESULT_NAMES[store.columns['combined']['last_result'][row]]
+        if key in MODE_COUNTERS:
+            return sum(store.columns[mode][key][row] for mode in MODES)
+
+        wins = sum(store.columns[mode]['wins'][row] for mode in MODES)
+        total = sum(store.columns[mode][counter][row] for mode in MODES for counter in MODE_COUNTERS)
+        if key == 'total_games':
+            return total
+        return _win_percentage(wins, total)
+
+    @property
+    def version(self) -> int:
+        """Changes whenever the user's counters or history do: the number of games they've played."""
+        row = self._row
+        if row is None:
+            return 0
+        store = self._store
+        return sum(store.columns[mode][counter][row] for mode in MODES for counter in MODE_COUNTERS)
+
+    def __repr__(self) -> str:
+        return repr(self._store.to_dict(self._user_id))
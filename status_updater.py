@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from outbound import NOT_SENT, PRIORITY_STATUS, OutboundScheduler
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two status updates of the same game; changes in between are sent together
+STATUS_UPDATE_WINDOW = float(os.environ.get("STATUS_UPDATE_WINDOW", "1.5"))
+
+# Chats whose last update went out more than a window ago are forgotten; checked this often
+_SWEEP_INTERVAL = 60.0
+
+
+class _ChatStatus:
+    """The status message of one chat's game: its latest update and when it last went out."""
+
+    __slots__ = ('call', 'timer', 'queued', 'last_sent', 'discarded', 'requested', 'coalesced')
+
+    def __init__(self):
+        self.call: Optional[Callable[..., Awaitable]] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.queued = False        # An update is in the outbound queue and hasn't run yet
+        self.last_sent = float('-inf')
+        self.discarded = False
+        self.requested = 0
+        self.coalesced = 0
+
+
+class StatusUpdater:
+    """
+    Coalesces the group status updates of each game into at most one per window.
+
+    The first change after a quiet window goes out right away. Changes made while
+    an update is waiting, either for the window to pass or in the outbound queue,
+    only replace the update to make: the status is rendered when it's sent, so one
+    edit shows all of them. flush() sends a waiting update immediately, for when a
+    game ends; discard() drops it, for when the status message has been replaced.
+    Chats with nothing waiting whose window has passed are swept away every so often,
+    so games that end without a flush() don't leave their chat behind.
+    """
+
+    def __init__(self, outbound: OutboundScheduler, window: float = STATUS_UPDATE_WINDOW):
+        self.outbound = outbound
+        self.window = window
+        self._chats: Dict[int, _ChatStatus] = {}
+        self._last_sweep = time.monotonic()
+
+        self.requested = 0
+        self.coalesced = 0
+
+    def request(self, chat_id: int, call: Callable[..., Awaitable]) -> None:
+        """Ask for call(bot) to update chat_id's status message, as soon as the window allows."""
+        now = time.monotonic()
+        if now - self._last_sweep > _SWEEP_INTERVAL:
+            self._sweep(now)
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatStatus()
+        state.call = call
+        state.requested += 1
+        self.requested += 1
+        if state.queued or state.timer is not None:
+            # The waiting update will render this change too
+            state.coalesced += 1
+            self.coalesced += 1
+            return
+
+        wait = state.last_sent + self.window - now
+        if wait > 0:
+            state.timer = asyncio.get_running_loop().call_later(wait, self._submit, chat_id, state)
+        else:
+            self._submit(chat_id, state)
+
+    def flush(self, chat_id: int) -> None:
+        """Send chat_id's waiting update now, and forget the chat once it has gone out."""
+        state = self._chats.pop(chat_id, None)
+        if state is None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+            self._submit(chat_id, state)
+        if state.coalesced:
+            logger.debug(f"Status of chat {chat_id}: {state.requested} changes sent in "
+                         f"{state.requested - state.coalesced} updates")
+
+    def flush_all(self) -> None:
+        """Send every waiting update now (before shutting down)."""
+        for chat_id in list(self._chats):
+            self.flush(chat_id)
+
+    def discard(self, chat_id: int) -> None:
+        """Drop chat_id's waiting update, including one already in the outbound queue."""
+        state = self._chats.pop(chat_id, None)
+        if state is None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+        state.discarded = True
+
+    def _sweep(self, now: float) -> None:
+        """Forget chats with no update waiting whose last one went out over a window ago."""
+        self._last_sweep = now
+        idle = [chat_id for chat_id, state in self._chats.items()
+                if not state.queued and state.timer is None and now - state.last_sent >= self.window]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def _submit(self, chat_id: int, state: _ChatStatus) -> None:
+        state.timer = None
+        state.queued = True
+
+        async def update(bot):
+            if state.discarded:
+                return NOT_SENT
+            state.queued = False
+            state.last_sent = time.monotonic()
+            # The latest request, which may have come in while this one was queued
+            return await state.call(bot)
+
+        self.outbound.submit(chat_id, update, PRIORITY_STATUS, method='editMessageText')
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'requested': self.requested,
+            'coalesced': self.coalesced,
+            'chats': len(self._chats),
+            'waiting': sum(1 for state in self._chats.values() if state.timer is not None or state.queued),
+        }
+
+
+# One updater per scheduler, so every status edit queued on it is coalesced in one place
+_updaters: Dict[int, StatusUpdater] = {}
+
+def get_status_updater(outbound: OutboundScheduler, **options) -> StatusUpdater:
+    """Get the status updater that feeds an outbound scheduler, creating it with options on first use."""
+    updater = _updaters.get(id(outbound))
+    if updater is None or updater.outbound is not outbound:
+        updater = _updaters[id(outbound)] = StatusUpdater(outbound, **options)
+    return updater
@@ -0,0 +1,334 @@
+import os
+import time
+import random
+import logging
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Moves as small ints; the move that beats m is (m + 1) % 3
+MOVES = ('rock', 'paper', 'scissors')
+MOVE_CODES = {name: code for code, name in enumerate(MOVES)}
+COUNTER = (1, 2, 0)
+
+# Outcome for the bot, indexed by bot_move * 3 + user_move: 0 win, 1 lose, 2 draw
+_BOT_OUTCOME = (2, 1, 0,
+                0, 2, 1,
+                1, 0, 2)
+
+# Strategy the solo opponent plays: 'random' (the default), or the adaptive 'frequency' or 'markov'
+SOLO_STRATEGY = os.environ.get("SOLO_STRATEGY", "random").lower()
+# Share of rounds the adaptive strategies play a random move anyway, so they can't be gamed
+STRATEGY_EXPLORATION = float(os.environ.get("SOLO_STRATEGY_EXPLORATION", "0.1"))
+# Memory the per-user models may take in total; the least recently active users are forgotten first
+STRATEGY_MEMORY_BUDGET = int(os.environ.get("SOLO_STRATEGY_MEMORY_BUDGET", str(4 * 1024 * 1024)))
+
+# Layout of a user's model: last move + 1 (0 before the first move), how often each
+# move was played, then how often each move followed each move (row = previous move)
+_LAST = 0
+_COUNTS = 1
+_TRANSITIONS = 4
+MODEL_SIZE = 13
+
+# Counts are single bytes; a row is halved when one of them fills up, which also
+# lets a player's recent habits outweigh old ones
+MAX_COUNT = 255
+
+# Estimated cost of a model's index entry (dict slot plus int key), on top of its bytes
+_INDEX_BYTES_PER_USER = 100
+
+
+class ModelTable:
+    """
+    Fixed-size move models for many users in one bytearray, within a memory budget.
+
+    Each user gets MODEL_SIZE bytes in a shared buffer. The index keeps users in
+    least-recently-used order, and once the budget is used up the least recently
+    active user's slot is wiped and reused.
+    """
+
+    def __init__(self, memory_budget: int = STRATEGY_MEMORY_BUDGET):
+        self.capacity = max(1, memory_budget // (MODEL_SIZE + _INDEX_BYTES_PER_USER))
+        self.data = bytearray()
+        # user_id -> slot offset in data, least recently used first
+        self._slots: Dict[int, int] = {}
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def find(self, user_id: int) -> Optional[int]:
+        """The offset of a user's model, or None if the user has none."""
+        offset = self._slots.pop(user_id, None)
+        if offset is not None:
+            self._slots[user_id] = offset
+        return offset
+
+    def slot(self, user_id: int) -> int:
+        """The offset of a user's model, creating an empty one if needed."""
+        offset = self.find(user_id)
+        if offset is not None:
+            return offset
+        slots = self._slots
+        if len(slots) < self.capacity:
+            offset = len(self.data)
+            self.data.extend(bytes(MODEL_SIZE))
+        else:
+            oldest = next(iter(slots))
+            offset = slots.pop(oldest)
+            self.data[offset:offset + MODEL_SIZE] = bytes(MODEL_SIZE)
+            self.evictions += 1
+        slots[user_id] = offset
+        return offset
+
+    def record(self, user_id: int, move: int) -> None:
+        """Add a move to a user's model in O(1)."""
+        _record(self.data, self.slot(user_id), move)
+
+    def memory_bytes(self) -> int:
+        """Approximate memory taken by the models and their index."""
+        return len(self.data) + len(self._slots) * _INDEX_BYTES_PER_USER
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'users': len(self._slots),
+            'capacity': self.capacity,
+            'memory_bytes': self.memory_bytes(),
+            'evictions': self.evictions,
+        }
+
+
+def _record(data: bytearray, offset: int, move: int) -> None:
+    """Add a move to the model at offset."""
+    _bump(data, offset + _COUNTS, move)
+    last = data[offset + _LAST]
+    if last:
+        _bump(data, offset + _TRANSITIONS + (last - 1) * 3, move)
+    data[offset + _LAST] = move + 1
+
+
+def _bump(data: bytearray, row: int, move: int) -> None:
+    """Count a move in a row of three counters, halving the row when one would overflow."""
+    if data[row + move] == MAX_COUNT:
+        for i in range(row, row + 3):
+            data[i] >>= 1
+    data[row + move] += 1
+
+
+def _most_frequent(a: int, b: int, c: int) -> Optional[int]:
+    """The move with the highest count (ties go to a random one of them), or None without counts."""
+    top = max(a, b, c)
+    if not top:
+        return None
+    best = [move for move, count in enumerate((a, b, c)) if count == top]
+    return best[0] if len(best) == 1 else random.choice(best)
+
+
+class Strategy:
+    """
+    How the solo opponent picks its moves.
+
+    choose() is called before the player's move is known, then observe() with
+    the move they played. score_stream() replays a recorded sequence of a
+    player's moves against a fresh instance of the strategy.
+    """
+
+    name = 'strategy'
+
+    def choose(self, user_id: int) -> int:
+        raise NotImplementedError
+
+    def observe(self, user_id: int, move: int) -> None:
+        pass
+
+    def score_stream(self, moves: bytes) -> Tuple[int, int, int]:
+        """
+        Play a strategy against a recorded player, one move code (0-2) per byte.
+
+        Returns:
+            tuple: (bot wins, bot losses, draws)
+        """
+        replay = type(self)()
+        outcomes = [0, 0, 0]
+        for move in moves:
+            outcomes[_BOT_OUTCOME[replay.choose(0) * 3 + move]] += 1
+            replay.observe(0, move)
+        return outcomes[0], outcomes[1], outcomes[2]
+
+    def stats(self) -> Dict[str, int]:
+        return {}
+
+
+class RandomStrategy(Strategy):
+    """Uniformly random moves, whatever the player does."""
+
+    name = 'random'
+
+    def choose(self, user_id):
+        return random.randrange(3)
+
+
+class PatternStrategy(Strategy):
+    """
+    Predicts a player's next move from their model and plays the move that beats it.
+
+    Falls back to a random move without a prediction, and plays one anyway in
+    about `exploration` of the rounds.
+    """
+
+    def __init__(self, models: Optional[ModelTable] = None, exploration: float = STRATEGY_EXPLORATION):
+        self.models = models if models is not None else ModelTable()
+        self.exploration = exploration
+
+    def predict(self, data: bytearray, offset: int) -> Optional[int]:
+        raise NotImplementedError
+
+    def choose(self, user_id):
+        return self._pick(self.models.data, self.models.find(user_id))
+
+    def _pick(self, data: bytearray, offset: Optional[int]) -> int:
+        if offset is None or random.random() < self.exploration:
+            return random.randrange(3)
+        predicted = self.predict(data, offset)
+        return random.randrange(3) if predicted is None else COUNTER[predicted]
+
+    def observe(self, user_id, move):
+        self.models.record(user_id, move)
+
+    def score_stream(self, moves):
+        # The player's model alone, without a ModelTable and its LRU index; the moves
+        # are picked and the model updated exactly as for a live player
+        data = bytearray(MODEL_SIZE)
+        pick = self._pick
+        outcomes = [0, 0, 0]
+        for move in moves:
+            outcomes[_BOT_OUTCOME[pick(data, 0) * 3 + move]] += 1
+            _record(data, 0, move)
+        return outcomes[0], outcomes[1], outcomes[2]
+
+    def stats(self):
+        return self.models.stats()
+
+
+class FrequencyStrategy(PatternStrategy):
+    """Expects the player's most frequent move."""
+
+    name = 'frequency'
+
+    def predict(self, data, offset):
+        row = offset + _COUNTS
+        return _most_frequent(data[row], data[row + 1], data[row + 2])
+
+
+class MarkovStrategy(PatternStrategy):
+    """
+    Expects the move the player most often followed their last move with.
+
+    A first-order Markov chain over the player's moves; until their last move
+    has been seen followed by anything, it expects their most frequent move.
+    """
+
+    name = 'markov'
+
+    def predict(self, data, offset):
+        last = data[offset + _LAST]
+        if last:
+            row = offset + _TRANSITIONS + (last - 1) * 3
+            predicted = _most_frequent(data[row], data[row + 1], data[row + 2])
+            if predicted is not None:
+                return predicted
+        row = offset + _COUNTS
+        return _most_frequent(data[row], data[row + 1], data[row + 2])
+
+
+STRATEGIES = {cls.name: cls for cls in (RandomStrategy, FrequencyStrategy, MarkovStrategy)}
+
+
+def create_strategy(name: Optional[str] = None) -> Strategy:
+    """
+    Create the strategy selected by name or by the SOLO_STRATEGY environment variable
+
+    Args:
+        name (str, optional): 'random' (default), 'frequency' or 'markov'
+
+    Returns:
+        Strategy: The strategy instance
+    """
+    name = (name or SOLO_STRATEGY).lower()
+    cls = STRATEGIES.get(name)
+    if cls is None:
+        logger.warning(f"Unknown solo strategy '{name}', playing randomly")
+        cls = RandomStrategy
+    return cls()
+
+
+def encode_moves(moves: Iterable[Optional[str]]) -> bytes:
+    """Pack move names into the byte string score_stream() takes, skipping missing moves."""
+    return bytes(MOVE_CODES[move] for move in moves if move in MOVE_CODES)
+
+
+class Evaluation:
+    """How a strategy did against a set of recorded move streams."""
+
+    __slots__ = ('name', 'wins', 'losses', 'draws', 'seconds')
+
+    def __init__(self, name: str, wins: int, losses: int, draws: int, seconds: float):
+        self.name = name
+        self.wins = wins
+        self.losses = losses
+        self.draws = draws
+        self.seconds = seconds
+
+    @property
+    def moves(self) -> int:
+        return self.wins + self.losses + self.draws
+
+    @property
+    def win_rate(self) -> float:
+        return self.wins / self.moves if self.moves else 0.0
+
+    @property
+    def edge(self) -> float:
+        """Wins minus losses per round: 0 for random play, 1 for a perfect read of the player."""
+        return (self.wins - self.losses) / self.moves if self.moves else 0.0
+
+    @property
+    def moves_per_second(self) -> float:
+        return self.moves / self.seconds if self.seconds else 0.0
+
+
+def evaluate(strategies: Iterable[Union[str, Strategy]], streams: Sequence[bytes]) -> List[Evaluation]:
+    """
+    Score strategies against recorded move streams, each stream replayed from an empty model
+
+    Args:
+        strategies: Strategy names or instances
+        streams: One byte string of move codes (see encode_moves) per player
+
+    Returns:
+        list: An Evaluation per strategy, in the order given
+    """
+    results = []
+    for strategy in strategies:
+        if isinstance(strategy, str):
+            strategy = create_strategy(strategy)
+        started = time.perf_counter()
+        wins = losses = draws = 0
+        for moves in streams:
+            w, l, d = strategy.score_stream(moves)
+            wins += w
+            losses += l
+            draws += d
+        results.append(Evaluation(strategy.name, wins, losses, draws, time.perf_counter() - started))
+    return results
+
+
+# Shared by every solo game, so a player's model keeps learning from game to game
+_strategy: Optional[Strategy] = None
+
+def get_strategy() -> Strategy:
+    """Get the solo opponent's strategy."""
+    global _strategy
+    if _strategy is None:
+        _strategy = create_strategy()
+    return _strategy
@@ -0,0 +1,13 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def fresh_stats():
+    """The stats module with empty in-memory state, as in a newly started process."""
+    import stats
+    stats.close_persistence()
+    stats = importlib.reload(stats)
+    yield stats
+    stats.close_persistence()
@@ -0,0 +1,42 @@
+from callback_dedup import CallbackDeduplicator
+
+
+def test_same_press_within_the_ttl_is_a_repeat():
+    dedup = CallbackDeduplicator(ttl=3, size=100)
+    assert not dedup.is_repeat(1, 'rock', 10, now=100.0)
+    assert dedup.is_repeat(1, 'rock', 10, now=102.9)
+    assert not dedup.is_repeat(1, 'rock', 10, now=103.0)
+    assert dedup.stats() == {'checked': 3, 'repeats': 1, 'remembered': 1}
+
+
+def test_repeats_do_not_extend_the_window():
+    dedup = CallbackDeduplicator(ttl=3, size=100)
+    dedup.is_repeat(1, 'rock', 10, now=100.0)
+    assert dedup.is_repeat(1, 'rock', 10, now=101.0)
+    assert dedup.is_repeat(1, 'rock', 10, now=102.0)
+    assert not dedup.is_repeat(1, 'rock', 10, now=103.5)
+
+
+def test_presses_differing_in_user_data_or_message_are_not_repeats():
+    dedup = CallbackDeduplicator(ttl=3, size=100)
+    dedup.is_repeat(1, 'rock', 10, now=100.0)
+    assert not dedup.is_repeat(2, 'rock', 10, now=100.1)
+    assert not dedup.is_repeat(1, 'paper', 10, now=100.1)
+    assert not dedup.is_repeat(1, 'rock', 11, now=100.1)
+    # A button without data is keyed like empty data
+    dedup.is_repeat(1, None, 12, now=100.1)
+    assert dedup.is_repeat(1, '', 12, now=100.2)
+
+
+def test_the_least_recently_seen_presses_are_evicted_first():
+    dedup = CallbackDeduplicator(ttl=60, size=3)
+    for message_id in (1, 2, 3):
+        dedup.is_repeat(1, 'rock', message_id, now=100.0)
+    # Seeing the first again makes the second the oldest
+    assert dedup.is_repeat(1, 'rock', 1, now=101.0)
+    dedup.is_repeat(1, 'rock', 4, now=102.0)
+    assert dedup.stats()['remembered'] == 3
+    assert not dedup.is_repeat(1, 'rock', 2, now=103.0)
+    assert dedup.is_repeat(1, 'rock', 1, now=103.0)
+    assert dedup.is_repeat(1, 'rock', 4, now=103.0)
+    assert dedup.stats()['remembered'] == 3
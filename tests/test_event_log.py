@@ -0,0 +1,169 @@
+import importlib
+import os
+import pickle
+from array import array
+
+import pytest
+
+from event_log import (
+    EventLog, LEGACY_SNAPSHOT_FILE, SNAPSHOT_FILE, decode_columns, encode_columns, is_columns
+)
+from storage import EventLogBackend
+
+
+def _segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith('.log'))
+
+
+def _write(path, payloads, snapshot_every=100000):
+    log = EventLog(str(path), snapshot_every=snapshot_every)
+    state, records = log.load()
+    list(records)
+    for payload in payloads:
+        log.append(1, payload)
+    log.close()
+
+
+def _load(path):
+    log = EventLog(str(path))
+    state, records = log.load()
+    return log, state, [payload for _, payload in records]
+
+
+def test_records_survive_reopening(tmp_path):
+    _write(tmp_path, [b'one', b'two'])
+    _write(tmp_path, [b'three'])
+    log, state, records = _load(tmp_path)
+    log.close()
+    assert state is None
+    assert records == [b'one', b'two', b'three']
+
+
+def test_torn_tail_is_dropped_and_later_writes_survive(tmp_path):
+    _write(tmp_path, [b'one', b'two'])
+    segment = tmp_path / _segments(tmp_path)[-1]
+    # A crash in the middle of a write: a record header promising more bytes than made it to disk
+    data = segment.read_bytes()
+    segment.write_bytes(data + data[:9] + b'tw')
+
+    log, state, records = _load(tmp_path)
+    assert records == [b'one', b'two']
+    # New records go to a fresh segment, so the torn one is never appended to
+    log.append(1, b'three')
+    log.close()
+
+    log, state, records = _load(tmp_path)
+    log.close()
+    assert records == [b'one', b'two', b'three']
+
+
+def test_corrupt_record_ends_its_segment(tmp_path):
+    _write(tmp_path, [b'first', b'second', b'third'])
+    segment = tmp_path / _segments(tmp_path)[-1]
+    data = bytearray(segment.read_bytes())
+    # Flip a byte in the second payload so its checksum no longer matches
+    data[9 + len(b'first') + 9] ^= 0xFF
+    segment.write_bytes(bytes(data))
+
+    log, state, records = _load(tmp_path)
+    log.close()
+    assert records == [b'first']
+
+
+def test_snapshot_replaces_older_segments(tmp_path):
+    log = EventLog(str(tmp_path))
+    log.load()
+    log.append(1, b'before')
+    log.snapshot(b'state')
+    log.append(1, b'after')
+    log.close()
+
+    log, state, records = _load(tmp_path)
+    log.close()
+    assert bytes(state) == b'state'
+    assert records == [b'after']
+    assert (tmp_path / SNAPSHOT_FILE).exists()
+
+
+def test_legacy_pickled_snapshot_is_read_then_replaced(tmp_path):
+    with open(tmp_path / LEGACY_SNAPSHOT_FILE, 'wb') as f:
+        pickle.dump({'segment': 0, 'state': {'legacy': True}}, f)
+
+    log, state, records = _load(tmp_path)
+    assert state == {'legacy': True}
+    log.snapshot(b'new')
+    log.close()
+
+    assert not (tmp_path / LEGACY_SNAPSHOT_FILE).exists()
+    log, state, records = _load(tmp_path)
+    log.close()
+    assert bytes(state) == b'new'
+
+
+def test_columns_round_trip():
+    columns = {
+        'ids': array('q', [1, -2, 2 ** 40]),
+        'codes': array('b', [-1, 0, 2]),
+        'counts': array('i', []),
+        'names': ['alice', 'bob', 'zoë'],
+    }
+    data = encode_columns(columns)
+    assert is_columns(data)
+    assert not is_columns(pickle.dumps(columns))
+
+    decoded = decode_columns(data)
+    assert list(decoded) == list(columns)
+    for name, values in columns.items():
+        assert decoded[name] == values
+        assert type(decoded[name]) is type(values)
+
+
+def _play(stats):
+    for game in range(3):
+        for user_id in range(1, 6):
+            result = ('win', 'lose', 'draw')[(user_id + game) % 3]
+            stats.update_user_stats(user_id, f"player_{user_id}", result, mode=('solo', 'multiplayer')[game % 2],
+                                    choice='rock', opponent_choice='paper', bet=10)
+            stats.update_user_currency(user_id, 5 * user_id, key=f"game-{game}:{user_id}")
+
+
+def _observed(stats):
+    return {
+        'stats': {user_id: stats.user_stats.to_dict(user_id) for user_id in range(1, 6)},
+        'history': {user_id: [dict(record) for record in stats.get_user_history(user_id, 10)]
+                    for user_id in range(1, 6)},
+        'currency': {user_id: stats.get_user_currency(user_id) for user_id in range(1, 6)},
+        'search': sorted(stats.find_users_by_username('player')),
+    }
+
+
+@pytest.mark.parametrize('snapshot_every', [100000, 7])
+def test_stats_round_trip_through_snapshot(tmp_path, fresh_stats, snapshot_every):
+    stats = fresh_stats
+    stats.init_persistence(EventLogBackend(str(tmp_path), snapshot_every=snapshot_every))
+    _play(stats)
+    pending = stats.sync_persistence()
+    pending.result()
+    expected = _observed(stats)
+    stats.close_persistence()
+
+    stats = importlib.reload(stats)
+    assert stats.init_persistence(EventLogBackend(str(tmp_path))) == 0
+    assert _observed(stats) == expected
+    assert stats.currency_change_applied('game-2:3')
+
+
+def test_stats_recover_from_the_log_after_a_crash(tmp_path, fresh_stats):
+    stats = fresh_stats
+    stats.init_persistence(EventLogBackend(str(tmp_path)))
+    _play(stats)
+    stats.sync_persistence().result()
+    expected = _observed(stats)
+    # No close_persistence(): the process dies with only the synced log on disk
+
+    stats = importlib.reload(stats)
+    assert stats.init_persistence(EventLogBackend(str(tmp_path))) == 30
+    assert _observed(stats) == expected
+    # Repeating a change that was logged before the crash does nothing
+    balance = stats.get_user_currency(3)
+    assert stats.update_user_currency(3, 15, key='game-2:3') == balance
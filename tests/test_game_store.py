@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from game_manager import CAS_ATTEMPTS, GameManager
+from game_store import GameStore, GameStoreError, MemoryGameStore, game_key, user_key
+
+CHAT = -1001
+
+
+class SharedStore(MemoryGameStore):
+    """
+    An in-memory store that packs values into bytes like a networked one, and lets a
+    test run another process's write just before each put() of ours.
+    """
+
+    pack_game = GameStore.pack_game
+    unpack_game = GameStore.unpack_game
+    pack_chat_ids = GameStore.pack_chat_ids
+    unpack_chat_ids = GameStore.unpack_chat_ids
+
+    def __init__(self):
+        super().__init__()
+        self.interfere = None
+        self.puts = 0
+
+    async def put(self, key, value, token=None, ttl=0):
+        self.puts += 1
+        interfere, self.interfere = self.interfere, None
+        if interfere is not None:
+            await interfere(key)
+        return await super().put(key, value, token, ttl)
+
+
+async def _other_process(store, chat_id, change):
+    """Change a game the way another bot process would, with its own read and write."""
+    other = GameManager(store)
+    return await other._modify(chat_id, change)
+
+
+def test_modify_redoes_the_change_on_a_game_changed_in_between():
+    async def run():
+        store = SharedStore()
+        manager = GameManager(store)
+        await manager.create_game(CHAT, 1, 'alice')
+
+        async def bob_joins(key):
+            await _other_process(store, CHAT, lambda game: game.add_player(2, 'bob'))
+        store.interfere = bob_joins
+
+        calls = []
+
+        def carol_joins(game):
+            calls.append(set(game.players))
+            return game.add_player(3, 'carol')
+
+        game, added = await manager._modify(CHAT, carol_joins)
+        assert added is True
+        # The first attempt saw only alice; the retry saw bob too and kept him
+        assert calls == [{1}, {1, 2}]
+        assert set(game.players) == {1, 2, 3}
+        assert set((await manager.get_game(CHAT)).players) == {1, 2, 3}
+        stored, token = await store.get(game_key(CHAT))
+        assert manager._tokens[CHAT] == token
+
+    asyncio.run(run())
+
+
+def test_modify_gives_up_after_cas_attempts_conflicts():
+    async def run():
+        store = SharedStore()
+        manager = GameManager(store)
+        await manager.create_game(CHAT, 1, 'alice')
+        puts = store.puts
+
+        async def always_first(key):
+            # Re-arm before writing, so every one of our puts loses the race
+            store.interfere = always_first
+            data, token = await store.get(key)
+            await MemoryGameStore.put(store, key, data, token)
+        store.interfere = always_first
+
+        with pytest.raises(GameStoreError):
+            await manager._modify(CHAT, lambda game: game.add_player(2, 'bob'))
+        store.interfere = None
+        assert store.puts - puts == CAS_ATTEMPTS
+        assert set((await manager.get_game(CHAT)).players) == {1}
+
+    asyncio.run(run())
+
+
+def test_modify_of_a_missing_game_forgets_the_cached_one():
+    async def run():
+        store = SharedStore()
+        manager = GameManager(store)
+        await manager.create_game(CHAT, 1, 'alice')
+        # Another process ends the game
+        assert await GameManager(store).end_game(CHAT)
+        assert CHAT in manager.games
+        assert await manager._modify(CHAT, lambda game: game.start_game()) == (None, None)
+        assert CHAT not in manager.games
+        assert CHAT not in manager._tokens
+
+    asyncio.run(run())
+
+
+def test_user_games_update_keeps_a_concurrent_change():
+    async def run():
+        store = SharedStore()
+        manager = GameManager(store)
+        await manager.track_player(1, CHAT)
+
+        async def joins_another_chat(key):
+            assert key == user_key(1)
+            await GameManager(store).track_player(1, -1002)
+        store.interfere = joins_another_chat
+
+        await manager.track_player(1, -1003)
+        assert await manager.get_user_games(1) == {CHAT, -1002, -1003}
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+from ledger import Ledger, settlement_key
+
+
+def test_posting_a_key_twice_changes_nothing():
+    ledger = Ledger(100)
+    key = settlement_key(-1001, 1700000000.5, 42)
+    assert ledger.post(42, 25, key) == (125, 25)
+    assert ledger.post(42, 25, key) is None
+    assert ledger.balance(42) == 125
+    assert key in ledger
+    assert ledger.stats()['duplicates'] == 1
+
+
+def test_changes_without_a_key_always_apply():
+    ledger = Ledger(100)
+    ledger.post(1, 10)
+    ledger.post(1, 10)
+    assert ledger.balance(1) == 120
+
+
+def test_balance_never_goes_below_zero():
+    ledger = Ledger(100)
+    assert ledger.post(1, -250, 'bet') == (0, -100)
+    assert ledger.balance(1) == 0
+
+
+def test_replayed_entries_respect_keys_applied_before():
+    ledger = Ledger(100)
+    ledger.post(1, 30, 'game-1')
+    # The same entry coming back from storage, by balance and by change
+    assert not ledger.replay_balance(1, 130, 'game-1')
+    assert not ledger.replay_change(1, 30, 'game-1')
+    assert ledger.balance(1) == 130
+
+    assert ledger.replay_change(1, -200, 'game-2')
+    # Changes from other processes aren't clamped, so every process ends up with the same balance
+    assert ledger.balance(1) == -70
+
+
+def test_keys_survive_a_reload():
+    ledger = Ledger(100)
+    ledger.post(1, 5, 'a')
+    ledger.post(2, 5, 'b')
+
+    restored = Ledger(100)
+    restored.load(dict(ledger.balances), ledger.keys())
+    assert restored.post(1, 5, 'a') is None
+    assert restored.balance(1) == 105
+
+
+def test_only_the_newest_keys_are_remembered():
+    ledger = Ledger(100, capacity=2)
+    for key in ('a', 'b', 'c'):
+        ledger.post(1, 1, key)
+    assert 'a' not in ledger
+    assert ledger.keys() == ['b', 'c']
+    # A key that has been forgotten applies again
+    assert ledger.post(1, 1, 'a') == (104, 1)
+
+    ledger.load({}, ['w', 'x', 'y', 'z'])
+    assert ledger.keys() == ['y', 'z']
+
+
+def test_stats_ignore_a_repeated_wallet_change(fresh_stats):
+    stats = fresh_stats
+    start = stats.get_user_currency(7)
+    assert stats.update_user_currency(7, 40, key='mp:1:2.0:7') == start + 40
+    assert stats.update_user_currency(7, 40, key='mp:1:2.0:7') == start + 40
+    assert stats.currency_change_applied('mp:1:2.0:7')
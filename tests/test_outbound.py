@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import TimedOut
+
+from outbound import NOT_SENT, OutboundScheduler
+
+GROUP = -1001
+PRIVATE = 42
+
+
+class FakeBot:
+    """Records the Bot API calls made, failing the first few with the given errors."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    async def _call(self, method, **kwargs):
+        self.calls.append((method, kwargs))
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(**{'message_id': len(self.calls), **kwargs})
+
+    async def send_message(self, **kwargs):
+        return await self._call('send_message', **kwargs)
+
+    async def edit_message_text(self, **kwargs):
+        return await self._call('edit_message_text', **kwargs)
+
+
+def test_a_call_that_sends_nothing_gives_its_tokens_back():
+    async def scenario():
+        bot = FakeBot()
+        # Rates too slow to refill noticeably while the test runs
+        outbound = OutboundScheduler(bot, global_rate=5, private_rate=0.001, private_burst=3)
+        sent = []
+        first = outbound.send_message(PRIVATE, 'hello')
+        skipped = outbound.submit(PRIVATE, lambda bot: asyncio.sleep(0, NOT_SENT), on_sent=sent.append)
+        assert await outbound.drain(5)
+        assert (await first).text == 'hello'
+        assert await skipped is None
+        assert sent == []
+        assert outbound.stats()['sent'] == 1
+        assert outbound.stats()['skipped'] == 1
+        assert outbound._chats[PRIVATE].bucket.tokens == pytest.approx(2, abs=0.01)
+        assert outbound._global.tokens == pytest.approx(4, abs=0.1)
+
+    asyncio.run(scenario())
+
+
+def test_edits_to_the_text_already_shown_are_skipped():
+    async def scenario():
+        bot = FakeBot()
+        outbound = OutboundScheduler(bot, rate_limits=False)
+        message = await outbound.send_message(GROUP, 'waiting for players')
+        assert await outbound.edit_message_text(GROUP, message.message_id, 'waiting for players') is None
+        assert [method for method, _ in bot.calls] == ['send_message']
+        assert outbound.stats()['skipped'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_sends_are_not_repeated_after_a_network_error():
+    async def scenario():
+        bot = FakeBot(TimedOut())
+        outbound = OutboundScheduler(bot, rate_limits=False)
+        failed = []
+        future = outbound.send_message(GROUP, 'You won!', on_error=failed.append)
+        assert await outbound.drain(5)
+        with pytest.raises(TimedOut):
+            await future
+        assert len(bot.calls) == 1
+        assert len(failed) == 1
+        assert outbound.stats()['retried'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_edits_are_retried_after_a_network_error():
+    async def scenario():
+        bot = FakeBot(TimedOut())
+        outbound = OutboundScheduler(bot, rate_limits=False)
+        edited = await asyncio.wait_for(outbound.edit_message_text(GROUP, 7, 'Game started'), 5)
+        assert edited.text == 'Game started'
+        assert [method for method, _ in bot.calls] == ['edit_message_text'] * 2
+        assert outbound.stats()['retried'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_replies_quote_the_command_outside_private_chats():
+    async def scenario():
+        bot = FakeBot()
+        outbound = OutboundScheduler(bot, rate_limits=False)
+        group = SimpleNamespace(chat=SimpleNamespace(type='supergroup'), chat_id=GROUP, message_id=5)
+        private = SimpleNamespace(chat=SimpleNamespace(type='private'), chat_id=PRIVATE, message_id=6)
+        await outbound.reply_to(group, 'Game created')
+        await outbound.reply_to(private, 'Choose your move')
+        (_, in_group), (_, in_private) = bot.calls
+        assert in_group['chat_id'] == GROUP
+        assert in_group['reply_to_message_id'] == 5
+        assert in_group['allow_sending_without_reply'] is True
+        assert in_private['chat_id'] == PRIVATE
+        assert 'reply_to_message_id' not in in_private
+
+    asyncio.run(scenario())
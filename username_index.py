@@ -0,0 +1,319 @@
+from array import array
+from bisect import bisect_left, insort
+from itertools import accumulate, chain
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+# Length of the n-grams indexed for substring search
+GRAM_SIZE = 3
+
+# Names per block of the sorted name list; a block is split once it holds twice as many
+_BLOCK_SIZE = 1024
+
+
+def normalize_username(username: str) -> str:
+    """Normalize a username for lookups (case-insensitive, without a leading @)."""
+    return (username or '').lower().strip('@')
+
+
+def _grams(name: str) -> Set[str]:
+    return {name[i:i + GRAM_SIZE] for i in range(len(name) - GRAM_SIZE + 1)}
+
+
+class _SortedBlocks:
+    """
+    Sorted list of (normalized name, user_id) pairs, kept in blocks.
+
+    An insert or delete only shifts the items of one block plus the list of block
+    maxima, instead of the whole list, so it stays cheap with millions of names.
+    """
+
+    __slots__ = ('_blocks', '_maxes', '_len')
+
+    def __init__(self, items: List[Tuple[str, int]] = ()):
+        """Take items that are already sorted."""
+        self._blocks = [items[i:i + _BLOCK_SIZE] for i in range(0, len(items), _BLOCK_SIZE)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(items)
+
+    def copy(self) -> '_SortedBlocks':
+        copied = _SortedBlocks()
+        copied._blocks = [block[:] for block in self._blocks]
+        copied._maxes = self._maxes[:]
+        copied._len = self._len
+        return copied
+
+    def __iter__(self) -> Iterator[Tuple[str, int]]:
+        return chain.from_iterable(self._blocks)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, item: Tuple[str, int]) -> None:
+        blocks, maxes = self._blocks, self._maxes
+        self._len += 1
+        if not blocks:
+            blocks.append([item])
+            maxes.append(item)
+            return
+        i = bisect_left(maxes, item)
+        if i == len(maxes):
+            # Past every name so far: goes at the end of the last block
+            i -= 1
+            blocks[i].append(item)
+            maxes[i] = item
+        else:
+            insort(blocks[i], item)
+        block = blocks[i]
+        if len(block) > 2 * _BLOCK_SIZE:
+            blocks[i:i + 1] = [block[:_BLOCK_SIZE], block[_BLOCK_SIZE:]]
+            maxes[i:i + 1] = [block[_BLOCK_SIZE - 1], block[-1]]
+
+    def remove(self, item: Tuple[str, int]) -> None:
+        blocks, maxes = self._blocks, self._maxes
+        i = bisect_left(maxes, item)
+        if i == len(maxes):
+            return
+        block = blocks[i]
+        position = bisect_left(block, item)
+        if position == len(block) or block[position] != item:
+            return
+        del block[position]
+        self._len -= 1
+        if not block:
+            del blocks[i]
+            del maxes[i]
+        elif position == len(block):
+            maxes[i] = block[-1]
+
+    def starting_at(self, item: Tuple[str, int]) -> Iterator[Tuple[str, int]]:
+        """The items from the first one not less than item onwards, in order."""
+        blocks = self._blocks
+        i = bisect_left(self._maxes, item)
+        if i == len(blocks):
+            return
+        block = blocks[i]
+        for position in range(bisect_left(block, item), len(block)):
+            yield block[position]
+        for block in blocks[i + 1:]:
+            yield from block
+
+
+class UsernameIndex:
+    """
+    Index of player usernames for exact, prefix and substring lookups.
+
+    Substring queries intersect the trigram posting lists of the query and verify
+    the few remaining candidates, so their cost depends on how many names share the
+    query's trigrams rather than on the total number of players. Prefix queries
+    use a sorted list of names, kept in blocks. Queries shorter than a trigram fall
+    back to a scan, since they match a large share of all names anyway.
+
+    snapshot() shares the posting sets with the copy it returns, and the index
+    copies a set the first time it changes one afterwards, like HistoryRings.
+    Postings loaded with from_columns() stay in one flat array until a query or
+    an update first needs them.
+    """
+
+    def __init__(self):
+        self._names: Dict[int, Tuple[str, str]] = {}  # user_id -> (normalized, display name)
+        self._postings: Dict[str, Set[int]] = {}       # trigram -> user_ids whose name contains it
+        self._sorted = _SortedBlocks()                 # (normalized name, user_id), sorted
+        # Postings not unpacked yet: trigram -> (start, end) of its user_ids in _packed_ids
+        self._packed_postings: Dict[str, Tuple[int, int]] = {}
+        self._packed_ids = array('q')
+        # Trigrams whose postings were copied (or created) since the last snapshot; None before the first one
+        self._owned: Optional[Set[str]] = None
+
+    def load(self, users) -> None:
+        """
+        Replace the index with a saved UsernameIndex, or with (user_id, username) pairs, each user once
+
+        Indexing pairs is much faster than calling set() for each user: the names are
+        sorted once and the trigram postings filled in a single pass.
+        """
+        if isinstance(users, UsernameIndex):
+            self.__dict__.update(users.__dict__)
+            self._owned = None
+            return
+        names: Dict[int, Tuple[str, str]] = {}
+        postings: Dict[str, Set[int]] = {}
+        for user_id, username in users:
+            normalized = normalize_username(username)
+            if not normalized.strip():
+                continue
+            names[user_id] = (normalized, username)
+            for gram in _grams(normalized):
+                posting = postings.get(gram)
+                if posting is None:
+                    postings[gram] = {user_id}
+                else:
+                    posting.add(user_id)
+        self._names = names
+        self._postings = postings
+        self._sorted = _SortedBlocks(sorted((entry[0], user_id) for user_id, entry in names.items()))
+        self._packed_postings = {}
+        self._packed_ids = array('q')
+        self._owned = None
+
+    def snapshot(self) -> 'UsernameIndex':
+        """A copy that stays as it is while this index changes, e.g. for another thread to save."""
+        copied = UsernameIndex.__new__(UsernameIndex)
+        copied._names = self._names.copy()
+        copied._postings = self._postings.copy()
+        copied._sorted = self._sorted.copy()
+        copied._packed_postings = self._packed_postings.copy()
+        copied._packed_ids = self._packed_ids  # Never changed, only replaced
+        copied._owned = None
+        self._owned = set()
+        return copied
+
+    def _posting(self, gram: str) -> Optional[Set[int]]:
+        posting = self._postings.get(gram)
+        if posting is None:
+            span = self._packed_postings.pop(gram, None)
+            if span is not None:
+                posting = self._postings[gram] = set(self._packed_ids[span[0]:span[1]])
+                # A new set, so not shared with any snapshot
+                if self._owned is not None:
+                    self._owned.add(gram)
+        return posting
+
+    def _writable_posting(self, gram: str) -> Optional[Set[int]]:
+        posting = self._posting(gram)
+        owned = self._owned
+        if posting is not None and owned is not None and gram not in owned:
+            posting = self._postings[gram] = set(posting)
+            owned.add(gram)
+        return posting
+
+    def to_columns(self) -> Dict[str, object]:
+        """The index as named columns, for event_log.encode_columns."""
+        entries = list(self._sorted)
+        names = self._names
+        packed, spans = self._packed_ids, self._packed_postings.values()
+        return {
+            'names': [name for name, _ in entries],
+            'user_ids': array('q', [user_id for _, user_id in entries]),
+            'display_names': [names[user_id][1] for _, user_id in entries],
+            'grams': list(self._postings) + list(self._packed_postings),
+            'posting_sizes': array('I', chain(map(len, self._postings.values()),
+                                              (end - start for start, end in spans))),
+            'postings': array('q', chain(chain.from_iterable(self._postings.values()),
+                                         *[packed[start:end] for start, end in spans])),
+        }
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, object]) -> 'UsernameIndex':
+        """Rebuild an index from to_columns() output without re-deriving anything."""
+        index = cls()
+        names, user_ids = columns['names'], columns['user_ids']
+        index._names = dict(zip(user_ids, zip(names, columns['display_names'])))
+        index._sorted = _SortedBlocks(list(zip(names, user_ids)))
+        starts = [0, *accumulate(columns['posting_sizes'])]
+        index._packed_postings = dict(zip(columns['grams'], zip(starts, starts[1:])))
+        index._packed_ids = columns['postings']
+        return index
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def set(self, user_id: int, username: str) -> str:
+        """
+        Index a user's current username, replacing any previous one
+
+        Returns:
+            str: The user's previous normalized username, or '' if there was none
+        """
+        normalized = normalize_username(username)
+        previous = self._names.get(user_id)
+        if previous is not None:
+            if previous[0] == normalized:
+                # Same name, maybe different capitalization
+                self._names[user_id] = (normalized, username)
+                return previous[0]
+            self.remove(user_id)
+        if not normalized.strip():
+            return previous[0] if previous else ''
+
+        self._names[user_id] = (normalized, username)
+        for gram in _grams(normalized):
+            posting = self._writable_posting(gram)
+            if posting is None:
+                self._postings[gram] = {user_id}
+                if self._owned is not None:
+                    self._owned.add(gram)
+            else:
+                posting.add(user_id)
+        self._sorted.add((normalized, user_id))
+        return previous[0] if previous else ''
+
+    def remove(self, user_id: int) -> None:
+        """Remove a user from the index."""
+        entry = self._names.pop(user_id, None)
+        if entry is None:
+            return
+        normalized = entry[0]
+        for gram in _grams(normalized):
+            posting = self._writable_posting(gram)
+            if posting is not None:
+                posting.discard(user_id)
+                if not posting:
+                    del self._postings[gram]
+        self._sorted.remove((normalized, user_id))
+
+    def display_name(self, user_id: int) -> str:
+        entry = self._names.get(user_id)
+        return entry[1] if entry else ''
+
+    def prefix(self, query: str) -> List[Tuple[int, str]]:
+        """All users whose username starts with query, sorted by name."""
+        query = normalize_username(query)
+        matches = []
+        for name, user_id in self._sorted.starting_at((query, -2 ** 63)):
+            if not name.startswith(query):
+                break
+            matches.append((user_id, self._names[user_id][1]))
+        return matches
+
+    def substring(self, query: str) -> List[Tuple[int, str]]:
+        """All users whose username contains query, sorted by name."""
+        query = normalize_username(query)
+        if not query:
+            return []
+
+        if len(query) < GRAM_SIZE:
+            candidates = self._names.keys()
+        else:
+            postings = []
+            for gram in _grams(query):
+                posting = self._posting(gram)
+                if not posting:
+                    return []
+                postings.append(posting)
+            # Intersect starting from the rarest trigram to keep the working set small
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates &= posting
+                if not candidates:
+                    return []
+
+        matches = []
+        for user_id in candidates:
+            normalized, display = self._names[user_id]
+            if query in normalized:
+                matches.append((normalized, user_id, display))
+        matches.sort()
+        return [(user_id, display) for _, user_id, display in matches]
+
+    def search(self, query: str) -> List[Tuple[int, str]]:
+        """
+        Find users matching query: prefix matches first, then other substring matches
+
+        Returns:
+            list: (user_id, username) tuples
+        """
+        query = normalize_username(query)
+        prefix_matches = self.prefix(query)
+        seen = {user_id for user_id, _ in prefix_matches}
+        return prefix_matches + [match for match in self.substring(query) if match[0] not in seen]
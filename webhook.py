@@ -0,0 +1,166 @@
+import os
+import hmac
+import json
+import asyncio
+import logging
+import secrets
+import threading
+from typing import Optional
+
+from telegram import Update
+
+from bot import TELEGRAM_TOKEN, create_application, close_persistence
+from sharding import BOT_SHARDS, ShardedRuntime, create_front_bot, dispatch_raw_update
+
+logger = logging.getLogger(__name__)
+
+# Public HTTPS URL Telegram should deliver updates to (e.g. https://example.com/telegram)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# Path the web server accepts updates on
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Value Telegram sends back in the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Concurrent connections Telegram may open to the webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+SECRET_HEADER = "HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN"
+
+
+class WebhookBridge:
+    """
+    Runs the bot's Application on an event loop in a background thread and feeds
+    it updates received by the web server.
+
+    Web server threads hand each update to the loop with submit() and return right
+    away; the Application processes the queue just like with polling, including its
+    scheduled jobs. Game state lives in this process, so run a single web worker
+    process (with as many threads as you like).
+
+    With shards > 1 the bot runs in worker processes instead (see sharding.py) and
+    submit() only routes each update to the inbox of the worker that owns its chat.
+    Started before the web server forks its workers (gunicorn --preload), every web
+    worker shares those inboxes, so any number of them can accept updates.
+    """
+
+    def __init__(self, url: str = WEBHOOK_URL, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH,
+                 shards: int = BOT_SHARDS):
+        self.url = url
+        self.shards = shards
+        self.path = path
+        if not secret:
+            # Telegram only echoes a secret we registered, so a random one works as long as we register it
+            secret = secrets.token_urlsafe(32)
+            if not url:
+                logger.warning("WEBHOOK_SECRET is not set and WEBHOOK_URL is empty; "
+                               "updates will be rejected until the webhook is registered by this process")
+        self.secret = secret
+        self.application = None
+        self.runtime: Optional[ShardedRuntime] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        """Start the Application and register the webhook. Returns False if the bot isn't configured."""
+        if self.shards > 1:
+            return self._start_shards()
+
+        self.application = create_application()
+        if not self.application:
+            return False
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="telegram-webhook", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._startup(), self.loop).result()
+        return True
+
+    def _start_shards(self) -> bool:
+        if not TELEGRAM_TOKEN:
+            logger.error("No Telegram token provided. Please set the TELEGRAM_TOKEN environment variable.")
+            return False
+        bot = create_front_bot()
+        self.runtime = ShardedRuntime(self.shards)
+        self.runtime.start()
+        if self.url:
+            asyncio.run(self._register_with(bot))
+        return True
+
+    async def _register_with(self, bot) -> None:
+        async with bot:
+            await self._register(bot)
+
+    async def _register(self, bot) -> None:
+        await bot.set_webhook(
+            url=self.url,
+            secret_token=self.secret,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"Webhook registered at {self.url}")
+
+    async def _startup(self) -> None:
+        await self.application.initialize()
+        if self.url:
+            await self._register(self.application.bot)
+        await self.application.start()
+
+    def check_secret(self, received: Optional[str]) -> bool:
+        return received is not None and hmac.compare_digest(received, self.secret)
+
+    def submit(self, body: bytes) -> bool:
+        """Queue a raw update from Telegram. Returns False if it couldn't be parsed."""
+        if self.runtime is not None:
+            return dispatch_raw_update(self.runtime, body)
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.error(f"Invalid update received on webhook: {e}")
+            return False
+        asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop)
+        return True
+
+    def stop(self) -> None:
+        if self.runtime is not None:
+            self.runtime.stop()
+            self.runtime = None
+            return
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=30)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        self.loop = None
+        close_persistence()
+
+    async def _shutdown(self) -> None:
+        await self.application.stop()
+        # Run the post_stop hook like run_polling() does (it flushes queued messages)
+        if self.application.post_stop:
+            await self.application.post_stop(self.application)
+        await self.application.shutdown()
+
+    def handle_request(self, environ, start_response):
+        """WSGI handling of one POST from Telegram."""
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return _respond(start_response, "405 Method Not Allowed")
+        if not self.check_secret(environ.get(SECRET_HEADER)):
+            return _respond(start_response, "403 Forbidden")
+
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        body = environ['wsgi.input'].read(length) if length else b''
+        if not self.submit(body):
+            return _respond(start_response, "400 Bad Request")
+        return _respond(start_response, "200 OK")
+
+
+def _respond(start_response, status: str, text: str = ""):
+    data = text.encode('utf-8')
+    start_response(status, [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", str(len(data)))
+    ])
+    return [data]
+